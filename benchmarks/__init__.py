@@ -0,0 +1,7 @@
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+
+# oee_timeseries modules import each other as top-level modules, as they do when deployed as a function
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "oee_timeseries"))
@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+from .cases import CASES
+from .cases import SCALES
+from .runner import compare
+from .runner import format_table
+from .runner import measure
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Benchmark the OEE kernel, gap filling and extractor decoding paths on synthetic inputs.",
+    )
+    parser.add_argument("--scale", nargs="+", choices=list(SCALES), default=["small", "medium"])
+    parser.add_argument("--case", nargs="+", choices=list(CASES), default=list(CASES))
+    parser.add_argument("--repeat", type=int, default=5, help="timed calls per case")
+    parser.add_argument("--save", type=Path, help="write the results to this file, to compare later runs against")
+    parser.add_argument("--compare", type=Path, help="baseline written by an earlier run with --save")
+    parser.add_argument(
+        "--threshold", type=float, default=0.2, help="relative slowdown or memory growth that counts as a regression"
+    )
+    args = parser.parse_args()
+
+    results = {}
+    for scale in args.scale:
+        for name in args.case:
+            case = CASES[name](**SCALES[scale])
+            print(f"Running {case.key}", file=sys.stderr)
+            results[case.key] = measure(case, repeat=args.repeat)
+
+    baseline = json.loads(args.compare.read_text()) if args.compare else {}
+    print(format_table(results, baseline))
+
+    if args.save:
+        args.save.write_text(json.dumps(results, indent=2, sort_keys=True))
+        print(f"Saved results to {args.save}")
+
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
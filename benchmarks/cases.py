@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+import arrow
+import numpy as np
+import ujson
+from cognite.client.data_classes import TimeSeries
+from handler import get_payload
+from handler import process_site
+from requests import PreparedRequest
+from requests import Response
+from requests.adapters import BaseAdapter
+from tools import discover_datapoints
+
+from common.timegrid import DAY_MS
+from common.timegrid import MINUTE_MS
+from common.timegrid import Span
+from common.timegrid import spans
+from common.timegrid import to_ms
+from execute_rest_extractor.ice_cream_factory_datapoints_extractor.ice_cream_factory_api import IceCreamFactoryAPI
+from local_backend import FakeCogniteClient
+from local_backend import SyntheticFactory
+
+# Fixed end of all benchmark inputs, so every run works on the same data
+NOW = to_ms(arrow.get("2023-01-02T00:00:00+00:00"))
+
+# Inputs of every case per scale
+SCALES: Dict[str, Dict[str, int]] = {
+    "small": {"machines": 2, "lookback_minutes": 1440, "points_per_response": 1440},
+    "medium": {"machines": 10, "lookback_minutes": 7 * 1440, "points_per_response": 7 * 1440},
+    "large": {"machines": 50, "lookback_minutes": 30 * 1440, "points_per_response": 30 * 1440},
+}
+
+
+@dataclass
+class Case:
+    """
+    A benchmarked function and the inputs of one scale.
+
+    Args:
+        name: name of the case
+        params: inputs the case was set up with
+        items: datapoints handled by one call, for throughput
+        run: the call to measure
+    """
+
+    name: str
+    params: Dict[str, int]
+    items: int
+    run: Callable[[], Any]
+
+    @property
+    def key(self) -> str:
+        return f"{self.name}[{','.join(f'{k}={v}' for k, v in self.params.items())}]"
+
+
+def _factory(machines: int) -> SyntheticFactory:
+    return SyntheticFactory(sites=["Oslo"], equipment_per_site=machines)
+
+
+def _window(lookback_minutes: int) -> Span:
+    return NOW - lookback_minutes * MINUTE_MS, NOW
+
+
+def discover_datapoints_case(machines: int, lookback_minutes: int, **_) -> Case:
+    """
+    discover_datapoints on retrieved 1 minute sums, with the status seeds cached so no client is needed.
+    """
+    factory = _factory(machines)
+    window = _window(lookback_minutes)
+    start, end = window
+    ts = {meta["external_id"]: TimeSeries(external_id=meta["external_id"]) for meta in factory.timeseries()}
+    retrieved = {ext_id: np.column_stack(factory.datapoints(ext_id, start, end)).astype(np.float64) for ext_id in ts}
+    seed_cache: Dict[Tuple[str, int], Tuple[list, list]] = {
+        (ext_id, start + 1): ([start - 60_000], [1.0]) for ext_id in ts if ext_id.endswith("status")
+    }
+    return Case(
+        name="discover_datapoints",
+        params={"machines": machines, "lookback_minutes": lookback_minutes},
+        items=sum(len(v) for v in retrieved.values()),
+        run=lambda: discover_datapoints(None, ts, window, retrieved, seed_cache),
+    )
+
+
+class _CountingUploader:
+    """Stands in for DatapointsUploader, counting the datapoints handed to it."""
+
+    def __init__(self):
+        self.datapoints = 0
+
+    def add(self, datapoints: List[Dict[str, Any]], typ: str) -> None:
+        self.datapoints += sum(len(record["datapoints"]) for record in datapoints)
+
+
+def process_site_case(machines: int, lookback_minutes: int, **_) -> Case:
+    """
+    process_site end to end against a FakeCogniteClient prefilled with the input datapoints.
+    """
+    factory = _factory(machines)
+    window = _window(lookback_minutes)
+    client = FakeCogniteClient(factory, prefill=True, prefill_days=lookback_minutes / 1440 + 1, now=NOW)
+    windows = spans(*window, DAY_MS, anchor=window[0])
+    return Case(
+        name="process_site",
+        params={"machines": machines, "lookback_minutes": lookback_minutes},
+        items=machines * 4 * lookback_minutes,
+        run=lambda: process_site(client, _CountingUploader(), "Oslo", windows, {}),
+    )
+
+
+def get_payload_case(machines: int, lookback_minutes: int, **_) -> Case:
+    """
+    get_payload for one metric of every machine over the window.
+    """
+    window = _window(lookback_minutes)
+    metrics = np.random.default_rng(0).random((machines, lookback_minutes))
+    return Case(
+        name="get_payload",
+        params={"machines": machines, "lookback_minutes": lookback_minutes},
+        items=metrics.size,
+        run=lambda: [get_payload(values, window) for values in metrics],
+    )
+
+
+class _CannedAdapter(BaseAdapter):
+    """Answers every request with the same prebuilt body, so only the client side is measured."""
+
+    def __init__(self, content: bytes):
+        super().__init__()
+        self.content = content
+
+    def send(self, request: PreparedRequest, **kwargs) -> Response:
+        response = Response()
+        response.status_code = 200
+        response._content = self.content
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self) -> None:
+        pass
+
+
+def _api_datapoints_case(name: str, arrays: bool, machines: int, points_per_response: int) -> Case:
+    factory = _factory(machines)
+    end = NOW
+    start = end - points_per_response * factory.interval_ms
+    body = {}
+    for meta in factory.timeseries():
+        timestamps, values = factory.datapoints(meta["external_id"], start, end)
+        body[meta["external_id"]] = [[t / 1000, v] for t, v in zip(timestamps.tolist(), values.tolist())]
+    api = IceCreamFactoryAPI(base_url="http://localhost", retries=0)
+    api.session.mount("http://", _CannedAdapter(ujson.dumps(body).encode("utf-8")))
+    return Case(
+        name=name,
+        params={"machines": machines, "points_per_response": points_per_response},
+        items=sum(len(v) for v in body.values()),
+        run=lambda: api.get_oee_timeseries_datapoints("Oslo", start / 1000, end / 1000, arrays=arrays),
+    )
+
+
+def api_datapoints_case(machines: int, points_per_response: int, **_) -> Case:
+    """
+    Parsing of a datapoints response for every series of the site into (timestamp, value) tuples.
+    """
+    return _api_datapoints_case("get_oee_timeseries_datapoints", False, machines, points_per_response)
+
+
+def api_datapoints_arrays_case(machines: int, points_per_response: int, **_) -> Case:
+    """
+    Parsing of a datapoints response for every series of the site into timestamp and value arrays.
+    """
+    return _api_datapoints_case("get_oee_timeseries_datapoints_arrays", True, machines, points_per_response)
+
+
+CASES: Dict[str, Callable[..., Case]] = {
+    "discover_datapoints": discover_datapoints_case,
+    "process_site": process_site_case,
+    "get_payload": get_payload_case,
+    "get_oee_timeseries_datapoints": api_datapoints_case,
+    "get_oee_timeseries_datapoints_arrays": api_datapoints_arrays_case,
+}
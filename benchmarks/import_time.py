@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import argparse
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# Function folders, deployed with their handler module at the top level
+FUNCTIONS = {
+    "oee_timeseries": ROOT / "oee_timeseries",
+    "execute_rest_extractor": ROOT / "execute_rest_extractor",
+}
+
+
+def import_times(function_dir: Path, python: str = sys.executable) -> Dict[str, Tuple[int, int]]:
+    """
+    Import the handler of a function in a fresh interpreter, as on a cold start, and get the import time of every
+    module it loads.
+
+    Args:
+        function_dir: folder of the function
+        python: interpreter to run
+
+    Returns:
+        Own and cumulative import time in microseconds per module
+    """
+    env = dict(os.environ, PYTHONPATH=str(ROOT))
+    result = subprocess.run(
+        [python, "-X", "importtime", "-c", "import handler"],
+        cwd=function_dir,
+        env=env,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=False,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, module = (field.strip() for field in line[len("import time:") :].split("|"))
+        times[module.strip()] = (int(own), int(cumulative))
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing the handler of {function_dir.name} failed:\n{result.stderr[-2000:]}")
+    return times
+
+
+def top_level(times: Dict[str, Tuple[int, int]]) -> List[Tuple[str, int]]:
+    """
+    Cumulative import time in microseconds of the top level packages, slowest first.
+    """
+    packages: Dict[str, int] = {}
+    for module, (own, _) in times.items():
+        package = module.split(".")[0]
+        packages[package] = packages.get(package, 0) + own
+    return sorted(packages.items(), key=lambda item: item[1], reverse=True)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.import_time",
+        description="Measure the cold start import time of the function handlers.",
+    )
+    parser.add_argument("--function", nargs="+", choices=list(FUNCTIONS), default=list(FUNCTIONS))
+    parser.add_argument("--budget-ms", type=float, help="import time per handler above which the run fails")
+    parser.add_argument("--top", type=int, default=10, help="number of packages to list per handler")
+    parser.add_argument("--repeat", type=int, default=3, help="imports per handler, the fastest is reported")
+    args = parser.parse_args()
+
+    over_budget = []
+    for name in args.function:
+        runs = [import_times(FUNCTIONS[name]) for _ in range(args.repeat)]
+        times = min(runs, key=lambda run: sum(own for own, _ in run.values()))
+        total_ms = sum(own for own, _ in times.values()) / 1000
+        print(f"{name}: {total_ms:.0f} ms to import handler")
+        for package, own in top_level(times)[: args.top]:
+            print(f"  {package:<40} {own / 1000:>8.1f} ms")
+        if args.budget_ms is not None and total_ms > args.budget_ms:
+            over_budget.append(f"{name}: {total_ms:.0f} ms > {args.budget_ms:.0f} ms")
+
+    for line in over_budget:
+        print(f"OVER BUDGET {line}")
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import gc
+import statistics
+import tracemalloc
+from time import perf_counter
+from typing import Any
+from typing import Dict
+from typing import List
+
+from .cases import Case
+
+
+def measure(case: Case, repeat: int = 5) -> Dict[str, Any]:
+    """
+    Time a case and measure its memory use.
+
+    The call is timed repeat times after one warm-up call, without tracing. It is then run once more under tracemalloc
+    for the peak memory and the number of allocations it makes, counted as memory blocks allocated and not freed again
+    before the call returns (the result included).
+
+    Args:
+        case: case to measure
+        repeat: number of timed calls
+    """
+    case.run()
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        started = perf_counter()
+        case.run()
+        timings.append(perf_counter() - started)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        result = case.run()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    del result
+    not_tracemalloc = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    blocks = sum(
+        stat.count_diff
+        for stat in after.filter_traces(not_tracemalloc).compare_to(before.filter_traces(not_tracemalloc), "filename")
+    )
+
+    seconds = statistics.median(timings)
+    return {
+        "case": case.name,
+        "params": case.params,
+        "items": case.items,
+        "seconds": seconds,
+        "best_seconds": min(timings),
+        "items_per_sec": case.items / seconds if seconds else float("inf"),
+        "peak_kib": peak / 1024,
+        "allocated_blocks": blocks,
+    }
+
+
+def compare(
+    results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]], threshold: float = 0.2
+) -> List[str]:
+    """
+    Compare results to a baseline of the same cases.
+
+    Args:
+        results: measure() results keyed by case key
+        baseline: earlier results keyed by case key
+        threshold: relative increase of the best time or the peak memory that counts as a regression
+
+    Returns:
+        Descriptions of the regressions
+    """
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        for metric in ("best_seconds", "peak_kib"):
+            if base[metric] and result[metric] > base[metric] * (1 + threshold):
+                regressions.append(f"{key}: {metric} {base[metric]:.4g} -> {result[metric]:.4g}")
+    return regressions
+
+
+def format_table(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]]) -> str:
+    lines = [
+        f"{'case':<76} {'median s':>10} {'items/s':>12} {'peak KiB':>10} {'blocks':>9} {'best vs base':>12}",
+    ]
+    for key, result in results.items():
+        base = baseline.get(key)
+        change = f"{result['best_seconds'] / base['best_seconds']:.2f}x" if base and base["best_seconds"] else "-"
+        lines.append(
+            f"{key:<76} {result['seconds']:>10.4f} {result['items_per_sec']:>12.4g} "
+            f"{result['peak_kib']:>10.0f} {result['allocated_blocks']:>9} {change:>12}"
+        )
+    return "\n".join(lines)
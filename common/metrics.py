@@ -0,0 +1,214 @@
+from __future__ import annotations
+
+import os
+import tempfile
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Sequence
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets, as in the Prometheus exposition format.
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """
+        Upper bound of the bucket holding the q-quantile, the largest observation for the last bucket.
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank and seen > 0:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    """
+    Thread-safe counters, latency histograms and gauges of one function run, grouped by stage (e.g. CDF reads, API
+    requests, compute, uploads).
+
+    Results are available as a summary for the function return value, and in the Prometheus text format, written to a
+    textfile for the node exporter or pushed to a pushgateway.
+
+    Args:
+        namespace: prefix of the Prometheus metric names
+        buckets: upper bounds (seconds) of the latency histogram buckets
+    """
+
+    def __init__(self, namespace: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.namespace = namespace
+        self.buckets = tuple(buckets)
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Forget everything recorded so far, e.g. at the start of a warm function invocation.
+        """
+        with self._lock:
+            self.started = monotonic()
+            self.latencies: Dict[str, Histogram] = {}
+            self.counters: Dict[str, Dict[str, float]] = {}
+            self.gauges: Dict[str, Dict[str, float]] = {}
+            self.gauge_max: Dict[str, Dict[str, float]] = {}
+
+    @contextmanager
+    def time(self, stage: str) -> Iterator[None]:
+        """
+        Record the duration of the block as one call of the stage, also when it raises.
+        """
+        started = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(stage, monotonic() - started)
+
+    def observe(self, stage: str, seconds: float) -> None:
+        """
+        Record a call of the stage that took the given time.
+        """
+        with self._lock:
+            if stage not in self.latencies:
+                self.latencies[stage] = Histogram(self.buckets)
+            self.latencies[stage].observe(seconds)
+
+    def count(self, stage: str, name: str, value: float = 1) -> None:
+        """
+        Add to a counter of the stage, e.g. datapoints or retries.
+        """
+        with self._lock:
+            counters = self.counters.setdefault(stage, {})
+            counters[name] = counters.get(name, 0) + value
+
+    def gauge(self, stage: str, name: str, value: float) -> None:
+        """
+        Set a gauge of the stage, e.g. a queue depth. The largest value set is kept as well.
+        """
+        with self._lock:
+            self.gauges.setdefault(stage, {})[name] = value
+            gauge_max = self.gauge_max.setdefault(stage, {})
+            gauge_max[name] = max(gauge_max.get(name, value), value)
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Calls, time spent, latency percentiles, counters and gauges per stage, and datapoints per second for stages
+        that count datapoints.
+        """
+        with self._lock:
+            stages: Dict[str, Dict[str, Any]] = {}
+            for stage in sorted(set(self.latencies) | set(self.counters) | set(self.gauges)):
+                entry: Dict[str, Any] = {}
+                histogram = self.latencies.get(stage)
+                if histogram is not None:
+                    entry.update(
+                        calls=histogram.count,
+                        seconds=round(histogram.sum, 3),
+                        p50_seconds=round(histogram.quantile(0.5), 3),
+                        p95_seconds=round(histogram.quantile(0.95), 3),
+                        max_seconds=round(histogram.max, 3),
+                    )
+                entry.update(self.counters.get(stage, {}))
+                if histogram is not None and histogram.sum > 0 and "datapoints" in entry:
+                    entry["datapoints_per_sec"] = round(entry["datapoints"] / histogram.sum, 1)
+                for name, value in self.gauges.get(stage, {}).items():
+                    entry[name] = value
+                    entry[f"{name}_max"] = self.gauge_max[stage][name]
+                stages[stage] = entry
+            return {"run_seconds": round(monotonic() - self.started, 3), "stages": stages}
+
+    def to_prometheus(self) -> str:
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        ns = self.namespace
+        with self._lock:
+            lines: List[str] = [f"# TYPE {ns}_run_seconds gauge", f"{ns}_run_seconds {monotonic() - self.started}"]
+            if self.latencies:
+                lines.append(f"# TYPE {ns}_stage_seconds histogram")
+            for stage, histogram in sorted(self.latencies.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'{ns}_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'{ns}_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'{ns}_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+            for name in sorted({name for counters in self.counters.values() for name in counters}):
+                lines.append(f"# TYPE {ns}_{name}_total counter")
+                for stage, counters in sorted(self.counters.items()):
+                    if name in counters:
+                        lines.append(f'{ns}_{name}_total{{stage="{stage}"}} {counters[name]}')
+            for name in sorted({name for gauges in self.gauges.values() for name in gauges}):
+                for suffix, values in (("", self.gauges), ("_max", self.gauge_max)):
+                    lines.append(f"# TYPE {ns}_{name}{suffix} gauge")
+                    for stage, gauges in sorted(values.items()):
+                        if name in gauges:
+                            lines.append(f'{ns}_{name}{suffix}{{stage="{stage}"}} {gauges[name]}')
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: str) -> None:
+        """
+        Write the metrics to a file for the node exporter textfile collector. The file is replaced atomically, so the
+        collector never reads a partly written file.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".metrics-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(self.to_prometheus())
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def push(self, gateway_url: str, job: str, timeout: float = 10.0) -> None:
+        """
+        Push the metrics to a Prometheus pushgateway, replacing the metrics last pushed for the job.
+        """
+        # Only imported when pushing, to keep it out of the cold start of the functions
+        import requests
+
+        response = requests.put(
+            f"{gateway_url.rstrip('/')}/metrics/job/{job}",
+            data=self.to_prometheus().encode("utf-8"),
+            headers={"Content-Type": "text/plain; version=0.0.4"},
+            timeout=timeout,
+        )
+        response.raise_for_status()
+
+    def export(
+        self, textfile: Optional[str] = None, pushgateway_url: Optional[str] = None, job: Optional[str] = None
+    ) -> None:
+        """
+        Write and push the metrics to the destinations given.
+        """
+        if textfile:
+            self.write_textfile(textfile)
+        if pushgateway_url:
+            self.push(pushgateway_url, job or self.namespace)
@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import sys
+from datetime import datetime
+from datetime import timezone
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import TYPE_CHECKING
+from typing import Union
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from arrow import Arrow
+
+MINUTE_MS = 60_000
+HOUR_MS = 3_600_000
+DAY_MS = 86_400_000
+
+# A half-open time range [start, end) in epoch milliseconds
+Span = Tuple[int, int]
+
+
+def to_ms(time: Union[Arrow, datetime, int, float]) -> int:
+    """
+    Epoch milliseconds of a time. Arrow and datetime objects are converted exactly, numbers are taken to be epoch
+    milliseconds already and rounded to whole ones.
+    """
+    # Not imported here to keep arrow out of the cold start, an Arrow object means the caller has imported it already
+    arrow = sys.modules.get("arrow")
+    if arrow is not None and isinstance(time, arrow.Arrow):
+        time = time.datetime
+    if isinstance(time, datetime):
+        if time.tzinfo is None:
+            time = time.replace(tzinfo=timezone.utc)
+        delta = time - datetime(1970, 1, 1, tzinfo=timezone.utc)
+        return (delta.days * 86_400 + delta.seconds) * 1000 + delta.microseconds // 1000
+    return int(round(time))
+
+
+def to_seconds(ms: int) -> float:
+    """
+    UNIX timestamp in seconds of epoch milliseconds, as taken by the Ice Cream Factory API.
+    """
+    return ms / 1000
+
+
+def isoformat(ms: int) -> str:
+    """
+    ISO 8601 representation in UTC of epoch milliseconds, for logging.
+    """
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc).isoformat()
+
+
+def floor_ms(ms: int, step: int = MINUTE_MS, anchor: int = 0) -> int:
+    """
+    Latest multiple of step after anchor at or before ms, e.g. the start of the minute ms is in.
+    """
+    return ms - (ms - anchor) % step
+
+
+def ceil_ms(ms: int, step: int = MINUTE_MS, anchor: int = 0) -> int:
+    """
+    Earliest multiple of step after anchor at or after ms.
+    """
+    return ms + (anchor - ms) % step
+
+
+def spans(start: int, end: int, step: int, anchor: Optional[int] = None) -> List[Span]:
+    """
+    Split [start, end) into consecutive half-open spans with boundaries at multiples of step after anchor. The first
+    and last span are cut off at start and end.
+
+    Args:
+        start: start of the range (ms, inclusive)
+        end: end of the range (ms, exclusive)
+        step: length of a whole span (ms)
+        anchor: time a span boundary falls on, the epoch by default (so day spans are UTC days). Pass start for spans
+            of exactly step counted from the start, or end for spans counted back from the end
+    """
+    if step <= 0:
+        raise ValueError(f"Span length must be positive, got {step}")
+    boundaries = np.arange(floor_ms(start, step, anchor or 0) + step, end, step, dtype=np.int64).tolist()
+    edges = [start] + boundaries + [end]
+    return [(edges[i], edges[i + 1]) for i in range(len(edges) - 1) if edges[i] < edges[i + 1]]
+
+
+def grid(start: int, end: int, step: int = MINUTE_MS) -> np.ndarray:
+    """
+    Timestamps (ms) of all multiples of step in [start, end), e.g. every whole minute of a window.
+    """
+    return np.arange(ceil_ms(start, step), end, step, dtype=np.int64)
+
+
+def window_slice(timestamps: np.ndarray, start: int, end: int) -> slice:
+    """
+    Slice of the ascending timestamps (ms) that are inside [start, end).
+    """
+    return slice(int(np.searchsorted(timestamps, start)), int(np.searchsorted(timestamps, end)))
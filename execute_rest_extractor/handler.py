@@ -4,24 +4,32 @@ import os
 
 from ice_cream_factory_datapoints_extractor import extractor
 
+# Function data keys and the environment variables overriding the extractor config they map to
+OVERRIDES = {
+    "frontfill_enabled": "FRONTFILL_ENABLED",
+    "frontfill_lookback_min": "FRONTFILL_LOOKBACK_MIN",
+    "frontfill_tailing": "FRONTFILL_TAILING",
+    "backfill_enabled": "BACKFILL_ENABLED",
+    "backfill_history_days": "BACKFILL_HISTORY_DAYS",
+    "backfill_gap_detection": "BACKFILL_GAP_DETECTION",
+    "async_client": "ASYNC_CLIENT",
+    "sites": "SITES",
+    "metrics_textfile": "METRICS_TEXTFILE",
+    "metrics_pushgateway_url": "METRICS_PUSHGATEWAY_URL",
+    "backfill_shift_now_ts_backwards_days": "BACKFILL_SHIFT_NOW_TS_BACKWARDS_DAYS",
+}
+
 
 def handle(secrets, data):
     print("running rest extractor.")
     if secrets:
         os.environ["COGNITE_CLIENT_ID"] = secrets.get("client-id")
         os.environ["COGNITE_CLIENT_SECRET"] = secrets.get("client-secret")
-    if data:
-        if data.get("frontfill_enabled"):
-            os.environ["FRONTFILL_ENABLED"] = data.get("frontfill_enabled")
-        if data.get("frontfill_lookback_min"):
-            os.environ["FRONTFILL_LOOKBACK_MIN"] = data.get("frontfill_lookback_min")
-        if data.get("backfill_enabled"):
-            os.environ["BACKFILL_ENABLED"] = data.get("backfill_enabled")
-        if data.get("backfill_history_days"):
-            os.environ["BACKFILL_HISTORY_DAYS"] = data.get("backfill_history_days")
-        if data.get("sites"):
-            os.environ["SITES"] = data.get("sites")
-        if data.get("backfill_shift_now_ts_backwards_days"):
-            os.environ["BACKFILL_SHIFT_NOW_TS_BACKWARDS_DAYS"] = data.get("backfill_shift_now_ts_backwards_days")
-    extractor.main()
+    # Overrides of an earlier invocation in the same (warm) process must not apply to this one
+    for key, env_var in OVERRIDES.items():
+        os.environ.pop(env_var, None)
+        if data and data.get(key):
+            os.environ[env_var] = data.get(key)
+    summary = extractor.main()
     print("running rest extractor done.")
+    return summary
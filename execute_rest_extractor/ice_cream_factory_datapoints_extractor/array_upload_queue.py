@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+from contextlib import nullcontext
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import arrow
+import numpy as np
+from cognite.extractorutils.uploader import DataPointList
+from cognite.extractorutils.uploader import MAX_DATAPOINT_VALUE
+from cognite.extractorutils.uploader import MIN_DATAPOINT_TIMESTAMP
+from cognite.extractorutils.uploader import MIN_DATAPOINT_VALUE
+from cognite.extractorutils.uploader import TIMESERIES_UPLOADER_POINTS_DISCARDED
+from cognite.extractorutils.uploader import TimeSeriesUploadQueue
+from cognite.extractorutils.util import EitherId
+
+from .dedupe import DatapointDeduplicator
+from common.metrics import Metrics
+
+# Timestamps (ms, int64) and values (float64) of a time series
+DatapointArrays = Tuple[np.ndarray, np.ndarray]
+
+
+class ArrayTimeSeriesUploadQueue(TimeSeriesUploadQueue):
+    """
+    Upload queue for numeric time series that keeps queued datapoints as NumPy arrays of timestamps and values.
+
+    Datapoints are only turned into the (timestamp, value) tuples the Cognite SDK posts right before they are sent, at
+    most max_upload_points at a time, so peak memory does not grow with the size of the queue. The post upload function
+    is given the earliest and latest datapoint of every uploaded time series, which is what a state store needs to
+    expand its watermarks.
+
+    Datapoints dropped by the deduplicator, e.g. ones already queued from an overlapping query, are never queued.
+    Datapoints of time series the upload drops, e.g. ones missing in CDF, are forgotten by the deduplicator again so
+    they are queued when queried again. If the upload fails, the datapoints stay queued for the next upload.
+
+    Args:
+        max_upload_points: upper bound for datapoints converted and posted in one request
+        deduplicator: filter for datapoints that do not need to be uploaded
+        metrics: where upload timings, datapoints, dropped duplicates and the queue depth are recorded, under the
+            "upload" stage
+        Other arguments are passed on to TimeSeriesUploadQueue
+    """
+
+    def __init__(
+        self,
+        *args,
+        max_upload_points: int = 100_000,
+        deduplicator: Optional[DatapointDeduplicator] = None,
+        metrics: Optional[Metrics] = None,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.max_upload_points = max_upload_points
+        self.deduplicator = deduplicator
+        self.metrics = metrics
+        self.points_deduplicated = 0
+        self.upload_queue: Dict[EitherId, List[DatapointArrays]] = {}
+
+    def add_to_upload_queue(self, *, id: int = None, external_id: str = None, datapoints: DataPointList = []) -> None:
+        """
+        Add (timestamp, value) datapoints to upload queue, see add_arrays_to_upload_queue.
+        """
+        datapoints_array = np.array(datapoints, dtype=np.float64).reshape(-1, 2)
+        self.add_arrays_to_upload_queue(
+            id=id,
+            external_id=external_id,
+            timestamps=np.rint(datapoints_array[:, 0]).astype(np.int64),
+            values=datapoints_array[:, 1],
+        )
+
+    def add_arrays_to_upload_queue(
+        self, *, id: int = None, external_id: str = None, timestamps: np.ndarray, values: np.ndarray
+    ) -> None:
+        """
+        Add datapoints to upload queue. The queue will be uploaded if the queue size is larger than the threshold
+        specified in the __init__.
+
+        Args:
+            id: Internal ID of time series. Either this or external_id must be set.
+            external_id: External ID of time series. Either this or external_id must be set.
+            timestamps: Timestamps in ms
+            values: Values, one per timestamp
+        """
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+
+        valid = (
+            (timestamps >= MIN_DATAPOINT_TIMESTAMP)
+            & np.isfinite(values)
+            & (values <= MAX_DATAPOINT_VALUE)
+            & (values >= MIN_DATAPOINT_VALUE)
+        )
+        if not valid.all():
+            discarded = int(len(valid) - np.count_nonzero(valid))
+            self.logger.warning(f"Discarding {discarded} datapoints due to bad timestamp or value")
+            TIMESERIES_UPLOADER_POINTS_DISCARDED.inc(discarded)
+            timestamps, values = timestamps[valid], values[valid]
+
+        if self.deduplicator is not None and external_id is not None:
+            keep = self.deduplicator.filter(external_id, timestamps)
+            deduplicated = int(len(keep) - np.count_nonzero(keep))
+            self.points_deduplicated += deduplicated
+            if self.metrics is not None and deduplicated:
+                self.metrics.count("upload", "duplicates_dropped", deduplicated)
+            timestamps, values = timestamps[keep], values[keep]
+
+        either_id = EitherId(id=id, external_id=external_id)
+
+        with self.lock:
+            if self.upload_queue_size == 0:
+                self.latency_zero_point = arrow.utcnow()
+
+            self.upload_queue.setdefault(either_id, []).append((timestamps, values))
+            self.points_queued.inc(len(timestamps))
+            self.latency.observe((arrow.utcnow() - self.latency_zero_point).total_seconds() / 60)
+            self.upload_queue_size += len(timestamps)
+            self.queue_size.set(self.upload_queue_size)
+            if self.metrics is not None:
+                self.metrics.gauge("upload", "queue_depth", self.upload_queue_size)
+
+            self._check_triggers()
+
+    def upload(self) -> None:
+        """
+        Trigger an upload of the queue, clears queue afterwards
+        """
+        if len(self.upload_queue) == 0:
+            return
+
+        with self.lock, self.metrics.time("upload") if self.metrics is not None else nullcontext():
+            uploaded_ids = set()
+            watermarks = {}
+            batch: List[Dict] = []
+            batch_size = 0
+            for either_id, arrays in self.upload_queue.items():
+                timestamps = np.concatenate([a[0] for a in arrays])
+                values = np.concatenate([a[1] for a in arrays])
+                if len(timestamps) == 0:
+                    continue
+                self.points_written.inc(len(timestamps))
+                first, last = int(np.argmin(timestamps)), int(np.argmax(timestamps))
+                watermarks[either_id] = [(int(timestamps[i]), float(values[i])) for i in (first, last)]
+
+                for start in range(0, len(timestamps), self.max_upload_points):
+                    stop = min(start + self.max_upload_points, len(timestamps))
+                    if batch_size + stop - start > self.max_upload_points:
+                        uploaded_ids.update(self._upload_arrays_batch(batch))
+                        batch, batch_size = [], 0
+                    datapoints = list(zip(timestamps[start:stop].tolist(), values[start:stop].tolist()))
+                    batch.append({either_id.type(): either_id.content(), "datapoints": datapoints})
+                    batch_size += len(datapoints)
+            uploaded_ids.update(self._upload_arrays_batch(batch))
+
+            try:
+                self._post_upload(
+                    [
+                        {either_id.type(): either_id.content(), "datapoints": datapoints}
+                        for either_id, datapoints in watermarks.items()
+                        if either_id in uploaded_ids
+                    ]
+                )
+            except Exception as e:
+                self.logger.error("Error in upload callback: %s", str(e))
+
+            if self.deduplicator is not None:
+                for either_id, arrays in self.upload_queue.items():
+                    if either_id not in uploaded_ids and either_id.external_id is not None:
+                        self.deduplicator.forget(either_id.external_id, np.concatenate([a[0] for a in arrays]))
+
+            self.upload_queue.clear()
+            self.logger.info(f"Uploaded {self.upload_queue_size} datapoints")
+            if self.metrics is not None:
+                self.metrics.count("upload", "datapoints", self.upload_queue_size)
+                self.metrics.gauge("upload", "queue_depth", 0)
+            self.upload_queue_size = 0
+            self.queue_size.set(self.upload_queue_size)
+
+    def _upload_arrays_batch(self, batch: List[Dict]) -> List[EitherId]:
+        uploaded = self._upload_batch(batch)
+        return [EitherId(id=entry.get("id"), external_id=entry.get("externalId")) for entry in uploaded]
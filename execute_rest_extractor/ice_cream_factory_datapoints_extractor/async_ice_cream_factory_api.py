@@ -0,0 +1,240 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from contextlib import nullcontext
+from time import monotonic
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+import aiohttp
+import ujson as ujson
+
+from .array_upload_queue import DatapointArrays
+from .config import ApiConfig
+from .ice_cream_factory_api import count_datapoints
+from .ice_cream_factory_api import decode_datapoints
+from .ice_cream_factory_api import merge_datapoints
+from .transport import backoff_seconds
+from .transport import CircuitBreaker
+from .transport import retry_after_seconds
+from .transport import RETRY_STATUS_CODES
+from common.metrics import Metrics
+
+
+class AsyncIceCreamFactoryAPI:
+    """
+    asyncio client for the datapoints endpoints of the Ice Cream Factory API. Requests share one pool of keep-alive
+    connections, and a semaphore bounds how many are in flight, so hundreds of queries can be outstanding from a single
+    thread. Use as an async context manager to open and close the connection pool.
+
+    Retries, timeouts, the circuit breaker and metrics behave as for IceCreamFactoryAPI.
+
+    Args:
+        base_url: url of the API
+        max_concurrent_requests: upper bound for requests in flight
+        multi_series_requests: whether the datapoints endpoint accepts several external ids in one request
+        keepalive_timeout: seconds an idle connection is kept open for reuse
+        retries: retries per request on connection errors, timeouts, throttling and transient server errors
+        backoff_factor: initial backoff in seconds, doubled for every retry
+        max_backoff: upper bound for the backoff in seconds
+        retry_deadline: seconds after the first failure of a request after which it is not retried, no limit if None
+        timeout: connect and read timeout in seconds
+        circuit_breaker: circuit breaker shared by all requests, none by default
+        metrics: where request and decoding timings, retries, errors and datapoints are recorded
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        max_concurrent_requests: int = 100,
+        multi_series_requests: bool = False,
+        keepalive_timeout: float = 30.0,
+        retries: int = 5,
+        backoff_factor: float = 0.5,
+        max_backoff: float = 30.0,
+        retry_deadline: Optional[float] = 60.0,
+        timeout: Tuple[float, float] = (5.0, 40.0),
+        circuit_breaker: Optional[CircuitBreaker] = None,
+        metrics: Optional[Metrics] = None,
+    ):
+        self.base_url = base_url
+        self.max_concurrent_requests = max_concurrent_requests
+        self.multi_series_requests = multi_series_requests
+        self.keepalive_timeout = keepalive_timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.retry_deadline = retry_deadline
+        self.timeout = aiohttp.ClientTimeout(connect=timeout[0], sock_read=timeout[1])
+        self.circuit_breaker = circuit_breaker
+        self.metrics = metrics
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._owns_session = False
+        self._request_slots: Optional[asyncio.Semaphore] = None
+
+    @classmethod
+    def from_config(cls, config: ApiConfig, metrics: Optional[Metrics] = None) -> AsyncIceCreamFactoryAPI:
+        """
+        Create a client from the api section of the extractor config.
+        """
+        return cls(
+            base_url=config.url,
+            max_concurrent_requests=config.async_max_concurrent_requests,
+            multi_series_requests=config.multi_series_requests,
+            retries=config.retries,
+            backoff_factor=config.backoff_factor,
+            max_backoff=config.max_backoff_sec,
+            retry_deadline=config.retry_deadline_sec,
+            timeout=(config.connect_timeout_sec, config.read_timeout_sec),
+            circuit_breaker=CircuitBreaker(config.circuit_breaker_threshold, config.circuit_breaker_reset_sec),
+            metrics=metrics,
+        )
+
+    async def __aenter__(self) -> AsyncIceCreamFactoryAPI:
+        if self.session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_concurrent_requests, keepalive_timeout=self.keepalive_timeout
+            )
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self._owns_session = True
+        # Created here so the semaphore belongs to the running event loop
+        self._request_slots = asyncio.Semaphore(self.max_concurrent_requests)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        if self._owns_session:
+            await self.session.close()
+            self.session = None
+            self._owns_session = False
+
+    async def get_content(self, url_suffix: str, params: List[Tuple[str, Union[str, int, float]]]) -> bytes:
+        """
+        Get the body of a response from the API.
+
+        Args:
+            url_suffix: string to add to base url
+            params: query parameters, repeated keys allowed
+        """
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.check()
+        try:
+            with self.metrics.time("factory_api") if self.metrics is not None else nullcontext():
+                content = await self._get_content(url_suffix, params)
+        except aiohttp.ClientResponseError as e:
+            self._record(success=e.status not in RETRY_STATUS_CODES)
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self._record(success=False)
+            raise
+        self._record(success=True)
+        return content
+
+    def _record(self, success: bool) -> None:
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record(success=success)
+        if self.metrics is not None:
+            self.metrics.count("factory_api", "requests")
+            if not success:
+                self.metrics.count("factory_api", "errors")
+
+    async def _get_content(self, url_suffix: str, params: List[Tuple[str, Union[str, int, float]]]) -> bytes:
+        retry_until = None
+        for attempt in range(self.retries + 1):
+            # The last attempt raises on failure, as does the first attempt after the deadline
+            last = attempt == self.retries or (retry_until is not None and monotonic() >= retry_until)
+            retry_after = None
+            try:
+                async with self._request_slots:
+                    async with self.session.get(f"{self.base_url}/{url_suffix}", params=params) as response:
+                        if response.status not in RETRY_STATUS_CODES or last:
+                            response.raise_for_status()
+                            return await response.read()
+                        retry_after = retry_after_seconds(response.headers.get("Retry-After"))
+                        logging.warning(f"{url_suffix} returned {response.status}, retry {attempt + 1}/{self.retries}")
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if last:
+                    raise
+                logging.warning(f"{url_suffix} failed ({e!r}), retry {attempt + 1}/{self.retries}")
+            if self.metrics is not None:
+                self.metrics.count("factory_api", "retries")
+            if retry_until is None and self.retry_deadline is not None:
+                retry_until = monotonic() + self.retry_deadline
+            wait = (
+                retry_after
+                if retry_after is not None
+                else backoff_seconds(attempt, self.backoff_factor, self.max_backoff)
+            )
+            # Wait outside the request slot, so other requests can go ahead
+            await asyncio.sleep(wait if retry_until is None else min(wait, max(0.0, retry_until - monotonic())))
+
+    async def get_oee_timeseries_datapoints(
+        self,
+        timeseries_ext_id: Union[str, List[str]],
+        start: Union[int, float],
+        end: Union[int, float],
+        arrays: bool = False,
+    ) -> Dict[str, Union[List[Tuple[float, float]], DatapointArrays]]:
+        """
+        Get datapoints for one or, if the API supports it, several timeseries external ids. Associated timeseries are
+        returned as well, see IceCreamFactoryAPI.get_oee_timeseries_datapoints.
+
+        Args:
+            timeseries_ext_id: external id(s) of timeseries to get datapoints for
+            start: start for datapoints (UNIX timestamp)
+            end: end for datapoints (UNIX timestamp)
+            arrays: return timestamp (ms) and value arrays per timeseries instead of lists of (timestamp, value) tuples
+        """
+        ext_ids = [timeseries_ext_id] if isinstance(timeseries_ext_id, str) else timeseries_ext_id
+        params = [("start", start), ("end", end)] + [("external_id", ext_id) for ext_id in ext_ids]
+        content = await self.get_content("datapoints/oee", params)
+        with self.metrics.time("decode") if self.metrics is not None else nullcontext():
+            if arrays:
+                datapoints = decode_datapoints(content)
+            else:
+                # convert timestamp to ms (*1000) for CDF uploads
+                datapoints = {
+                    timeseries: [(dp[0] * 1000, dp[1]) for dp in ts_datapoints]
+                    for timeseries, ts_datapoints in ujson.loads(content).items()
+                }
+
+        if self.metrics is not None:
+            self.metrics.count("decode", "datapoints", count_datapoints(datapoints))
+        return datapoints
+
+    async def get_oee_timeseries_datapoints_multi(
+        self, queries: List[Tuple[str, Union[int, float], Union[int, float]]], arrays: bool = False
+    ) -> Dict[str, Union[List[Tuple[float, float]], DatapointArrays]]:
+        """
+        Get datapoints for many (external id, start, end) queries concurrently, see
+        IceCreamFactoryAPI.get_oee_timeseries_datapoints_multi.
+
+        Args:
+            queries: external id, start and end of every query
+            arrays: return timestamp (ms) and value arrays per timeseries instead of lists of (timestamp, value) tuples
+
+        Returns:
+            Datapoints of all requested and associated timeseries, merged per external id
+        """
+        if self.multi_series_requests:
+            windows: Dict[Tuple, List[str]] = {}
+            for ext_id, start, end in queries:
+                windows.setdefault((start, end), []).append(ext_id)
+            requests = [(ext_ids, start, end) for (start, end), ext_ids in windows.items()]
+        else:
+            requests = list(queries)
+
+        datapoints_dicts = await asyncio.gather(
+            *(self.get_oee_timeseries_datapoints(*request, arrays) for request in requests)
+        )
+        if arrays:
+            return merge_datapoints(datapoints_dicts)
+
+        merged: Dict[str, List[Tuple[float, float]]] = {}
+        for datapoints_dict in datapoints_dicts:
+            for ext_id, datapoints in datapoints_dict.items():
+                merged.setdefault(ext_id, []).extend(datapoints)
+        return merged
@@ -1,37 +1,86 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
+from typing import Dict
 from typing import List
+from typing import Optional
+from typing import Tuple
 
+from cognite.client import CogniteClient
 from cognite.extractorutils.configtools import BaseConfig
+from cognite.extractorutils.configtools import CogniteConfig
 from cognite.extractorutils.configtools import RawStateStoreConfig
-from cognite.extractorutils.configtools import StateStoreConfig
+
+from .state_store import BatchedStateStoreConfig
+
+# Cognite clients created in this process, keyed by client name and CDF config
+_COGNITE_CLIENTS: Dict[Tuple[str, str], CogniteClient] = {}
+
+
+@dataclass
+class ReusableCogniteConfig(CogniteConfig):
+    def get_cognite_client(
+        self, client_name: str, token_custom_args: Optional[Dict[str, str]] = None, use_experimental_sdk=False
+    ) -> CogniteClient:
+        """
+        Cognite client for this config, reused by later runs in the same process (e.g. warm Cognite Function
+        invocations) so they keep its token and open connections.
+        """
+        key = (client_name, repr((self, token_custom_args, use_experimental_sdk)))
+        if key not in _COGNITE_CLIENTS:
+            _COGNITE_CLIENTS[key] = super().get_cognite_client(client_name, token_custom_args, use_experimental_sdk)
+        return _COGNITE_CLIENTS[key]
 
 
 @dataclass
 class ApiConfig:
     url: str
     sites: List[str]
+    max_concurrent_requests: int = 8  # Upper bound for requests in flight towards the API from all workers
+    multi_series_requests: bool = False  # Request datapoints for several external ids in one call to the API
+    async_client: bool = False  # Query the API from one event loop instead of a thread pool
+    async_max_concurrent_requests: int = 100  # Upper bound for requests in flight when async-client is enabled
+    pool_size: Optional[int] = None  # Connections kept open to the API, defaults to max-concurrent-requests
+    retries: int = 5  # Retries per request on connection errors, throttling (429) and transient server errors (5xx)
+    backoff_factor: float = 0.5  # Initial backoff in seconds, doubled for every retry and randomized. Retry-After wins
+    max_backoff_sec: float = 30.0
+    # Seconds after the first failure of a request after which it is not retried. A request takes at most this plus
+    # two attempts (connect and read timeout), which has to fit the run time of the function
+    retry_deadline_sec: Optional[float] = 60.0
+    connect_timeout_sec: float = 5.0
+    read_timeout_sec: float = 40.0
+    circuit_breaker_threshold: int = 5  # Consecutive failed requests before requests fail fast
+    circuit_breaker_reset_sec: float = 30.0  # Seconds requests fail fast before the API is tried again
 
 
 @dataclass
 class ExtractorConfig:
-    state_store: StateStoreConfig = StateStoreConfig(
+    state_store: BatchedStateStoreConfig = BatchedStateStoreConfig(
         local=None,
         raw=RawStateStoreConfig(
             database="src:002:opcua:db:state", table="timeseries_datapoints_states", upload_interval=5
         ),
+        watermark_table="timeseries_datapoints_watermark",
     )
 
     create_assets: bool = False
     upload_interval: int = 5  # Automatically trigger an upload each m seconds when run as a thread
     parallelism: int = 2
+    dedupe: bool = True  # Drop datapoints already queued for upload during this run, always on with frontfill tailing
+    dedupe_watermarks: bool = False  # Also drop datapoints inside the state store watermarks, see DatapointDeduplicator
+    metadata_snapshot: bool = True  # Skip syncing time series metadata to CDF while the catalog is unchanged
+    metadata_snapshot_table: str = "timeseries_datapoints_metadata"  # RAW table in the state store database
+    metadata_max_age_hours: float = 24  # Sync time series metadata to CDF at least this often
+    metrics_textfile: Optional[str] = None  # Write run metrics here in the Prometheus text format
+    metrics_pushgateway_url: Optional[str] = None  # Push run metrics to this Prometheus pushgateway
 
 
 @dataclass
 class BackFillConfig:
     enabled: bool
     history_days: int
+    gap_detection: bool = False  # Only query the API for hours with missing datapoints in CDF
+    expected_interval_sec: int = 60  # Expected spacing of datapoints, used to tell complete hours from gaps
 
 
 @dataclass
@@ -39,10 +88,13 @@ class FrontFillConfig:
     enabled: bool
     continuous: bool
     lookback_min: float
+    tailing: bool = False  # Start from the latest datapoint of each time series instead of the full lookback window
+    late_data_margin_min: float = 5  # Minutes before the latest datapoint queried again when tailing, for late data
 
 
 @dataclass
 class IceCreamFactoryConfig(BaseConfig):
+    cognite: ReusableCogniteConfig
     api: ApiConfig
     backfill: BackFillConfig
     frontfill: FrontFillConfig
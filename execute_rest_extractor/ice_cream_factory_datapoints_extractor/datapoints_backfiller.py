@@ -1,19 +1,33 @@
 from __future__ import annotations
 
+import asyncio
 import logging
 import os
 from threading import Event
+from typing import Any
+from typing import Dict
+from typing import Iterator
 from typing import List
+from typing import Optional
 from typing import Set
+from typing import Tuple
 
 import arrow
+from cognite.client import CogniteClient
 from cognite.client.data_classes import TimeSeries
 from cognite.extractorutils.statestore import AbstractStateStore
-from cognite.extractorutils.uploader import TimeSeriesUploadQueue
-from retry import retry
 
+from .array_upload_queue import ArrayTimeSeriesUploadQueue
 from .config import IceCreamFactoryConfig
 from .ice_cream_factory_api import IceCreamFactoryAPI
+from common.timegrid import DAY_MS
+from common.timegrid import floor_ms
+from common.timegrid import HOUR_MS
+from common.timegrid import isoformat
+from common.timegrid import Span
+from common.timegrid import spans
+from common.timegrid import to_ms
+from common.timegrid import to_seconds
 
 
 class Backfiller:
@@ -28,16 +42,18 @@ class Backfiller:
         time_series: List of timeseries to query datapoints for and back fill
         config: Set of configuration parameters
         states: Current state of time series in CDF
+        cognite: Cognite client used to find gaps in CDF. The full time frame is queried from the API when not given
     """
 
     def __init__(
         self,
-        upload_queue: TimeSeriesUploadQueue,
+        upload_queue: ArrayTimeSeriesUploadQueue,
         stop: Event,
         api: IceCreamFactoryAPI,
         timeseries_list: List[TimeSeries],
         config: IceCreamFactoryConfig,
         states: AbstractStateStore,
+        cognite: Optional[CogniteClient] = None,
     ):
         # Target iteration time to allow some throttling between iterations
         self.target_iteration_time = 2 * len(timeseries_list)
@@ -48,62 +64,163 @@ class Backfiller:
         self.logger = logging.getLogger(__name__)
         self.timeseries_list = timeseries_list
         self.states = states
-        self.stop_at = arrow.utcnow().shift(days=-config.backfill.history_days)
-        self.now_ts = arrow.utcnow()
-        self.timeseries_seen_set: Set[str] = set()
-
+        self.cognite = cognite
+        # Time frame to backfill (ms)
+        self.now_ts = to_ms(arrow.utcnow())
         if os.getenv("BACKFILL_SHIFT_NOW_TS_BACKWARDS_DAYS"):
-            self.now_ts = arrow.utcnow().shift(days=-int(os.getenv("BACKFILL_SHIFT_NOW_TS_BACKWARDS_DAYS")))
-            self.stop_at = self.now_ts.shift(days=-config.backfill.history_days)
+            self.now_ts -= int(os.getenv("BACKFILL_SHIFT_NOW_TS_BACKWARDS_DAYS")) * DAY_MS
+        self.stop_at = self.now_ts - int(config.backfill.history_days * DAY_MS)
+        self.timeseries_seen_set: Set[str] = set()
 
-    @retry(tries=10)
-    def _extract_time_series(self, timeseries: TimeSeries) -> None:
+    def time_ranges(self, timeseries: TimeSeries, state: Optional[Tuple[Any, Any]] = None) -> List[Span]:
         """
-        Perform a query for a given time series. Function to send to thread pool in run().
+        Time ranges (ms) to backfill for a time series, from its low and high watermarks to the configured limits.
 
         Args:
             timeseries: timeseries to get datapoints for
+            state: (low, high) watermarks of the time series, looked up in the state store when not given
         """
-        low, high = self.states.get_state(timeseries.external_id)
-        if not low:
-            low = self.now_ts.float_timestamp
-        if not high:
-            high = self.now_ts.float_timestamp
+        low, high = state if state is not None else self.states.get_state(timeseries.external_id)
+        # Watermarks are CDF timestamps (ms)
+        low = to_ms(low) if low else self.now_ts
+        high = to_ms(high) if high else self.now_ts
 
-        earliest_start = min(low, self.stop_at.float_timestamp)
-        latest_start = max(low, self.stop_at.float_timestamp)
-        earliest_end = min(high, self.now_ts.float_timestamp)
-        latest_end = max(high, self.now_ts.float_timestamp)
+        return [
+            (min(low, self.stop_at), max(low, self.stop_at)),
+            (min(high, self.now_ts), max(high, self.now_ts)),
+        ]
 
-        self.process(timeseries, arrow.get(earliest_start, tzinfo="UTC"), arrow.get(latest_start, tzinfo="UTC"))
-        self.process(timeseries, arrow.get(earliest_end, tzinfo="UTC"), arrow.get(latest_end, tzinfo="UTC"))
-        logging.info(f"{timeseries.external_id} reached configured limit at {arrow.get(latest_end, tzinfo='UTC')}")
+    def slices(self, start: int, end: int) -> Iterator[Span]:
+        """
+        Split a time range (ms) into the largest ranges the API can be queried for at once, newest first.
+        """
+        single_query_lookback = int(min(2, self.config.backfill.history_days) * DAY_MS)
+        if end > start:
+            yield from reversed(spans(start, end, single_query_lookback, anchor=end))
 
-    def process(self, timeseries, start, end):
-        logging.info(f"Getting historical data {timeseries.external_id} from {start} to {end}")
-        single_query_lookback = -min(2, self.config.backfill.history_days)
-        while end > start and not self.stop.is_set():
+    def plan(self) -> List[Tuple[TimeSeries, int, int]]:
+        """
+        All (timeseries, start, end) API queries needed to backfill the time series, newest data first. With gap
+        detection enabled, only the ranges missing in CDF are included.
+        """
+        if self.cognite is not None and self.config.backfill.gap_detection:
+            ranges = self.find_gaps(self.timeseries_list)
+        else:
+            states = self.states.get_state([ts.external_id for ts in self.timeseries_list])
+            ranges = {ts.external_id: self.time_ranges(ts, state) for ts, state in zip(self.timeseries_list, states)}
+
+        work = [
+            (ts, from_time, to_time)
+            for ts in self.timeseries_list
+            for start, end in ranges[ts.external_id]
+            for from_time, to_time in self.slices(start, end)
+        ]
+        return sorted(work, key=lambda item: item[2], reverse=True)
+
+    def extract_slice(self, timeseries: TimeSeries, start: int, end: int) -> None:
+        """
+        Query the API for one slice of a time series and queue the datapoints for upload. Function to send to thread
+        pool, one call per item of plan().
 
-            from_time = end.shift(days=single_query_lookback)  # can query API for only 10 min of data
+        Args:
+            timeseries: timeseries to get datapoints for
+            start: start of the slice (ms)
+            end: end of the slice (ms)
+        """
+        if self.stop.is_set():
+            return
+
+        logging.info(f"\t{timeseries.external_id} from {isoformat(start)} to {isoformat(end)}")
 
-            logging.info(f"\t{timeseries.external_id} from {from_time.isoformat()} to {end.isoformat()}")
+        datapoints_dict = self.api.get_oee_timeseries_datapoints(
+            timeseries_ext_id=timeseries.external_id, start=to_seconds(start), end=to_seconds(end), arrays=True
+        )
 
-            datapoints_dict = self.api.get_oee_timeseries_datapoints(
-                timeseries_ext_id=timeseries.external_id, start=from_time.timestamp(), end=end.timestamp()
+        for timeseries_ext_id, (timestamps, values) in datapoints_dict.items():
+            # API returns 2 associated timeseries.
+            self.upload_queue.add_arrays_to_upload_queue(
+                external_id=timeseries_ext_id, timestamps=timestamps, values=values
             )
 
-            for timeseries_ext_id in datapoints_dict:
-                # API returns 2 associated timeseries.
-                self.upload_queue.add_to_upload_queue(
-                    external_id=timeseries_ext_id, datapoints=datapoints_dict[timeseries_ext_id]
-                )
+    def find_gaps(self, timeseries_list: List[TimeSeries]) -> Dict[str, List[Span]]:
+        """
+        Find the hours between the backfill limit and now where CDF holds fewer datapoints than expected.
+
+        Time series without a state in the state store have never been extracted, so their whole time frame is a gap
+        and CDF is not queried for them.
 
-            end = from_time
+        Args:
+            timeseries_list: timeseries to find gaps for
+
+        Returns:
+            Time ranges (ms) to backfill per external id
+        """
+        gaps = {ts.external_id: [(self.stop_at, self.now_ts)] for ts in timeseries_list}
+
+        states = self.states.get_state([ts.external_id for ts in timeseries_list])
+        known_ext_ids = [ts.external_id for ts, (low, high) in zip(timeseries_list, states) if high]
+        if not known_ext_ids:
+            return gaps
+
+        hours = spans(self.stop_at, self.now_ts, HOUR_MS)
+        counts_list = self.cognite.time_series.data.retrieve(
+            external_id=known_ext_ids,
+            start=floor_ms(self.stop_at, HOUR_MS),
+            end=floor_ms(self.now_ts, HOUR_MS) + HOUR_MS,
+            aggregates=["count"],
+            granularity="1h",
+            ignore_unknown_ids=True,
+        )
+        counts_by_ext_id = {dps.external_id: dict(zip(dps.timestamp, dps.count)) for dps in counts_list}
+
+        for ext_id in known_ext_ids:
+            counts = counts_by_ext_id.get(ext_id, {})
+            ranges: List[Span] = []
+            # The first and last hour are only partly inside the time frame
+            for hour_start, hour_end in hours:
+                expected_count = (hour_end - hour_start) / 1000 // self.config.backfill.expected_interval_sec
+                if counts.get(floor_ms(hour_start, HOUR_MS), 0) >= expected_count:
+                    continue
+                if ranges and ranges[-1][1] >= hour_start:
+                    ranges[-1] = (ranges[-1][0], hour_end)
+                else:
+                    ranges.append((hour_start, hour_end))
+            gaps[ext_id] = ranges
+        return gaps
 
     def run(self) -> None:
         """
         Run backfiller until the low watermark has reached the configured backfill-min limit, or until the stop event is
         set.
         """
-        for ts in self.timeseries_list:
-            self._extract_time_series(ts)
+        for item in self.plan():
+            self.extract_slice(*item)
+
+
+class AsyncBackfiller(Backfiller):
+    """
+    Backfiller for an AsyncIceCreamFactoryAPI. All slices of plan() are queried concurrently, bounded by the request
+    limit of the API client.
+    """
+
+    async def extract_slice(self, timeseries: TimeSeries, start: int, end: int) -> None:
+        if self.stop.is_set():
+            return
+
+        logging.info(f"\t{timeseries.external_id} from {isoformat(start)} to {isoformat(end)}")
+
+        datapoints_dict = await self.api.get_oee_timeseries_datapoints(
+            timeseries_ext_id=timeseries.external_id, start=to_seconds(start), end=to_seconds(end), arrays=True
+        )
+
+        for timeseries_ext_id, (timestamps, values) in datapoints_dict.items():
+            # API returns 2 associated timeseries.
+            self.upload_queue.add_arrays_to_upload_queue(
+                external_id=timeseries_ext_id, timestamps=timestamps, values=values
+            )
+
+    async def run(self) -> None:
+        """
+        Run backfiller until all slices are extracted, or until the stop event is set.
+        """
+        await asyncio.gather(*(self.extract_slice(*item) for item in self.plan()))
@@ -1,18 +1,26 @@
 from __future__ import annotations
 
+import asyncio
 import logging
 from threading import Event
+from typing import Dict
 from typing import List
 from typing import Set
+from typing import Tuple
 
 import arrow
 from cognite.client.data_classes import TimeSeries
 from cognite.extractorutils.statestore import AbstractStateStore
-from cognite.extractorutils.uploader import TimeSeriesUploadQueue
-from retry import retry
 
+from .array_upload_queue import ArrayTimeSeriesUploadQueue
+from .array_upload_queue import DatapointArrays
 from .config import IceCreamFactoryConfig
 from .ice_cream_factory_api import IceCreamFactoryAPI
+from common.timegrid import floor_ms
+from common.timegrid import MINUTE_MS
+from common.timegrid import spans
+from common.timegrid import to_ms
+from common.timegrid import to_seconds
 
 
 class Streamer:
@@ -25,11 +33,12 @@ class Streamer:
         api: API to query
         timeseries_list: List of timeseries to query datapoints for
         config: Set of configuration parameters
+        states: Current state of time series in CDF, used as starting point when tailing
     """
 
     def __init__(
         self,
-        upload_queue: TimeSeriesUploadQueue,
+        upload_queue: ArrayTimeSeriesUploadQueue,
         stop: Event,
         api: IceCreamFactoryAPI,
         timeseries_list: List[TimeSeries],
@@ -46,43 +55,108 @@ class Streamer:
 
         self.timeseries_list = timeseries_list
         self.timeseries_seen_set: Set[str] = set()
+        # Latest datapoint timestamp (ms) per external id
+        self.cursors: Dict[str, int] = {}
 
-    @retry(tries=10)
-    def _extract_timeseries(self, timeseries: TimeSeries) -> None:
+    def start_time(self, timeseries: TimeSeries, to_time: int) -> int:
         """
-        Perform a query for a given time series. Function to send to thread pool in run().
+        Where to start querying a time series. That is the start of the lookback window, or with tailing enabled the
+        latest datapoint seen for the time series minus the late data margin, bounded by the lookback window.
 
         Args:
             timeseries: timeseries to get datapoints for
+            to_time: end of the query (ms)
         """
-        logging.info(f"Getting live data for {timeseries.external_id}")
-        to_time = arrow.utcnow()
-        # lookup back for X minutes. Allows late data.
-        from_time = to_time.shift(minutes=-self.config.frontfill.lookback_min)
-        single_query_lookback = min(3600, self.config.frontfill.lookback_min)
-
-        while from_time < to_time:
-            req_time = min(to_time, from_time.shift(minutes=single_query_lookback))
-            datapoints_dict = self.api.get_oee_timeseries_datapoints(
-                timeseries_ext_id=timeseries.external_id, start=from_time.float_timestamp, end=req_time.float_timestamp
+        lookback_start = to_time - int(self.config.frontfill.lookback_min * MINUTE_MS)
+        if not self.config.frontfill.tailing:
+            return lookback_start
+
+        high = self.cursors.get(timeseries.external_id)
+        if high is None:
+            high = self.states.get_state(timeseries.external_id)[1]
+        if not high:
+            return lookback_start
+        # Floor to whole minutes so time series with similar watermarks share query windows
+        cursor = to_ms(high) - int(self.config.frontfill.late_data_margin_min * MINUTE_MS)
+        return max(lookback_start, floor_ms(cursor))
+
+    def queries(self, timeseries_list: List[TimeSeries]) -> List[Tuple[str, float, float]]:
+        """
+        API queries (external id, start, end) for the given time series, split into windows the API can be queried
+        for at once.
+
+        Args:
+            timeseries_list: timeseries to get datapoints for
+        """
+        to_time = to_ms(arrow.utcnow())
+        single_query_lookback = int(min(3600, self.config.frontfill.lookback_min) * MINUTE_MS)
+
+        queries = []
+        for timeseries in timeseries_list:
+            from_time = self.start_time(timeseries, to_time)
+            for start, end in spans(from_time, to_time, single_query_lookback, anchor=from_time):
+                queries.append((timeseries.external_id, to_seconds(start), to_seconds(end)))
+        return queries
+
+    def add_to_upload_queue(self, datapoints_dict: Dict[str, DatapointArrays]) -> None:
+        """
+        Queue datapoints for upload. With tailing enabled, the cursors are moved to the latest datapoint of every time
+        series. Datapoints queried again within the late data margin are dropped by the deduplicator of the queue.
+
+        Args:
+            datapoints_dict: timestamps (ms) and values per external id, as returned by the API
+        """
+        for timeseries_ext_id, (timestamps, values) in datapoints_dict.items():
+            if self.config.frontfill.tailing and len(timestamps):
+                latest = int(timestamps.max())
+                self.cursors[timeseries_ext_id] = max(self.cursors.get(timeseries_ext_id, latest), latest)
+
+            # API returns 2 associated timeseries.
+            self.upload_queue.add_arrays_to_upload_queue(
+                external_id=timeseries_ext_id, timestamps=timestamps, values=values
             )
 
-            for timeseries_ext_id in datapoints_dict:
-                # API returns 2 associated timeseries.
-                self.upload_queue.add_to_upload_queue(
-                    external_id=timeseries_ext_id, datapoints=datapoints_dict[timeseries_ext_id]
-                )
+    def _extract_timeseries(self, timeseries_list: List[TimeSeries]) -> None:
+        """
+        Perform the queries for the given time series, batched per time window. Function to send to thread pool in
+        run().
 
-            from_time = req_time
+        Args:
+            timeseries_list: timeseries to get datapoints for
+        """
+        logging.info(f"Getting live data for {len(timeseries_list)} time series")
+        queries = self.queries(timeseries_list)
+        self.add_to_upload_queue(self.api.get_oee_timeseries_datapoints_multi(queries, arrays=True))
 
     def run(self) -> None:
         """
         Run streamer until the stop event is set.
         """
         while True:
-            for ts in self.timeseries_list:
-                self._extract_timeseries(ts)
-            if not (
-                self.config.frontfill.continuous and self.stop.wait(60.0 * self.config.frontfill.lookback_min / 6.0)
+            self._extract_timeseries(self.timeseries_list)
+            # Event.wait returns True once the stop event is set, and False when it timed out
+            if not self.config.frontfill.continuous or self.stop.wait(60.0 * self.config.frontfill.lookback_min / 6.0):
+                break
+
+
+class AsyncStreamer(Streamer):
+    """
+    Streamer for an AsyncIceCreamFactoryAPI, run as a task on an event loop instead of a thread.
+    """
+
+    async def _extract_timeseries(self, timeseries_list: List[TimeSeries]) -> None:
+        logging.info(f"Getting live data for {len(timeseries_list)} time series")
+        queries = self.queries(timeseries_list)
+        self.add_to_upload_queue(await self.api.get_oee_timeseries_datapoints_multi(queries, arrays=True))
+
+    async def run(self) -> None:
+        """
+        Run streamer until the stop event is set.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._extract_timeseries(self.timeseries_list)
+            if not self.config.frontfill.continuous or await loop.run_in_executor(
+                None, self.stop.wait, 60.0 * self.config.frontfill.lookback_min / 6.0
             ):
                 break
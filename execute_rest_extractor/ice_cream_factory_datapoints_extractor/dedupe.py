@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+from threading import Lock
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+from cognite.extractorutils.statestore import AbstractStateStore
+
+# First timestamp, last timestamp and spacing (ms) of a run of evenly spaced timestamps
+Run = Tuple[int, int, int]
+
+
+class TimestampRuns:
+    """
+    Set of timestamps stored as runs of evenly spaced timestamps, so a regularly sampled time series takes the same
+    memory whether it holds an hour or a month of datapoints.
+
+    At most max_runs runs are kept, the oldest ones are forgotten first, except runs ending within keep_ms of the
+    latest timestamp. Forgetting timestamps only means they are not recognized as seen, never that unseen timestamps
+    are.
+
+    Args:
+        max_runs: upper bound for runs kept outside the keep window
+        keep_ms: length of the window before the latest timestamp that is never forgotten (ms)
+    """
+
+    def __init__(self, max_runs: int = 1000, keep_ms: int = 0):
+        self.max_runs = max_runs
+        self.keep_ms = keep_ms
+        self.runs: List[Run] = []
+        self._starts = np.empty(0, dtype=np.int64)
+        self._ends = np.empty(0, dtype=np.int64)
+        self._steps = np.empty(0, dtype=np.int64)
+
+    def contains(self, timestamps: np.ndarray) -> np.ndarray:
+        """
+        Boolean mask of the timestamps that are in the set.
+        """
+        if not self.runs or len(timestamps) == 0:
+            return np.zeros(len(timestamps), dtype=bool)
+        idx = np.searchsorted(self._starts, timestamps, side="right") - 1
+        found = idx >= 0
+        idx = np.maximum(idx, 0)
+        offset = timestamps - self._starts[idx]
+        return found & (timestamps <= self._ends[idx]) & (offset % self._steps[idx] == 0)
+
+    def add(self, timestamps: np.ndarray) -> None:
+        """
+        Add timestamps to the set.
+        """
+        timestamps = np.unique(timestamps)
+        if len(timestamps) == 0:
+            return
+        if len(timestamps) == 1:
+            new_runs = [(int(timestamps[0]), int(timestamps[0]), 1)]
+        else:
+            steps = np.diff(timestamps)
+            # Split where the spacing changes, neighbouring runs share their boundary timestamp
+            bounds = np.concatenate([[0], np.flatnonzero(steps[1:] != steps[:-1]) + 1, [len(steps)]])
+            new_runs = [
+                (int(timestamps[i]), int(timestamps[j]), int(steps[i])) for i, j in zip(bounds[:-1], bounds[1:])
+            ]
+        self._set_runs(self._evict(self._merge(sorted(self.runs + new_runs))))
+
+    def remove(self, timestamps: np.ndarray) -> None:
+        """
+        Remove timestamps from the set, e.g. ones that turned out not to be uploaded after all.
+        """
+        timestamps = np.unique(timestamps)
+        if not self.runs or len(timestamps) == 0:
+            return
+        hit = (self._starts <= timestamps[-1]) & (self._ends >= timestamps[0])
+        if not hit.any():
+            return
+        # Runs that may hold any of the timestamps are expanded and added again without them
+        expanded = np.concatenate(
+            [np.arange(start, end + 1, step, dtype=np.int64) for (start, end, step), h in zip(self.runs, hit) if h]
+        )
+        self._set_runs([run for run, h in zip(self.runs, hit) if not h])
+        self.add(np.setdiff1d(expanded, timestamps))
+
+    def _evict(self, runs: List[Run]) -> List[Run]:
+        excess = len(runs) - self.max_runs
+        if excess <= 0:
+            return runs
+        recent = max(run[1] for run in runs) - self.keep_ms
+        return [run for i, run in enumerate(runs) if i >= excess or run[1] >= recent]
+
+    def _set_runs(self, runs: List[Run]) -> None:
+        self.runs = runs
+        self._starts = np.array([r[0] for r in self.runs], dtype=np.int64)
+        self._ends = np.array([r[1] for r in self.runs], dtype=np.int64)
+        self._steps = np.array([r[2] for r in self.runs], dtype=np.int64)
+
+    @staticmethod
+    def _merge(runs: List[Run]) -> List[Run]:
+        merged: List[Run] = []
+        for start, end, step in runs:
+            if merged:
+                last_start, last_end, last_step = merged[-1]
+                on_grid = (start - last_start) % last_step == 0 and step % last_step == 0
+                if on_grid and step == last_step and start <= last_end + step:
+                    merged[-1] = (last_start, max(last_end, end), step)
+                    continue
+                if on_grid and end <= last_end:
+                    # Every timestamp of the run is in the last run already
+                    continue
+            merged.append((start, end, step))
+        return merged
+
+
+class DatapointDeduplicator:
+    """
+    Drops datapoints that were already queued for upload during this run, and optionally datapoints inside the low and
+    high watermarks of the state store.
+
+    Datapoints inside the watermarks are not necessarily in CDF: gap filling backfills and late datapoints are inside
+    them too. Only enable skip_watermarks when neither is used.
+
+    Args:
+        states: state store with watermarks to skip datapoints inside of
+        skip_watermarks: whether to drop datapoints inside the watermarks of states
+        max_runs: upper bound for runs of timestamps remembered per time series
+        window_ms: length of the window before the latest datapoint of a time series that is always remembered (ms),
+            e.g. the late data margin queried again by a tailing frontfill
+    """
+
+    def __init__(
+        self,
+        states: Optional[AbstractStateStore] = None,
+        skip_watermarks: bool = False,
+        max_runs: int = 1000,
+        window_ms: int = 0,
+    ):
+        self.states = states
+        self.skip_watermarks = skip_watermarks and states is not None
+        self.max_runs = max_runs
+        self.window_ms = window_ms
+        self.seen: Dict[str, TimestampRuns] = {}
+        self._lock = Lock()
+
+    def filter(self, external_id: str, timestamps: np.ndarray) -> np.ndarray:
+        """
+        Boolean mask of the datapoints to upload, and remember them as seen.
+
+        Args:
+            external_id: external id of the time series
+            timestamps: timestamps (ms) of the datapoints
+        """
+        keep = np.zeros(len(timestamps), dtype=bool)
+        keep[np.unique(timestamps, return_index=True)[1]] = True
+        if self.skip_watermarks:
+            low, high = self.states.get_state(external_id)
+            if low is not None and high is not None:
+                keep &= (timestamps < low) | (timestamps > high)
+
+        with self._lock:
+            seen = self.seen.setdefault(external_id, TimestampRuns(self.max_runs, self.window_ms))
+            keep &= ~seen.contains(timestamps)
+            seen.add(timestamps[keep])
+        return keep
+
+    def forget(self, external_id: str, timestamps: np.ndarray) -> None:
+        """
+        Forget datapoints that were not uploaded after all, so they are not dropped when queued again.
+
+        Args:
+            external_id: external id of the time series
+            timestamps: timestamps (ms) of the datapoints
+        """
+        with self._lock:
+            if external_id in self.seen:
+                self.seen[external_id].remove(timestamps)
@@ -2,25 +2,92 @@ from __future__ import annotations
 
 import argparse
 import ast
+import asyncio
+import copy
 import logging
 import os
 import random
+import re
 from concurrent.futures import as_completed
 from concurrent.futures import ThreadPoolExecutor
 from threading import Event
+from typing import Any
+from typing import Dict
 from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import TYPE_CHECKING
 
 from cognite.client import CogniteClient
 from cognite.client.data_classes import TimeSeries
 from cognite.extractorutils import Extractor
+from cognite.extractorutils.configtools import ConfigResolver
+from cognite.extractorutils.metrics import BaseMetrics
+from cognite.extractorutils.metrics import safe_get
 from cognite.extractorutils.statestore import AbstractStateStore
-from cognite.extractorutils.uploader import TimeSeriesUploadQueue
 from cognite.extractorutils.util import ensure_time_series
 
+from .array_upload_queue import ArrayTimeSeriesUploadQueue
+from .config import ApiConfig
 from .config import IceCreamFactoryConfig
+from .datapoints_backfiller import AsyncBackfiller
 from .datapoints_backfiller import Backfiller
+from .datapoints_streamer import AsyncStreamer
 from .datapoints_streamer import Streamer
+from .dedupe import DatapointDeduplicator
 from .ice_cream_factory_api import IceCreamFactoryAPI
+from .metadata_snapshot import MetadataSnapshot
+from common.metrics import Metrics
+from common.timegrid import MINUTE_MS
+
+if TYPE_CHECKING:
+    # Imports aiohttp, only needed when config.api.async_client is set
+    from .async_ice_cream_factory_api import AsyncIceCreamFactoryAPI
+
+# Per-stage timings and counters of the current run
+METRICS = Metrics(namespace="ice_cream_factory_extractor")
+
+# Parsed config files and Ice Cream Factory API clients of earlier runs in this process, reused by warm invocations
+_CONFIGS: Dict[str, Tuple[Tuple, ConfigResolver]] = {}
+_API_CLIENTS: Dict[str, IceCreamFactoryAPI] = {}
+
+
+class WarmExtractor(Extractor):
+    """
+    Extractor that reuses the config parsed by earlier runs in the same process, as in warm Cognite Function
+    invocations. The file is parsed again when it or the environment variables it refers to change. Every run gets
+    its own copy of the config, so overrides applied by a run do not leak into the next one.
+    """
+
+    def _initial_load_config(self, override_path: Optional[str] = None) -> None:
+        if not override_path:
+            super()._initial_load_config(override_path)
+            return
+
+        with open(override_path, "r") as f:
+            config_text = f.read()
+        env_vars = sorted(set(re.findall(r"\$\{(\w+)\}", config_text)))
+        key = (config_text, tuple(os.getenv(name) for name in env_vars))
+
+        cached = _CONFIGS.get(override_path)
+        if cached is None or cached[0] != key:
+            resolver = ConfigResolver(override_path, self.config_class)
+            resolver.config  # parse now, so failures surface here as for Extractor
+            cached = _CONFIGS[override_path] = (key, resolver)
+        self.config_resolver = cached[1]
+        self.config = copy.deepcopy(self.config_resolver.config)
+        Extractor._config_singleton = self.config
+
+
+def api_client(config: ApiConfig) -> IceCreamFactoryAPI:
+    """
+    Ice Cream Factory API client for the config, reused by later runs in the same process so they keep its open
+    connections.
+    """
+    key = repr(config)
+    if key not in _API_CLIENTS:
+        _API_CLIENTS[key] = IceCreamFactoryAPI.from_config(config, metrics=METRICS)
+    return _API_CLIENTS[key]
 
 
 def timeseries_updates(
@@ -59,8 +126,98 @@ def timeseries_updates(
     return updated_timeseries_list
 
 
+def sync_timeseries(
+    cognite: CogniteClient, config: IceCreamFactoryConfig, ice_cream_api: IceCreamFactoryAPI
+) -> List[TimeSeries]:
+    """
+    Get the time series of the configured sites from the Ice Cream Factory API and make sure they exist in CDF, unless
+    the metadata snapshot shows they were synced already.
+
+    Args:
+        cognite: Cognite client
+        config: Configuration parameters
+        ice_cream_api: API client
+
+    Returns:
+        Time series with data set and asset ids set
+    """
+    sites = ",".join(config.api.sites)
+    logging.info(f"Getting OEE timeseries data for the sites {sites}")
+    oee_timeseries_list = ice_cream_api.get_timeseries_list_for_sites(source="oee", sites=config.api.sites)
+
+    snapshot = None
+    if config.extractor.metadata_snapshot and config.extractor.state_store.raw:
+        snapshot = MetadataSnapshot(
+            cognite,
+            database=config.extractor.state_store.raw.database,
+            table=config.extractor.metadata_snapshot_table,
+            max_age_hours=config.extractor.metadata_max_age_hours,
+        )
+    catalog_hash = MetadataSnapshot.catalog_hash(oee_timeseries_list, config.oee_timeseries_dataset_ext_id)
+    timeseries_list = snapshot.apply(oee_timeseries_list, catalog_hash) if snapshot else None
+
+    if timeseries_list is None:
+        timeseries_list = timeseries_updates(timeseries_list=oee_timeseries_list, config=config, client=cognite)
+
+        logging.info(f"Ensuring that {len(timeseries_list)} time series exist in CDF")
+        # If timeseries don't exist in CDF already, they will be created
+        ensure_time_series(cognite, timeseries_list)
+        if snapshot:
+            snapshot.save(timeseries_list, catalog_hash)
+    else:
+        logging.info(f"Catalog of {len(timeseries_list)} time series unchanged since it was last synced to CDF")
+
+    return timeseries_list
+
+
+def chunks(lst, n):
+    """Yield successive n-sized chunks from lst."""
+    for i in range(0, len(lst), n):
+        yield lst[i : i + n]
+
+
+async def run_async(
+    queue: ArrayTimeSeriesUploadQueue,
+    stop_event: Event,
+    api: AsyncIceCreamFactoryAPI,
+    timeseries_to_query: List[TimeSeries],
+    config: IceCreamFactoryConfig,
+    states: AbstractStateStore,
+    cognite: CogniteClient,
+) -> None:
+    """
+    Run backfill and frontfill as tasks on one event loop, sharing the connection pool of the API client.
+
+    Args:
+        queue: Where to put data points
+        stop_event: Cancellation token
+        api: API to query
+        timeseries_to_query: Time series to query datapoints for
+        config: Configuration parameters
+        states: Current state of time series in CDF
+        cognite: Cognite client
+    """
+    async with api:
+        tasks = []
+        if config.backfill.enabled:
+            logging.info(f"Starting backfiller. Back-filling for {config.backfill.history_days} days of data")
+            tasks.append(AsyncBackfiller(queue, stop_event, api, timeseries_to_query, config, states, cognite).run())
+
+        if config.frontfill.enabled:
+            logging.info("Starting frontfiller...")
+            for batch in chunks(timeseries_to_query, 10):
+                tasks.append(AsyncStreamer(queue, stop_event, api, batch, config, states).run())
+
+        await asyncio.gather(*tasks)
+
+
 def run_extractor(
-    cognite: CogniteClient, states: AbstractStateStore, config: IceCreamFactoryConfig, stop_event: Event
+    cognite: CogniteClient,
+    states: AbstractStateStore,
+    config: IceCreamFactoryConfig,
+    stop_event: Event,
+    ice_cream_api: Optional[IceCreamFactoryAPI] = None,
+    async_ice_cream_api: Optional[AsyncIceCreamFactoryAPI] = None,
 ) -> None:
     """
     Run extractor and extract datapoints for timeseries for sites given in config.
@@ -70,28 +227,35 @@ def run_extractor(
         states: Initialized state store object
         config: Configuration parameters
         stop_event: Cancellation token, will be set when an interrupt signal is sent to the extractor process
+        ice_cream_api: API client to use instead of one created from config.api.url (e.g. for running offline)
+        async_ice_cream_api: API client to use for datapoints when config.api.async_client is set
+
+    Timings and counters of the run are recorded in METRICS.
     """
+    METRICS.reset()
 
     config.frontfill.enabled = str(os.getenv("FRONTFILL_ENABLED", config.frontfill.enabled)).lower() == "true"
     config.frontfill.lookback_min = int(os.getenv("FRONTFILL_LOOKBACK_MIN", config.frontfill.lookback_min))
+    config.frontfill.tailing = str(os.getenv("FRONTFILL_TAILING", config.frontfill.tailing)).lower() == "true"
     config.backfill.enabled = str(os.getenv("BACKFILL_ENABLED", config.backfill.enabled)).lower() == "true"
     config.backfill.history_days = int(os.getenv("BACKFILL_HISTORY_DAYS", config.backfill.history_days))
+    config.backfill.gap_detection = (
+        str(os.getenv("BACKFILL_GAP_DETECTION", config.backfill.gap_detection)).lower() == "true"
+    )
+    config.api.async_client = str(os.getenv("ASYNC_CLIENT", config.api.async_client)).lower() == "true"
     if os.getenv("SITES"):
         config.api.sites = ast.literal_eval(os.getenv("SITES"))
+    config.extractor.metrics_textfile = os.getenv("METRICS_TEXTFILE", config.extractor.metrics_textfile)
+    config.extractor.metrics_pushgateway_url = os.getenv(
+        "METRICS_PUSHGATEWAY_URL", config.extractor.metrics_pushgateway_url
+    )
 
     logging.basicConfig(level=logging.INFO)
     logging.info("Starting Ice Cream Factory datapoints extractor")
-    ice_cream_api = IceCreamFactoryAPI(base_url=config.api.url)
-
-    sites = ",".join(config.api.sites)
-    logging.info(f"Getting OEE timeseries data for the sites {sites}")
-    oee_timeseries_list = ice_cream_api.get_timeseries_list_for_sites(source="oee", sites=config.api.sites)
-
-    timeseries_list = timeseries_updates(timeseries_list=oee_timeseries_list, config=config, client=cognite)
+    ice_cream_api = ice_cream_api or api_client(config.api)
 
-    logging.info(f"Ensuring that {len(timeseries_list)} time series exist in CDF")
-    # If timeseries don't exist in CDF already, they will be created
-    ensure_time_series(cognite, timeseries_list)
+    with METRICS.time("startup"):
+        timeseries_list = sync_timeseries(cognite, config, ice_cream_api)
 
     # Only request datapoints for timeseries with count/planned_status in external id.
     # Datapoints for the corresponding good/status timeseries will be returned when querying for count/status timeseries
@@ -100,8 +264,22 @@ def run_extractor(
         ts for ts in timeseries_list if ("count" in ts.external_id or "planned_status" in ts.external_id)
     ]
 
-    clean_uploader_queue = TimeSeriesUploadQueue(
+    deduplicator = None
+    # A tailing frontfill queries the late data margin again every iteration, and relies on the deduplicator to drop
+    # the datapoints it already queued
+    if config.extractor.dedupe or config.frontfill.tailing:
+        if config.extractor.dedupe_watermarks and (config.backfill.gap_detection or config.frontfill.tailing):
+            logging.warning("Datapoints inside the watermarks are skipped, gaps and late datapoints will be dropped")
+        deduplicator = DatapointDeduplicator(
+            states,
+            skip_watermarks=config.extractor.dedupe_watermarks,
+            window_ms=int(config.frontfill.late_data_margin_min * MINUTE_MS) if config.frontfill.tailing else 0,
+        )
+
+    clean_uploader_queue = ArrayTimeSeriesUploadQueue(
         cognite,
+        deduplicator=deduplicator,
+        metrics=METRICS,
         post_upload_function=states.post_upload_handler(),
         max_upload_interval=config.extractor.upload_interval,
         max_queue_size=50_000,
@@ -109,32 +287,51 @@ def run_extractor(
         thread_name="CDF-Uploader",
     )
 
-    def chunks(lst, n):
-        """Yield successive n-sized chunks from lst."""
-        for i in range(0, len(lst), n):
-            yield lst[i : i + n]
-
-    futures = []
-    with clean_uploader_queue as queue:
-        with ThreadPoolExecutor(thread_name_prefix="Data", max_workers=config.extractor.parallelism * 2) as executor:
-            if config.backfill.enabled:
-                logging.info(f"Starting backfiller. Back-filling for {config.backfill.history_days} days of data")
-
-                for i, batch in enumerate(chunks(timeseries_to_query, 10)):
-                    worker = Backfiller(queue, stop_event, ice_cream_api, batch, config, states)
-                    futures.append(executor.submit(worker.run))
-
-            if config.frontfill.enabled:
-                logging.info("Starting frontfiller...")
-
-                for i, batch in enumerate(chunks(timeseries_to_query, 10)):
-                    worker = Streamer(queue, stop_event, ice_cream_api, batch, config, states)
-                    futures.append(executor.submit(worker.run))
-
-    for future in as_completed(futures):
-        future.result()
+    if config.api.async_client:
+        from .async_ice_cream_factory_api import AsyncIceCreamFactoryAPI
+
+        async_ice_cream_api = async_ice_cream_api or AsyncIceCreamFactoryAPI.from_config(config.api, metrics=METRICS)
+        with clean_uploader_queue as queue:
+            asyncio.run(run_async(queue, stop_event, async_ice_cream_api, timeseries_to_query, config, states, cognite))
+    else:
+        futures = []
+        with clean_uploader_queue as queue:
+            with ThreadPoolExecutor(
+                thread_name_prefix="Data", max_workers=config.extractor.parallelism * 2
+            ) as executor:
+                if config.backfill.enabled:
+                    logging.info(f"Starting backfiller. Back-filling for {config.backfill.history_days} days of data")
+
+                    # One work item per time series and API query, so a slow time series only holds up one worker
+                    backfiller = Backfiller(
+                        queue, stop_event, ice_cream_api, timeseries_to_query, config, states, cognite
+                    )
+                    work = backfiller.plan()
+                    logging.info(f"Backfilling {len(work)} time slices for {len(timeseries_to_query)} time series")
+                    for item in work:
+                        futures.append(executor.submit(backfiller.extract_slice, *item))
+
+                if config.frontfill.enabled:
+                    logging.info("Starting frontfiller...")
+
+                    for i, batch in enumerate(chunks(timeseries_to_query, 10)):
+                        worker = Streamer(queue, stop_event, ice_cream_api, batch, config, states)
+                        futures.append(executor.submit(worker.run))
+
+        for future in as_completed(futures):
+            future.result()
 
     queue.upload()  # Ensure leftovers are complete
+    if queue.points_deduplicated:
+        logging.info(f"Skipped {queue.points_deduplicated} duplicate datapoints")
+
+    logging.info(f"Metrics per stage: {METRICS.summary()}")
+    try:
+        METRICS.export(
+            textfile=config.extractor.metrics_textfile, pushgateway_url=config.extractor.metrics_pushgateway_url
+        )
+    except Exception as e:
+        logging.warning(f"Could not export metrics: {e}")
 
     if config.frontfill.enabled and not config.backfill.enabled:
         fake_state_ext_id = "fake_failure_counter"
@@ -151,19 +348,26 @@ def run_extractor(
             )
 
 
-def main(config_file_path: str = "extractor_config.yaml") -> None:
+def main(config_file_path: str = "extractor_config.yaml") -> Dict[str, Any]:
     """
     Main entrypoint.
+
+    Returns:
+        Summary of the timings and counters of the run per stage
     """
-    with Extractor(
+    with WarmExtractor(
         name="datapoints_rest_extractor",
         description="An extractor that ingest datapoints from the Ice Cream Factory API to CDF clean",
         config_class=IceCreamFactoryConfig,
         version="1.0",
         config_file_path=config_file_path,
         run_handle=run_extractor,
+        # Prometheus metrics can only be registered once per process, and the default token is shared by all runs
+        metrics=safe_get(BaseMetrics, extractor_name="datapoints_rest_extractor", extractor_version="1.0"),
+        cancelation_token=Event(),
     ) as extractor:
         extractor.run()
+    return METRICS.summary()
 
 
 if __name__ == "__main__":
@@ -1,27 +1,154 @@
 from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from threading import BoundedSemaphore
 from typing import Dict
+from typing import Iterable
 from typing import List
+from typing import Optional
+from typing import Tuple
 from typing import Union
 
+import numpy as np
 import ujson as ujson
 from cognite.client.data_classes import TimeSeries
 from requests import adapters
 from requests import Response
 from requests import Session
+from requests.exceptions import HTTPError
+from requests.exceptions import RequestException
+
+from .array_upload_queue import DatapointArrays
+from .config import ApiConfig
+from .transport import CircuitBreaker
+from .transport import http_retry
+from .transport import RETRY_STATUS_CODES
+from common.metrics import Metrics
+
+
+def decode_datapoints(content: bytes) -> Dict[str, DatapointArrays]:
+    """
+    Decode a datapoints response of the Ice Cream Factory API, {external id: [[timestamp (s), value], ...]}, straight
+    into arrays, without building a Python object per datapoint beyond what the JSON parser creates.
+
+    Args:
+        content: response body
+
+    Returns:
+        Timestamps in ms and values per external id
+    """
+    datapoints_arrays = {}
+    for external_id, datapoints in ujson.loads(content).items():
+        datapoints_array = np.array(datapoints, dtype=np.float64).reshape(-1, 2)
+        # convert timestamp to ms (*1000) for CDF uploads
+        datapoints_arrays[external_id] = (
+            np.rint(datapoints_array[:, 0] * 1000).astype(np.int64),
+            np.ascontiguousarray(datapoints_array[:, 1]),
+        )
+    return datapoints_arrays
+
+
+def merge_datapoints(datapoints_dicts: Iterable[Dict[str, DatapointArrays]]) -> Dict[str, DatapointArrays]:
+    """
+    Merge datapoint arrays of several responses per external id.
+    """
+    collected: Dict[str, List[DatapointArrays]] = {}
+    for datapoints_dict in datapoints_dicts:
+        for external_id, arrays in datapoints_dict.items():
+            collected.setdefault(external_id, []).append(arrays)
+    return {
+        external_id: (np.concatenate([a[0] for a in arrays]), np.concatenate([a[1] for a in arrays]))
+        for external_id, arrays in collected.items()
+    }
+
+
+def count_datapoints(datapoints_dict: Dict[str, Union[List[Tuple[float, float]], DatapointArrays]]) -> int:
+    """
+    Number of datapoints in a decoded datapoints response, as lists or arrays.
+    """
+    return sum(
+        len(datapoints[0]) if isinstance(datapoints, tuple) else len(datapoints)
+        for datapoints in datapoints_dict.values()
+    )
 
 
 class IceCreamFactoryAPI:
-    """Class for Ice Cream Factory API."""
+    """
+    Class for Ice Cream Factory API.
+
+    Requests are retried by the transport with exponential backoff and jitter, honoring Retry-After, and stop being
+    sent while the circuit breaker is open.
 
-    def __init__(self, base_url: str):
+    Args:
+        base_url: url of the API
+        max_concurrent_requests: upper bound for requests in flight from all threads sharing this client
+        multi_series_requests: whether the datapoints endpoint accepts several external ids in one request
+        pool_size: connections kept open to the API, defaults to max_concurrent_requests
+        retries: retries per request on connection errors, throttling and transient server errors
+        backoff_factor: initial backoff in seconds, doubled for every retry
+        max_backoff: upper bound for the backoff in seconds
+        retry_deadline: seconds after the first failure of a request after which it is not retried, no limit if None
+        timeout: connect and read timeout in seconds
+        circuit_breaker: circuit breaker shared by all requests, none by default
+        metrics: where request and decoding timings, retries, errors and datapoints are recorded, under the
+            "factory_api" and "decode" stages
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        max_concurrent_requests: Optional[int] = None,
+        multi_series_requests: bool = False,
+        pool_size: Optional[int] = None,
+        retries: int = 5,
+        backoff_factor: float = 0.5,
+        max_backoff: float = 30.0,
+        retry_deadline: Optional[float] = 60.0,
+        timeout: Tuple[float, float] = (5.0, 40.0),
+        circuit_breaker: Optional[CircuitBreaker] = None,
+        metrics: Optional[Metrics] = None,
+    ):
         self.base_url = base_url
-        self.adapter = adapters.HTTPAdapter(max_retries=3)
+        self.max_concurrent_requests = max_concurrent_requests
+        self.multi_series_requests = multi_series_requests
+        self.timeout = timeout
+        self.circuit_breaker = circuit_breaker
+        self.metrics = metrics
+        pool_size = pool_size or max_concurrent_requests or adapters.DEFAULT_POOLSIZE
+        self.adapter = adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            # Threads wait for a pooled connection instead of opening connections that are thrown away after use
+            pool_block=True,
+            max_retries=http_retry(retries, backoff_factor, max_backoff, retry_deadline),
+        )
         self.session = Session()
         self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.request_slots = BoundedSemaphore(max_concurrent_requests) if max_concurrent_requests else nullcontext()
+
+    @classmethod
+    def from_config(cls, config: ApiConfig, metrics: Optional[Metrics] = None) -> IceCreamFactoryAPI:
+        """
+        Create a client from the api section of the extractor config.
+        """
+        return cls(
+            base_url=config.url,
+            max_concurrent_requests=config.max_concurrent_requests,
+            multi_series_requests=config.multi_series_requests,
+            pool_size=config.pool_size,
+            retries=config.retries,
+            backoff_factor=config.backoff_factor,
+            max_backoff=config.max_backoff_sec,
+            retry_deadline=config.retry_deadline_sec,
+            timeout=(config.connect_timeout_sec, config.read_timeout_sec),
+            circuit_breaker=CircuitBreaker(config.circuit_breaker_threshold, config.circuit_breaker_reset_sec),
+            metrics=metrics,
+        )
 
     def get_response(
-        self, headers: Dict[str, str], url_suffix: str, params: Dict[str, Union[str, int, float]] = {}
+        self, headers: Dict[str, str], url_suffix: str, params: Dict[str, Union[str, int, float, List[str]]] = {}
     ) -> Response:
         """
         Get response from API.
@@ -32,10 +159,42 @@ class IceCreamFactoryAPI:
             params: query parameters
         """
 
-        response = self.session.get(f"{self.base_url}/{url_suffix}", headers=headers, timeout=40, params=params)
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.check()
+        try:
+            with self.metrics.time("factory_api") if self.metrics is not None else nullcontext():
+                response = self._get(headers, url_suffix, params)
+        except HTTPError as e:
+            self._record(success=e.response.status_code not in RETRY_STATUS_CODES)
+            raise
+        except RequestException:
+            self._record(success=False)
+            raise
+        self._record(success=True)
+        return response
+
+    def _get(
+        self, headers: Dict[str, str], url_suffix: str, params: Dict[str, Union[str, int, float, List[str]]]
+    ) -> Response:
+        with self.request_slots:
+            response = self.session.get(
+                f"{self.base_url}/{url_suffix}", headers=headers, timeout=self.timeout, params=params
+            )
+        # Retries happen inside the transport, its retry history tells how many were needed
+        retries = getattr(response.raw, "retries", None)
+        if self.metrics is not None and retries is not None and retries.history:
+            self.metrics.count("factory_api", "retries", len(retries.history))
         response.raise_for_status()
         return response
 
+    def _record(self, success: bool) -> None:
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record(success=success)
+        if self.metrics is not None:
+            self.metrics.count("factory_api", "requests")
+            if not success:
+                self.metrics.count("factory_api", "errors")
+
     def get_csv(self, url_suffix: str) -> str:
         """
         Get csv file.
@@ -75,7 +234,7 @@ class IceCreamFactoryAPI:
         return timeseries_list
 
     def get_oee_timeseries_datapoints(
-        self, timeseries_ext_id: str, start: Union[str, int, float], end: Union[str, int, float]
+        self, timeseries_ext_id: str, start: Union[str, int, float], end: Union[str, int, float], arrays: bool = False
     ):
         """
         Get datapoints for a timeseries external id. This will also return datapoints for an associated timeseries
@@ -88,16 +247,66 @@ class IceCreamFactoryAPI:
             timeseries_ext_id: external id of timeseries to get datapoints for
             start: start for datapoints (UNIX timestamp (int, float) or string with format 'YYYY-MM-DD HH:MM')
             end: end for datapoints (UNIX timestamp (int, float) or string with format 'YYYY-MM-DD HH:MM')
+            arrays: return timestamp (ms) and value arrays per timeseries instead of lists of (timestamp, value) tuples
+        """
+        return self._get_oee_datapoints(timeseries_ext_id, start, end, arrays)
+
+    def get_oee_timeseries_datapoints_multi(
+        self, queries: List[Tuple[str, Union[str, int, float], Union[str, int, float]]], arrays: bool = False
+    ) -> Dict[str, Union[List[Tuple[float, float]], DatapointArrays]]:
+        """
+        Get datapoints for many (external id, start, end) queries. Queries sharing a time window are sent as one
+        request when the API supports several external ids per request, otherwise all queries are sent concurrently.
+
+        Args:
+            queries: external id, start and end of every query, as for get_oee_timeseries_datapoints
+            arrays: return timestamp (ms) and value arrays per timeseries instead of lists of (timestamp, value) tuples
+
+        Returns:
+            Datapoints of all requested and associated timeseries, merged per external id
         """
+        if self.multi_series_requests:
+            windows: Dict[Tuple, List[str]] = {}
+            for ext_id, start, end in queries:
+                windows.setdefault((start, end), []).append(ext_id)
+            requests = [(ext_ids, start, end) for (start, end), ext_ids in windows.items()]
+        else:
+            requests = list(queries)
+
+        if not requests:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(len(requests), self.max_concurrent_requests or 4)) as executor:
+            datapoints_dicts = list(executor.map(lambda request: self._get_oee_datapoints(*request, arrays), requests))
+        if arrays:
+            return merge_datapoints(datapoints_dicts)
+
+        merged: Dict[str, List[Tuple[float, float]]] = {}
+        for datapoints_dict in datapoints_dicts:
+            for ext_id, datapoints in datapoints_dict.items():
+                merged.setdefault(ext_id, []).extend(datapoints)
+        return merged
+
+    def _get_oee_datapoints(
+        self,
+        timeseries_ext_id: Union[str, List[str]],
+        start: Union[str, int, float],
+        end: Union[str, int, float],
+        arrays: bool = False,
+    ) -> Dict[str, Union[List[Tuple[float, float]], DatapointArrays]]:
         params = {"start": start, "end": end, "external_id": timeseries_ext_id}
         response = self.get_response(headers={}, url_suffix="datapoints/oee", params=params)
+        with self.metrics.time("decode") if self.metrics is not None else nullcontext():
+            if arrays:
+                datapoints_to_upload = decode_datapoints(response.content)
+            else:
+                datapoints_dict = ujson.loads(response.content)
+                datapoints_to_upload = {}
 
-        datapoints_dict = ujson.loads(response.content)
-        datapoints_to_upload = {}
-
-        for timeseries in datapoints_dict:
-            ts_datapoints = datapoints_dict[timeseries]
-            # convert timestamp to ms (*1000) for CDF uploads
-            datapoints_to_upload[timeseries] = [(dp[0] * 1000, dp[1]) for dp in ts_datapoints]
+                for timeseries in datapoints_dict:
+                    ts_datapoints = datapoints_dict[timeseries]
+                    # convert timestamp to ms (*1000) for CDF uploads
+                    datapoints_to_upload[timeseries] = [(dp[0] * 1000, dp[1]) for dp in ts_datapoints]
 
+        if self.metrics is not None:
+            self.metrics.count("decode", "datapoints", count_datapoints(datapoints_to_upload))
         return datapoints_to_upload
@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import arrow
+import ujson as ujson
+from cognite.client import CogniteClient
+from cognite.client.data_classes import TimeSeries
+from cognite.client.exceptions import CogniteAPIError
+
+
+class MetadataSnapshot:
+    """
+    Snapshot of the time series catalog last synced to CDF, kept as one row in RAW. It holds a hash of the catalog and
+    the data set and asset ids found for it, so a run with an unchanged catalog can skip the asset and data set lookups
+    and the time series existence checks.
+
+    Args:
+        client: Cognite client
+        database: RAW database of the snapshot
+        table: RAW table of the snapshot
+        key: row key of the snapshot
+        max_age_hours: hours after which the metadata is synced to CDF again even if the catalog is unchanged
+    """
+
+    def __init__(
+        self,
+        client: CogniteClient,
+        database: str,
+        table: str,
+        key: str = "oee_timeseries",
+        max_age_hours: float = 24,
+    ):
+        self.client = client
+        self.database = database
+        self.table = table
+        self.key = key
+        self.max_age_hours = max_age_hours
+
+    @staticmethod
+    def catalog_hash(timeseries_list: List[TimeSeries], dataset_ext_id: str) -> str:
+        """
+        Hash of the time series catalog and the data set it is extracted to.
+
+        Args:
+            timeseries_list: time series from the Ice Cream Factory API
+            dataset_ext_id: external id of the data set of the time series
+        """
+        catalog = sorted((ts.dump() for ts in timeseries_list), key=lambda ts: ts["external_id"])
+        content = ujson.dumps([dataset_ext_id, catalog], sort_keys=True).encode("utf-8")
+        return hashlib.sha256(content).hexdigest()
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        """
+        Columns of the stored snapshot, if there is one.
+        """
+        try:
+            row = self.client.raw.rows.retrieve(db_name=self.database, table_name=self.table, key=self.key)
+        except CogniteAPIError as e:
+            if e.code != 404:
+                raise
+            return None
+        return row.columns if row is not None else None
+
+    def apply(self, timeseries_list: List[TimeSeries], catalog_hash: str) -> Optional[List[TimeSeries]]:
+        """
+        Set data set and asset ids of the time series from the snapshot.
+
+        Args:
+            timeseries_list: time series from the Ice Cream Factory API
+            catalog_hash: catalog_hash() of the time series
+
+        Returns:
+            The updated time series, or None if the snapshot is missing, outdated or for another catalog
+        """
+        snapshot = self.load()
+        if snapshot is None or snapshot.get("hash") != catalog_hash:
+            return None
+        if arrow.utcnow().shift(hours=-self.max_age_hours) > arrow.get(snapshot["synced"] / 1000):
+            return None
+
+        asset_ids = snapshot["asset_ids"]
+        for timeseries in timeseries_list:
+            timeseries.data_set_id = snapshot["data_set_id"]
+            timeseries.asset_id = asset_ids.get(timeseries.external_id.split(":")[0])
+        return timeseries_list
+
+    def save(self, timeseries_list: List[TimeSeries], catalog_hash: str) -> None:
+        """
+        Store the snapshot of time series that were synced to CDF.
+
+        Args:
+            timeseries_list: time series with data set and asset ids set
+            catalog_hash: catalog_hash() of the time series
+        """
+        data_set_ids = {ts.data_set_id for ts in timeseries_list}
+        if len(data_set_ids) != 1:
+            logging.info("Time series belong to more than one data set, not storing a metadata snapshot")
+            return
+        columns = {
+            "hash": catalog_hash,
+            "synced": int(arrow.utcnow().float_timestamp * 1000),
+            "data_set_id": data_set_ids.pop(),
+            "asset_ids": {ts.external_id.split(":")[0]: ts.asset_id for ts in timeseries_list if ts.asset_id},
+        }
+        self.client.raw.rows.insert(
+            db_name=self.database, table_name=self.table, row={self.key: columns}, ensure_parent=True
+        )
@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+from cognite.client.exceptions import CogniteAPIError
+from cognite.extractorutils.configtools import StateStoreConfig
+from cognite.extractorutils.retry import retry
+from cognite.extractorutils.statestore import AbstractStateStore
+from cognite.extractorutils.statestore import RawStateStore
+from cognite.extractorutils.statestore import RETRIES
+from cognite.extractorutils.statestore import RETRY_BACKOFF_FACTOR
+from cognite.extractorutils.statestore import RETRY_DELAY
+from cognite.extractorutils.statestore import RETRY_MAX_DELAY
+from requests.exceptions import ConnectionError
+
+
+# Row key of the latest high watermark of all states in the watermark table
+WATERMARK_KEY = "watermark"
+
+
+class BatchedRawStateStore(RawStateStore):
+    """
+    RAW state store that reads all states in one pass over the table at startup, keeps them in memory and only writes
+    the states that changed since the last synchronization, in batches of batch_size rows. Synchronization runs on the
+    save_interval timer and at shutdown, as for RawStateStore.
+
+    With a watermark_table, the latest high watermark of all states is also kept in a single row of that table, so
+    readers that only need the overall watermark do not have to read every state. The row only moves forward: several
+    extractor runs can share it, and a run whose states are older than the stored watermark leaves it alone.
+
+    Args:
+        batch_size: upper bound for rows written in one request
+        watermark_table: RAW table, in the same database, of the row holding the latest high watermark of all states
+        Other arguments are passed on to RawStateStore
+    """
+
+    def __init__(self, *args, batch_size: int = 1000, watermark_table: Optional[str] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_size = batch_size
+        self.watermark_table = watermark_table
+        self._changed: Set[str] = set()
+        self._watermark: Optional[Any] = None
+
+    def set_state(self, external_id: str, low: Optional[Any] = None, high: Optional[Any] = None) -> None:
+        with self.lock:
+            self._update(external_id, low, high, expand=False)
+
+    def expand_state(self, external_id: str, low: Optional[Any] = None, high: Optional[Any] = None) -> None:
+        with self.lock:
+            self._update(external_id, low, high, expand=True)
+
+    def expand_states(self, states: Dict[str, Tuple[Any, Any]]) -> None:
+        """
+        Like expand_state, for many external IDs at once.
+
+        Args:
+            states: (low, high) watermarks per external ID
+        """
+        with self.lock:
+            for external_id, (low, high) in states.items():
+                self._update(external_id, low, high, expand=True)
+
+    def delete_state(self, external_id: str) -> None:
+        super().delete_state(external_id)
+        with self.lock:
+            self._changed.discard(external_id)
+
+    def post_upload_handler(self) -> Callable[[List[Dict[str, Any]]], None]:
+        """
+        Get a callable suitable for passing to a time series upload queue as post_upload_function, that expands the
+        states of all uploaded time series at once.
+        """
+
+        def callback(uploaded_points: List[Dict[str, Any]]) -> None:
+            states = {}
+            for time_series in uploaded_points:
+                # Use CDF timestamps
+                data_points = time_series["datapoints"]
+                if data_points:
+                    states[time_series["externalId"]] = (min(data_points)[0], max(data_points)[0])
+            self.expand_states(states)
+
+        return callback
+
+    def synchronize(self) -> None:
+        with self.lock:
+            rows = {external_id: dict(self._local_state[external_id]) for external_id in self._changed}
+            deleted = list(self._deleted)
+            self._changed.clear()
+            self._deleted.clear()
+
+        try:
+            self._write(rows, deleted)
+        except Exception:
+            # Keep the states for the next synchronization
+            with self.lock:
+                self._changed.update(external_id for external_id in rows if external_id in self._local_state)
+                self._deleted.extend(deleted)
+            raise
+
+        if self.watermark_table and (rows or deleted):
+            with self.lock:
+                highs = [state["high"] for state in self._local_state.values() if state.get("high") is not None]
+            watermark = max(highs) if highs else None
+            if watermark is not None and (self._watermark is None or watermark > self._watermark):
+                self._advance_watermark(watermark, len(highs))
+
+    @retry(
+        exceptions=(CogniteAPIError, ConnectionError),
+        tries=RETRIES,
+        delay=RETRY_DELAY,
+        max_delay=RETRY_MAX_DELAY,
+        backoff=RETRY_BACKOFF_FACTOR,
+    )
+    def _write(self, rows: Dict[str, Dict[str, Any]], deleted: List[str]) -> None:
+        external_ids = list(rows)
+        for i in range(0, len(external_ids), self.batch_size):
+            batch = {external_id: rows[external_id] for external_id in external_ids[i : i + self.batch_size]}
+            self._cdf_client.raw.rows.insert(db_name=self.database, table_name=self.table, row=batch)
+        if deleted:
+            self._cdf_client.raw.rows.delete(db_name=self.database, table_name=self.table, key=deleted)
+
+    @retry(
+        exceptions=(CogniteAPIError, ConnectionError),
+        tries=RETRIES,
+        delay=RETRY_DELAY,
+        max_delay=RETRY_MAX_DELAY,
+        backoff=RETRY_BACKOFF_FACTOR,
+    )
+    def _advance_watermark(self, high: Any, states: int) -> None:
+        """
+        Write the watermark row, unless it holds a later watermark already (e.g. written by a concurrent run).
+        """
+        try:
+            row = self._cdf_client.raw.rows.retrieve(
+                db_name=self.database, table_name=self.watermark_table, key=WATERMARK_KEY
+            )
+        except CogniteAPIError as e:
+            if e.code != 404:
+                raise
+            row = None
+        stored = row.columns.get("high") if row is not None else None
+        if stored is not None and stored >= high:
+            self._watermark = stored
+            return
+
+        self._cdf_client.raw.rows.insert(
+            db_name=self.database,
+            table_name=self.watermark_table,
+            row={WATERMARK_KEY: {"high": high, "states": states}},
+            ensure_parent=True,
+        )
+        self._watermark = high
+
+    def _update(self, external_id: str, low: Optional[Any], high: Optional[Any], expand: bool) -> None:
+        """
+        Update a state and remember it as changed if it did. Must be called with the lock held.
+        """
+        state = self._local_state.setdefault(external_id, {})
+        old_low, old_high = state.get("low"), state.get("high")
+        if expand:
+            new_low = _extend(min, old_low, low)
+            new_high = _extend(max, old_high, high)
+        else:
+            new_low = low if low is not None else old_low
+            new_high = high if high is not None else old_high
+
+        if "low" not in state or (new_low, new_high) != (old_low, old_high):
+            state["low"] = new_low
+            state["high"] = new_high
+            self._changed.add(external_id)
+
+
+def _extend(pick: Callable[[Any, Any], Any], old: Optional[Any], new: Optional[Any]) -> Optional[Any]:
+    if new is None:
+        return old
+    return new if old is None else pick(old, new)
+
+
+@dataclass
+class BatchedStateStoreConfig(StateStoreConfig):
+    batch_size: int = 1000  # Upper bound for state rows written to RAW in one request
+    watermark_table: Optional[str] = None  # RAW table of the single row holding the latest high watermark of all states
+
+    def create_state_store(self, cdf_client=None, default_to_local: bool = True) -> AbstractStateStore:
+        """
+        Create a BatchedRawStateStore for a RAW state store, otherwise as StateStoreConfig.
+        """
+        if self.raw and not self.local:
+            if cdf_client is None:
+                raise TypeError("A cognite client object must be provided when state store is RAW")
+            return BatchedRawStateStore(
+                cdf_client=cdf_client,
+                database=self.raw.database,
+                table=self.raw.table,
+                save_interval=self.raw.upload_interval,
+                batch_size=self.batch_size,
+                watermark_table=self.watermark_table,
+            )
+        return super().create_state_store(cdf_client, default_to_local)
@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+import random
+from email.utils import parsedate_to_datetime
+from itertools import takewhile
+from threading import Lock
+from time import monotonic
+from typing import Optional
+
+import arrow
+from urllib3.util.retry import Retry
+
+# Responses worth retrying: throttling and transient server errors
+RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of sending a request while the circuit breaker is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Stops requests towards an API that keeps failing. After failure_threshold consecutive failed requests the circuit
+    opens and requests fail fast with CircuitOpenError. Once reset_timeout has passed, requests are let through again;
+    the circuit closes on the first success and opens again on the next failure.
+
+    A request counts as failed when it could not be sent or the API answered with a status in RETRY_STATUS_CODES after
+    all retries. Other error responses mean the API is up, and count as successes.
+
+    Args:
+        failure_threshold: consecutive failed requests before the circuit opens
+        reset_timeout: seconds the circuit stays open
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._lock = Lock()
+
+    def check(self) -> None:
+        """
+        Raise CircuitOpenError if requests should not be sent right now.
+        """
+        with self._lock:
+            if self.opened_at is not None and monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(
+                    f"{self.failures} consecutive requests failed, not sending requests for "
+                    f"{self.reset_timeout - (monotonic() - self.opened_at):.0f} seconds"
+                )
+
+    def record(self, success: bool) -> None:
+        """
+        Record the outcome of a request.
+        """
+        with self._lock:
+            if success:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = monotonic()
+
+
+def backoff_seconds(attempt: int, backoff_factor: float, max_backoff: float) -> float:
+    """
+    Exponential backoff with jitter before retry number attempt (starting at 0).
+    """
+    return min(max_backoff, backoff_factor * 2**attempt) + random.uniform(0, backoff_factor)
+
+
+def retry_after_seconds(retry_after: Optional[str]) -> Optional[float]:
+    """
+    Seconds to wait according to a Retry-After header, given either in seconds or as an HTTP date.
+    """
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (arrow.get(parsedate_to_datetime(retry_after)) - arrow.utcnow()).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class JitteredRetry(Retry):
+    """
+    urllib3 Retry with exponential backoff that is randomized and capped, as Retry(backoff_jitter, backoff_max) in
+    urllib3 2, but also available with urllib3 1.26.
+
+    With a deadline, a request is not retried once deadline seconds have passed since its first failure, and waits
+    for backoff or Retry-After are cut off at the deadline. A request then takes at most two attempts (connect and read
+    timeout) plus the deadline, however many retries are allowed.
+
+    Args:
+        max_backoff: upper bound for the backoff in seconds
+        jitter: upper bound for the random seconds added to the backoff
+        deadline: seconds after the first failure of a request after which it is not retried, no limit by default
+        Other arguments are passed on to Retry
+    """
+
+    def __init__(
+        self, *args, max_backoff: float = 120.0, jitter: float = 0.0, deadline: Optional[float] = None, **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.deadline = deadline
+        # Monotonic time the deadline passes, set on the first failure of a request
+        self.retry_until: Optional[float] = None
+
+    def new(self, **kwargs) -> JitteredRetry:
+        # Called by increment() on every failure, the policy given to the adapter is copied for every request
+        retry = super().new(**kwargs)
+        retry.max_backoff = self.max_backoff
+        retry.jitter = self.jitter
+        retry.deadline = self.deadline
+        retry.retry_until = self.retry_until
+        if retry.retry_until is None and self.deadline is not None:
+            retry.retry_until = monotonic() + self.deadline
+        return retry
+
+    def remaining(self) -> Optional[float]:
+        """
+        Seconds left until the deadline, None without one.
+        """
+        return None if self.retry_until is None else max(0.0, self.retry_until - monotonic())
+
+    def is_exhausted(self) -> bool:
+        return super().is_exhausted() or self.remaining() == 0
+
+    def get_backoff_time(self) -> float:
+        # Only the last consecutive errors count, redirects reset the backoff
+        consecutive_errors = len(list(takewhile(lambda x: x.redirect_location is None, reversed(self.history))))
+        if consecutive_errors <= 1:
+            return 0
+        backoff = self.backoff_factor * 2 ** (consecutive_errors - 1) + random.uniform(0, self.jitter)
+        return self._until_deadline(max(0.0, min(self.max_backoff, backoff)))
+
+    def get_retry_after(self, response) -> Optional[float]:
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else self._until_deadline(retry_after)
+
+    def _until_deadline(self, seconds: float) -> float:
+        remaining = self.remaining()
+        return seconds if remaining is None else min(seconds, remaining)
+
+
+def http_retry(retries: int, backoff_factor: float, max_backoff: float, deadline: Optional[float] = None) -> Retry:
+    """
+    urllib3 retry policy for idempotent requests: exponential backoff with jitter on connection errors and on
+    responses with a status in RETRY_STATUS_CODES, waiting as long as the Retry-After header asks for when given.
+    Retrying stops deadline seconds after the first failure. The last response is returned instead of raised, so
+    callers see its status code.
+    """
+    return JitteredRetry(
+        total=retries,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=frozenset({"GET"}),
+        backoff_factor=backoff_factor,
+        max_backoff=max_backoff,
+        jitter=backoff_factor,
+        deadline=deadline,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
@@ -0,0 +1,7 @@
+from __future__ import annotations
+
+from .cdf import FakeCogniteClient
+from .factory_api import FakeIceCreamFactoryAdapter
+from .synthetic import SyntheticFactory
+
+__all__ = ["FakeCogniteClient", "FakeIceCreamFactoryAdapter", "SyntheticFactory"]
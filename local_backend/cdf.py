@@ -0,0 +1,389 @@
+from __future__ import annotations
+
+import time
+from collections import Counter
+from itertools import count
+from threading import RLock
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import Union
+
+import numpy as np
+from cognite.client.data_classes import Asset
+from cognite.client.data_classes import AssetList
+from cognite.client.data_classes import Datapoints
+from cognite.client.data_classes import DatapointsList
+from cognite.client.data_classes import DataSet
+from cognite.client.data_classes import Row
+from cognite.client.data_classes import RowList
+from cognite.client.data_classes import TimeSeries
+from cognite.client.data_classes import TimeSeriesList
+from cognite.client.exceptions import CogniteAPIError
+from cognite.client.exceptions import CogniteDuplicatedError
+from cognite.client.exceptions import CogniteNotFoundError
+from cognite.client.utils._time import granularity_to_ms
+from cognite.client.utils._time import timestamp_to_ms
+
+from .synthetic import SyntheticFactory
+
+DEFAULT_DATA_SETS = ("uc:001:oee:ds", "src:002:opcua:ds")
+STATE_DB = "src:002:opcua:db:state"
+STATE_TABLE = "timeseries_datapoints_states"
+WATERMARK_TABLE = "timeseries_datapoints_watermark"
+
+AGGREGATES = {
+    "sum": np.add.reduceat,
+    "min": np.minimum.reduceat,
+    "max": np.maximum.reduceat,
+}
+
+
+class FakeCogniteClient:
+    """
+    In-process stand-in for the parts of CogniteClient used by the functions in this repository: time series,
+    datapoints (raw, aggregates and latest), assets, data sets and RAW.
+
+    Args:
+        factory: synthetic factory whose equipment assets are created up front
+        prefill: also create the factory input time series, serve the factory data as their datapoints for the
+            prefill_days before now, and write matching extractor states and watermark
+        prefill_days: length of the prefilled history
+        now: end of the prefilled history in ms. Defaults to the current minute
+        latency: seconds every API call sleeps before it is served
+        data_sets: external ids of the data sets that exist up front
+    """
+
+    def __init__(
+        self,
+        factory: Optional[SyntheticFactory] = None,
+        prefill: bool = False,
+        prefill_days: float = 30,
+        now: Optional[int] = None,
+        latency: float = 0.0,
+        data_sets: Sequence[str] = DEFAULT_DATA_SETS,
+    ):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self.lock = RLock()
+        self._ids = count(1)
+
+        self.timeseries_store: Dict[str, TimeSeries] = {}
+        self.datapoints_store: Dict[str, Dict[int, float]] = {}
+        self.asset_store: Dict[str, Asset] = {}
+        self.data_set_store: Dict[str, DataSet] = {}
+        self.raw_store: Dict[str, Dict[str, Dict[str, Dict[str, Any]]]] = {}
+
+        self.time_series = TimeSeriesAPI(self)
+        self.datapoints = self.time_series.data
+        self.assets = AssetsAPI(self)
+        self.data_sets = DataSetsAPI(self)
+        self.raw = RawAPI(self)
+
+        for external_id in data_sets:
+            self.data_set_store[external_id] = DataSet(id=self.next_id(), external_id=external_id, name=external_id)
+
+        self.factory = factory
+        self.prefill_range: Optional[Tuple[int, int]] = None
+        if factory is None:
+            return
+        for site in factory.sites:
+            for item in factory.equipment(site):
+                self.asset_store[item] = Asset(id=self.next_id(), external_id=item, name=item)
+        if prefill:
+            now = now if now is not None else int(time.time() // 60 * 60_000)
+            self.prefill_range = (now - int(prefill_days * 86_400_000), now)
+            for ts in factory.timeseries():
+                self.timeseries_store[ts["external_id"]] = TimeSeries(
+                    id=self.next_id(),
+                    external_id=ts["external_id"],
+                    name=ts["name"],
+                    metadata=ts["metadata"],
+                    is_step=ts["is_step"],
+                )
+            self.raw_store.setdefault(STATE_DB, {})[STATE_TABLE] = {
+                ts["external_id"]: {"low": self.prefill_range[0], "high": now - factory.interval_ms}
+                for ts in factory.timeseries()
+            }
+            self.raw_store[STATE_DB][WATERMARK_TABLE] = {
+                "watermark": {"high": now - factory.interval_ms, "states": len(factory.timeseries())}
+            }
+
+    def next_id(self) -> int:
+        return next(self._ids)
+
+    def call(self, name: str) -> None:
+        """
+        Count an API call and apply the configured latency.
+        """
+        with self.lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def series(self, external_id: str, start: int, end: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        All datapoints of a time series between start (inclusive) and end (exclusive), sorted by timestamp.
+        """
+        timestamps = np.empty(0, dtype=np.int64)
+        values = np.empty(0, dtype=np.float64)
+        if self.prefill_range and external_id in self.timeseries_store and self.factory is not None:
+            low, high = max(start, self.prefill_range[0]), min(end, self.prefill_range[1])
+            if low < high:
+                timestamps, values = self.factory.datapoints(external_id, low, high)
+
+        with self.lock:
+            stored = [(t, v) for t, v in self.datapoints_store.get(external_id, {}).items() if start <= t < end]
+        if stored:
+            stored_timestamps = np.array([t for t, _ in stored], dtype=np.int64)
+            keep = ~np.isin(timestamps, stored_timestamps)
+            timestamps = np.concatenate((timestamps[keep], stored_timestamps))
+            values = np.concatenate((values[keep], np.array([v for _, v in stored], dtype=np.float64)))
+            order = np.argsort(timestamps, kind="stable")
+            timestamps, values = timestamps[order], values[order]
+        return timestamps, values
+
+
+class TimeSeriesAPI:
+    def __init__(self, client: FakeCogniteClient):
+        self._client = client
+        self.data = DatapointsAPI(client)
+
+    def list(
+        self,
+        data_set_ids: Optional[List[int]] = None,
+        metadata: Optional[Dict[str, str]] = None,
+        limit: Optional[int] = 25,
+        **kwargs,
+    ) -> TimeSeriesList:
+        self._client.call("time_series.list")
+        with self._client.lock:
+            items = [
+                ts
+                for ts in self._client.timeseries_store.values()
+                if (not data_set_ids or ts.data_set_id in data_set_ids)
+                and all((ts.metadata or {}).get(k) == v for k, v in (metadata or {}).items())
+            ]
+        return TimeSeriesList(items if limit is None or limit == -1 else items[:limit])
+
+    def retrieve(self, id: Optional[int] = None, external_id: Optional[str] = None) -> Optional[TimeSeries]:
+        self._client.call("time_series.retrieve")
+        with self._client.lock:
+            for ts in self._client.timeseries_store.values():
+                if (id is not None and ts.id == id) or (external_id is not None and ts.external_id == external_id):
+                    return ts
+        return None
+
+    def retrieve_multiple(
+        self, ids: Optional[List[int]] = None, external_ids: Optional[List[str]] = None, ignore_unknown_ids=False
+    ) -> TimeSeriesList:
+        self._client.call("time_series.retrieve_multiple")
+        with self._client.lock:
+            found = [self._client.timeseries_store[e] for e in external_ids or [] if e in self._client.timeseries_store]
+            missing = [{"externalId": e} for e in external_ids or [] if e not in self._client.timeseries_store]
+        if missing and not ignore_unknown_ids:
+            raise CogniteNotFoundError(not_found=missing)
+        return TimeSeriesList(found)
+
+    def create(self, time_series: Union[TimeSeries, List[TimeSeries]]) -> Union[TimeSeries, TimeSeriesList]:
+        self._client.call("time_series.create")
+        items = time_series if isinstance(time_series, list) else [time_series]
+        with self._client.lock:
+            duplicated = [
+                {"externalId": ts.external_id} for ts in items if ts.external_id in self._client.timeseries_store
+            ]
+            if duplicated:
+                raise CogniteDuplicatedError(duplicated=duplicated)
+            for ts in items:
+                ts.id = self._client.next_id()
+                self._client.timeseries_store[ts.external_id] = ts
+        return TimeSeriesList(items) if isinstance(time_series, list) else items[0]
+
+
+class DatapointsAPI:
+    def __init__(self, client: FakeCogniteClient):
+        self._client = client
+
+    def _known(self, external_ids: List[str], ignore_unknown_ids: bool) -> List[str]:
+        with self._client.lock:
+            missing = [e for e in external_ids if e not in self._client.timeseries_store]
+        if missing and not ignore_unknown_ids:
+            raise CogniteNotFoundError(not_found=[{"externalId": e} for e in missing])
+        return [e for e in external_ids if e not in missing]
+
+    def retrieve(
+        self,
+        external_id: Union[str, List[str]],
+        start: Union[int, float, str],
+        end: Union[int, float, str],
+        aggregates: Optional[List[str]] = None,
+        granularity: Optional[str] = None,
+        ignore_unknown_ids: bool = False,
+        **kwargs,
+    ) -> Union[Datapoints, DatapointsList]:
+        self._client.call("datapoints.retrieve")
+        start, end = timestamp_to_ms(start), timestamp_to_ms(end)
+        result = []
+        for ext_id in self._known([external_id] if isinstance(external_id, str) else external_id, ignore_unknown_ids):
+            timestamps, values = self._client.series(ext_id, start, end)
+            if not aggregates:
+                result.append(Datapoints(external_id=ext_id, timestamp=timestamps.tolist(), value=values.tolist()))
+                continue
+
+            buckets = timestamps // granularity_to_ms(granularity) * granularity_to_ms(granularity)
+            bucket_starts, offsets, counts = np.unique(buckets, return_index=True, return_counts=True)
+            computed = {}
+            for aggregate in aggregates:
+                if aggregate == "count":
+                    computed[aggregate] = counts.tolist()
+                elif aggregate == "average":
+                    computed[aggregate] = (np.add.reduceat(values, offsets) / counts).tolist() if len(counts) else []
+                else:
+                    computed[aggregate] = AGGREGATES[aggregate](values, offsets).tolist() if len(counts) else []
+            result.append(Datapoints(external_id=ext_id, timestamp=bucket_starts.tolist(), **computed))
+        return result[0] if isinstance(external_id, str) else DatapointsList(result)
+
+    def retrieve_latest(
+        self,
+        external_id: Union[str, List[str]],
+        before: Optional[Union[int, float, str]] = None,
+        ignore_unknown_ids: bool = False,
+    ) -> Union[Datapoints, DatapointsList]:
+        self._client.call("datapoints.retrieve_latest")
+        before = timestamp_to_ms(before) if before is not None else 2**62
+        result = []
+        for ext_id in self._known([external_id] if isinstance(external_id, str) else external_id, ignore_unknown_ids):
+            timestamps, values = self._client.series(ext_id, -(2**62), before)
+            result.append(
+                Datapoints(external_id=ext_id, timestamp=timestamps[-1:].tolist(), value=values[-1:].tolist())
+            )
+        return result[0] if isinstance(external_id, str) else DatapointsList(result)
+
+    def insert(self, datapoints: List, external_id: str) -> None:
+        self.insert_multiple([{"externalId": external_id, "datapoints": datapoints}])
+
+    def insert_multiple(self, datapoints: List[Dict[str, Any]]) -> None:
+        self._client.call("datapoints.insert_multiple")
+        with self._client.lock:
+            missing = [d["externalId"] for d in datapoints if d["externalId"] not in self._client.timeseries_store]
+            if missing:
+                raise CogniteNotFoundError(
+                    not_found=[{"externalId": e} for e in missing],
+                    failed=[{"externalId": d["externalId"]} for d in datapoints],
+                )
+            for d in datapoints:
+                store = self._client.datapoints_store.setdefault(d["externalId"], {})
+                for dp in d["datapoints"]:
+                    if isinstance(dp, dict):
+                        store[timestamp_to_ms(dp["timestamp"])] = dp["value"]
+                    else:
+                        store[timestamp_to_ms(dp[0])] = dp[1]
+
+
+class AssetsAPI:
+    def __init__(self, client: FakeCogniteClient):
+        self._client = client
+
+    def retrieve_multiple(
+        self, ids: Optional[List[int]] = None, external_ids: Optional[List[str]] = None, ignore_unknown_ids=False
+    ) -> AssetList:
+        self._client.call("assets.retrieve_multiple")
+        with self._client.lock:
+            found = [self._client.asset_store[e] for e in external_ids or [] if e in self._client.asset_store]
+            missing = [{"externalId": e} for e in external_ids or [] if e not in self._client.asset_store]
+        if missing and not ignore_unknown_ids:
+            raise CogniteNotFoundError(not_found=missing)
+        return AssetList(found)
+
+
+class DataSetsAPI:
+    def __init__(self, client: FakeCogniteClient):
+        self._client = client
+
+    def retrieve(self, id: Optional[int] = None, external_id: Optional[str] = None) -> Optional[DataSet]:
+        self._client.call("data_sets.retrieve")
+        for data_set in self._client.data_set_store.values():
+            if (id is not None and data_set.id == id) or (
+                external_id is not None and data_set.external_id == external_id
+            ):
+                return data_set
+        return None
+
+
+class RawAPI:
+    def __init__(self, client: FakeCogniteClient):
+        self.databases = RawDatabasesAPI(client)
+        self.tables = RawTablesAPI(client)
+        self.rows = RawRowsAPI(client)
+
+
+class RawDatabasesAPI:
+    def __init__(self, client: FakeCogniteClient):
+        self._client = client
+
+    def create(self, name: str) -> None:
+        self._client.call("raw.databases.create")
+        with self._client.lock:
+            if name in self._client.raw_store:
+                raise CogniteAPIError(f"Database {name} already exists", code=400)
+            self._client.raw_store[name] = {}
+
+
+class RawTablesAPI:
+    def __init__(self, client: FakeCogniteClient):
+        self._client = client
+
+    def create(self, db_name: str, name: str) -> None:
+        self._client.call("raw.tables.create")
+        with self._client.lock:
+            if db_name not in self._client.raw_store:
+                raise CogniteAPIError(f"Database {db_name} not found", code=404)
+            if name in self._client.raw_store[db_name]:
+                raise CogniteAPIError(f"Table {name} already exists", code=400)
+            self._client.raw_store[db_name][name] = {}
+
+
+class RawRowsAPI:
+    def __init__(self, client: FakeCogniteClient):
+        self._client = client
+
+    def _table(self, db_name: str, table_name: str, ensure_parent: bool = False) -> Dict[str, Dict[str, Any]]:
+        if ensure_parent:
+            return self._client.raw_store.setdefault(db_name, {}).setdefault(table_name, {})
+        if table_name not in self._client.raw_store.get(db_name, {}):
+            raise CogniteAPIError(f"Table {db_name}/{table_name} not found", code=404)
+        return self._client.raw_store[db_name][table_name]
+
+    def list(self, db_name: str, table_name: str, limit: Optional[int] = 25, **kwargs) -> RowList:
+        self._client.call("raw.rows.list")
+        with self._client.lock:
+            rows = [Row(key=key, columns=dict(columns)) for key, columns in self._table(db_name, table_name).items()]
+        return RowList(rows if limit is None or limit == -1 else rows[:limit])
+
+    def retrieve(self, db_name: str, table_name: str, key: str) -> Optional[Row]:
+        self._client.call("raw.rows.retrieve")
+        with self._client.lock:
+            columns = self._table(db_name, table_name).get(key)
+        return Row(key=key, columns=dict(columns)) if columns is not None else None
+
+    def insert(
+        self, db_name: str, table_name: str, row: Union[Dict[str, Dict], Row, List[Row]], ensure_parent: bool = False
+    ) -> None:
+        self._client.call("raw.rows.insert")
+        if isinstance(row, Row):
+            row = [row]
+        rows = {r.key: r.columns for r in row} if isinstance(row, list) else row
+        with self._client.lock:
+            table = self._table(db_name, table_name, ensure_parent)
+            for key, columns in rows.items():
+                table[key] = dict(columns)
+
+    def delete(self, db_name: str, table_name: str, key: Union[str, List[str]]) -> None:
+        self._client.call("raw.rows.delete")
+        with self._client.lock:
+            table = self._table(db_name, table_name)
+            for k in [key] if isinstance(key, str) else key:
+                table.pop(k, None)
@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import Counter
+from threading import Lock
+from typing import Any
+from typing import Dict
+from typing import Sequence
+from typing import Tuple
+from typing import Union
+from urllib.parse import parse_qs
+from urllib.parse import urlencode
+from urllib.parse import urlparse
+
+import arrow
+import ujson
+from requests import PreparedRequest
+from requests import Response
+from requests.adapters import BaseAdapter
+
+from .synthetic import SyntheticFactory
+
+
+def _to_ms(timestamp: Union[str, float]) -> int:
+    """UNIX timestamp in seconds or 'YYYY-MM-DD HH:MM', as accepted by the Ice Cream Factory API."""
+    try:
+        return int(float(timestamp) * 1000)
+    except ValueError:
+        return int(arrow.get(timestamp, "YYYY-MM-DD HH:mm", tzinfo="UTC").float_timestamp * 1000)
+
+
+class FakeIceCreamFactoryAdapter(BaseAdapter):
+    """
+    Transport adapter serving the Ice Cream Factory API endpoints used by the extractor from synthetic data.
+
+    Mount it on the session of an IceCreamFactoryAPI with install(), or give an AsyncIceCreamFactoryAPI a session
+    answered by it with install_async(), to run the extractor without network access.
+    The datapoints endpoint accepts several external_id parameters in one request.
+
+    Args:
+        factory: synthetic data to serve
+        latency: seconds every request sleeps before it is answered
+    """
+
+    def __init__(self, factory: SyntheticFactory, latency: float = 0.0):
+        super().__init__()
+        self.factory = factory
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._lock = Lock()
+
+    def install(self, api) -> FakeIceCreamFactoryAdapter:
+        """
+        Route all requests of the given IceCreamFactoryAPI to this adapter.
+        """
+        api.session.mount(api.base_url, self)
+        return self
+
+    def install_async(self, api) -> FakeIceCreamFactoryAdapter:
+        """
+        Route all requests of the given AsyncIceCreamFactoryAPI to this adapter.
+        """
+        api.session = _FakeClientSession(self)
+        return self
+
+    def route(self, url: str) -> Tuple[int, Any]:
+        """
+        Status code and JSON body of the response to a GET request for url.
+        """
+        parsed = urlparse(url)
+        query = parse_qs(parsed.query)
+        endpoint = "/".join(parsed.path.strip("/").split("/")[-2:])
+        with self._lock:
+            self.calls[endpoint] += 1
+
+        if endpoint == "timeseries/oee":
+            return 200, self.factory.timeseries()
+        if endpoint == "datapoints/oee":
+            start, end = _to_ms(query["start"][0]), _to_ms(query["end"][0])
+            body = {}
+            for requested in query["external_id"]:
+                for external_id in self.factory.associated(requested):
+                    timestamps, values = self.factory.datapoints(external_id, start, end)
+                    body[external_id] = [[t / 1000, v] for t, v in zip(timestamps.tolist(), values.tolist())]
+            return 200, body
+        return 404, {"detail": "Not Found"}
+
+    def send(self, request: PreparedRequest, **kwargs) -> Response:
+        if self.latency:
+            time.sleep(self.latency)
+        status_code, body = self.route(request.url)
+        return self._response(request, status_code, body)
+
+    @staticmethod
+    def _response(request: PreparedRequest, status_code: int, body) -> Response:
+        response = Response()
+        response.status_code = status_code
+        response.reason = "OK" if status_code == 200 else "Not Found"
+        response.headers["Content-Type"] = "application/json"
+        response._content = ujson.dumps(body).encode("utf-8")
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self) -> None:
+        pass
+
+
+class _FakeClientResponse:
+    def __init__(self, url: str, status: int, body: Any):
+        self.url = url
+        self.status = status
+        self.headers: Dict[str, str] = {}
+        self._content = ujson.dumps(body).encode("utf-8")
+
+    async def __aenter__(self) -> _FakeClientResponse:
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        pass
+
+    def raise_for_status(self) -> None:
+        if self.status >= 400:
+            raise RuntimeError(f"{self.status} for {self.url}")
+
+    async def read(self) -> bytes:
+        return self._content
+
+
+class _FakeClientSession:
+    """The subset of aiohttp.ClientSession used by AsyncIceCreamFactoryAPI, answered by a FakeIceCreamFactoryAdapter."""
+
+    def __init__(self, adapter: FakeIceCreamFactoryAdapter):
+        self.adapter = adapter
+
+    def get(self, url: str, params: Sequence[Tuple[str, Any]] = ()) -> _FakeRequestContext:
+        return _FakeRequestContext(self.adapter, f"{url}?{urlencode(params)}")
+
+    async def close(self) -> None:
+        pass
+
+
+class _FakeRequestContext:
+    def __init__(self, adapter: FakeIceCreamFactoryAdapter, url: str):
+        self.adapter = adapter
+        self.url = url
+
+    async def __aenter__(self) -> _FakeClientResponse:
+        if self.adapter.latency:
+            await asyncio.sleep(self.adapter.latency)
+        return _FakeClientResponse(self.url, *self.adapter.route(self.url))
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        pass
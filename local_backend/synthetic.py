@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import zlib
+from typing import Dict
+from typing import List
+from typing import Sequence
+from typing import Tuple
+
+import numpy as np
+
+DEFAULT_SITES = [
+    "Oslo",
+    "Hannover",
+    "Nuremberg",
+    "Marseille",
+    "Houston",
+    "Sao Paulo",
+    "Kuala Lumpur",
+    "Chicago",
+    "Rotterdam",
+    "London",
+]
+
+# The Ice Cream Factory API returns the second series of each pair when asked for the first one
+ASSOCIATED_TYPES = {"count": ["count", "good"], "planned_status": ["planned_status", "status"]}
+TYPES = ("count", "good", "status", "planned_status")
+
+
+def _noise(key: int, x: np.ndarray) -> np.ndarray:
+    """Deterministic uniform values in [0, 1) for every element of x (splitmix64 of x mixed with key)."""
+    with np.errstate(over="ignore"):
+        z = x.astype(np.uint64) + np.uint64(key & 0xFFFFFFFFFFFFFFFF)
+        z = z * np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z = z ^ (z >> np.uint64(31))
+    return (z >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+
+class SyntheticFactory:
+    """
+    Deterministic synthetic Ice Cream Factory data. The value of a datapoint only depends on the seed, the external id
+    and the timestamp, so any time range can be generated independently and always gives the same result.
+
+    Args:
+        sites: sites to generate equipment for
+        equipment_per_site: number of machines per site, each with count, good, status and planned_status series
+        seed: seed mixed into every generated value
+        interval_seconds: spacing between generated datapoints
+    """
+
+    def __init__(
+        self,
+        sites: Sequence[str] = DEFAULT_SITES,
+        equipment_per_site: int = 2,
+        seed: int = 0,
+        interval_seconds: int = 60,
+    ):
+        self.sites = list(sites)
+        self.equipment_per_site = equipment_per_site
+        self.seed = seed
+        self.interval_ms = interval_seconds * 1000
+
+    def equipment(self, site: str) -> List[str]:
+        prefix = "".join(word[:3] for word in site.split()).upper()
+        return [f"{prefix}PM{i:03d}" for i in range(1, self.equipment_per_site + 1)]
+
+    def timeseries(self) -> List[Dict]:
+        """
+        Time series of all sites in the format of the Ice Cream Factory API timeseries endpoint.
+        """
+        return [
+            {
+                "name": f"{item} {typ}",
+                "external_id": f"{item}:{typ}",
+                "description": f"{typ} of {item} at {site}",
+                "is_string": False,
+                "is_step": typ.endswith("status"),
+                "metadata": {"site": site, "type": typ},
+            }
+            for site in self.sites
+            for item in self.equipment(site)
+            for typ in TYPES
+        ]
+
+    def associated(self, external_id: str) -> List[str]:
+        """
+        External ids returned by the API when asked for external_id.
+        """
+        item, typ = external_id.split(":", 1)
+        return [f"{item}:{t}" for t in ASSOCIATED_TYPES.get(typ, [typ])]
+
+    def datapoints(self, external_id: str, start: int, end: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Datapoints of a time series between start (inclusive) and end (exclusive), both in ms.
+
+        Returns:
+            Timestamps (int64 ms) and values (float64)
+        """
+        first = -(-int(start) // self.interval_ms)
+        slots = np.arange(first, max(first, -(-int(end) // self.interval_ms)), dtype=np.int64)
+        item, typ = external_id.split(":", 1)
+        key = zlib.crc32(item.encode()) ^ (self.seed << 32)
+        per_hour = max(1, 3_600_000 // self.interval_ms)
+
+        planned = _noise(key + 1, slots // (4 * per_hour)) > 0.05
+        running = planned & (_noise(key + 2, slots // per_hour) > 0.1)
+        count = np.where(running, 15 + np.floor(_noise(key + 3, slots) * 6), 0.0)
+        values = {
+            "planned_status": planned.astype(np.float64),
+            "status": running.astype(np.float64),
+            "count": count,
+            "good": np.maximum(count - np.floor(_noise(key + 4, slots) * 3), 0.0),
+        }[typ]
+        return slots * self.interval_ms, values
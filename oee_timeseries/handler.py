@@ -1,154 +1,277 @@
 from __future__ import annotations
 
-import random
 from concurrent.futures import Future
 from concurrent.futures import ThreadPoolExecutor
-from math import floor
 from typing import Any
 from typing import Dict
+from typing import Iterator
 from typing import List
+from typing import Optional
 from typing import Tuple
 
-import arrow
 import numpy as np
-from arrow import Arrow
 from cognite.client import CogniteClient
-from retry import retry
+from cognite.client.exceptions import CogniteAPIError
+from scheduler import SCHEDULER
+from tools import DatapointsUploader
 from tools import discover_datapoints
 from tools import get_timeseries_for_site
-from tools import insert_datapoints
+from tools import KNOWN_TIMESERIES
+from tools import METRICS
+from tools import retrieve_datapoints
+
+from common.timegrid import DAY_MS
+from common.timegrid import floor_ms
+from common.timegrid import grid
+from common.timegrid import isoformat
+from common.timegrid import MINUTE_MS
+from common.timegrid import Span
+from common.timegrid import spans
 
 CYCLE_TIME = 3
+OEE_STATE_DB = "src:002:opcua:db:state"
+OEE_STATE_TABLE = "oee_timeseries_states"
+# Single row the extractor state store keeps with the latest datapoint timestamp of all time series
+EXTRACTOR_WATERMARK_TABLE = "timeseries_datapoints_watermark"
+EXTRACTOR_WATERMARK_KEY = "watermark"
 
+# Sites processed at the same time
+SITE_WORKERS = 10
 
-def get_payload(collection: np.array, window: Tuple[Arrow, Arrow]):
-    return [
-        (_timestamp, collection[i])
-        for i, _timestamp in enumerate(
-            range(floor(window[0].float_timestamp * 1000), floor(window[1].float_timestamp * 1000), 60_000)
-        )
-    ]
 
+def get_payload(collection: np.array, window: Span):
+    return list(zip(grid(*window).tolist(), np.asarray(collection).tolist()))
+
+
+def compute_oee(
+    total_items: np.ndarray, good_items: np.ndarray, uptime: np.ndarray, planned_uptime: np.ndarray
+) -> Dict[str, np.ndarray]:
+    """
+    Compute the OEE metrics for all equipment of a site in one pass.
+
+    Args:
+        total_items: count per minute, shaped (equipment, minutes)
+        good_items: good count per minute, shaped (equipment, minutes)
+        uptime: status per minute, shaped (equipment, minutes)
+        planned_uptime: planned status per minute, shaped (equipment, minutes)
+
+    Returns:
+        Arrays of the same shape keyed by metric type (off_spec, quality, performance, availability, oee)
+    """
+    ideal_rate = 60.0 / CYCLE_TIME  # we know that ideal production should be 1 per CYCLE_TIME sec.
+
+    off_spec = np.subtract(total_items, good_items)
+    quality = np.divide(good_items, total_items, out=np.zeros_like(good_items), where=total_items != 0)
+    performance = np.divide(total_items, uptime, out=np.zeros_like(total_items), where=uptime != 0) / ideal_rate
+    availability = np.divide(uptime, planned_uptime, out=np.zeros_like(uptime), where=planned_uptime != 0)
+    oee = performance * availability * quality
+
+    return {
+        "off_spec": off_spec,
+        "quality": quality,
+        "performance": performance,
+        "availability": availability,
+        "oee": oee,
+    }
+
+
+def get_state(client, db_name, table_name, watermark_table: Optional[str] = EXTRACTOR_WATERMARK_TABLE):
+    """
+    Latest datapoint timestamp (ms) extracted for any time series. Read from the watermark row maintained by the
+    extractor state store, all extractor states in table_name are only read when that row does not exist (yet).
+    """
+    if watermark_table:
+        try:
+            row = client.raw.rows.retrieve(db_name, watermark_table, EXTRACTOR_WATERMARK_KEY)
+        except CogniteAPIError as e:
+            if e.code != 404:
+                raise
+            row = None
+        if row is not None and row.columns.get("high") is not None:
+            return row.columns["high"]
+
+    print(f"No watermark in {db_name}/{watermark_table}, reading all states in {db_name}/{table_name}")
+    rows = client.raw.rows.list(db_name, table_name, limit=None)
+    return max(
+        row.columns["high"]
+        for row in rows
+        if row.columns.get("low") is not None and row.columns.get("high") is not None
+    )
 
-def get_state(client, db_name, table_name):
-    state = client.raw.rows.list(db_name, table_name, limit=None).to_pandas().dropna()
-    return max(state["high"])
 
+def get_watermarks(client, db_name, table_name) -> Dict[str, Dict[str, int]]:
+    """
+    Read the last computed timestamp (ms, exclusive) of every equipment, keyed by site.
+    """
+    try:
+        rows = client.raw.rows.list(db_name, table_name, limit=None)
+    except CogniteAPIError as e:
+        if e.code == 404:
+            return {}
+        raise
+    return {row.key: row.columns for row in rows}
 
-def handle(client: CogniteClient, data: Dict[str, Any]) -> None:
+
+def set_watermarks(client, db_name, table_name, watermarks: Dict[str, Dict[str, int]]) -> None:
+    if watermarks:
+        client.raw.rows.insert(db_name, table_name, watermarks, ensure_parent=True)
+
+
+def handle(client: CogniteClient, data: Dict[str, Any]) -> Dict[str, Any]:
     print(f"Input data of function: {data}")
+    METRICS.reset()
 
     # Input data
     lookback_minutes = data.get("lookback_minutes", 1440)
     data_set_external_id = data.get("data_set_external_id", "uc:001:oee:ds")
     sites = data.get("sites")
+    # Output time series listings are reused across warm invocations only when a cache TTL (seconds) is given
+    KNOWN_TIMESERIES.ttl = data.get("timeseries_cache_ttl")
+    if KNOWN_TIMESERIES.ttl is None:
+        KNOWN_TIMESERIES.clear()
     # "now" variable specifies the time upto which the OEE numbers will be calculated
     # We want to balance the data freshness here
-    the_latest = get_state(client, db_name="src:002:opcua:db:state", table_name="timeseries_datapoints_states")
-    now = arrow.get(the_latest, tzinfo="UTC").floor("minutes").shift(minutes=-10)  # -10 minutes as a safety margin
-    data_set = client.data_sets.retrieve(external_id=data_set_external_id)
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        futures: List[Future] = []
-        for _range in Arrow.span_range("day", now.shift(minutes=-lookback_minutes), now, exact=True):
-            for site in sites:
-                futures.append(
-                    executor.submit(
-                        process_site,
-                        client,
-                        data_set,
-                        round((_range[1] - _range[0]).total_seconds() / 60),
-                        site,
-                        _range,
-                    )
-                )
-
-        for f in futures:
-            f.result()
-
-
-@retry(tries=5, jitter=random.randint(5, 10), delay=random.randint(5, 15))
-def process_site(client, data_set, lookback_minutes, site, window):
-    discovered_ts = get_timeseries_for_site(client, site)
-    discovered_points = discover_datapoints(client, discovered_ts, window)
-    equipment = {p.split(":")[0] for p in discovered_points.keys()}
-    off_spec_dps = []
-    performance_dps = []
-    availability_dps = []
-    quality_dps = []
-    oee_dps = []
+    with METRICS.time("cdf_read"):
+        the_latest = get_state(client, db_name="src:002:opcua:db:state", table_name="timeseries_datapoints_states")
+    now = floor_ms(int(the_latest)) - 10 * MINUTE_MS  # -10 minutes as a safety margin
+    with METRICS.time("cdf_read"):
+        data_set = client.data_sets.retrieve(external_id=data_set_external_id)
+
+    # In incremental mode only the minutes after the last computed one (minus an overlap for late data) are computed
+    incremental = data.get("incremental", False)
+    overlap_minutes = data.get("overlap_minutes", 10)
+    # Upper bound for concurrent CDF calls, lowered automatically while CDF throttles or slows down
+    SCHEDULER.configure(max_concurrency=data.get("max_concurrency", 10), metrics=METRICS, client=client)
+    # Upper bound for 1 minute aggregates held in memory at a time by all sites together. A retrieved datapoint takes
+    # about 100 bytes at the peak of a retrieval (SDK lists plus our arrays), so the default peaks around 200 MB.
+    # Unless chunk_days (days retrieved at a time per site) is given, chunks are sized from this budget
+    datapoint_budget = data.get("datapoint_budget", 2_000_000)
+    chunk_days = data.get("chunk_days")
+    with METRICS.time("cdf_read"):
+        watermarks = get_watermarks(client, OEE_STATE_DB, OEE_STATE_TABLE) if incremental else {}
+
+    # Latest status values before each window start, shared by all sites and retries of this run
+    seed_cache: Dict[Tuple[str, int], Tuple[list, list]] = {}
+
+    site_workers = min(SITE_WORKERS, len(sites)) or 1
+    with DatapointsUploader(client, data_set) as uploader, ThreadPoolExecutor(max_workers=site_workers) as executor:
+        futures: Dict[str, Future] = {}
+        for site in sites:
+            start = now - lookback_minutes * MINUTE_MS
+            if watermarks.get(site):
+                resume_at = min(watermarks[site].values()) - overlap_minutes * MINUTE_MS
+                start = max(start, floor_ms(resume_at))
+            if start >= now:
+                continue
+            futures[site] = executor.submit(
+                process_site,
+                client,
+                uploader,
+                site,
+                spans(start, now, DAY_MS, anchor=start),
+                seed_cache,
+                chunk_days,
+                datapoint_budget // site_workers,
+            )
+
+        computed: Dict[str, Dict[str, int]] = {}
+        for site, f in futures.items():
+            computed[site] = {item: now for item in f.result()}
+
+    if incremental:
+        # Only persisted once every window is uploaded, so a failed run resumes from the previous watermark
+        set_watermarks(client, OEE_STATE_DB, OEE_STATE_TABLE, computed)
+
+    summary = METRICS.summary()
+    print(f"Metrics per stage: {summary}")
+    # Optionally also exported in the Prometheus text format, as a node exporter textfile and/or to a pushgateway
+    try:
+        METRICS.export(textfile=data.get("metrics_textfile"), pushgateway_url=data.get("metrics_pushgateway_url"))
+    except Exception as e:
+        print(f"Could not export metrics: {e}")
+    return summary
+
+
+def process_site(
+    client,
+    uploader,
+    site,
+    windows: List[Span],
+    seed_cache=None,
+    chunk_days: Optional[int] = None,
+    max_datapoints: Optional[int] = None,
+) -> List[str]:
+    """
+    Compute OEE for every window (ms, half-open) of a site. Time series are discovered once, datapoints are retrieved
+    a chunk of windows at a time and handed to the uploader before the next chunk is retrieved.
+
+    Args:
+        chunk_days: windows per chunk
+        max_datapoints: when chunk_days is None, as many windows per chunk as fit this many 1 minute aggregates of all
+            time series of the site, at least one. All windows at once when both are None
+
+    Returns:
+        External ids of the equipment OEE was computed for
+    """
+    with METRICS.time("cdf_read"):
+        discovered_ts = get_timeseries_for_site(client, site)
+    if not discovered_ts:
+        return []
+    if chunk_days is None and max_datapoints is not None:
+        chunk_days = max(1, max_datapoints // (len(discovered_ts) * DAY_MS // MINUTE_MS))
+    equipment = set()
+    for chunk in chunked(windows, chunk_days or len(windows)):
+        with METRICS.time("cdf_read"):
+            retrieved = retrieve_datapoints(client, discovered_ts, chunk[0][0], chunk[-1][1])
+        METRICS.count("cdf_read", "datapoints", sum(len(v) for v in retrieved.values()))
+        for window in chunk:
+            equipment.update(process_window(client, uploader, discovered_ts, retrieved, window, seed_cache))
+    return sorted(equipment)
+
+
+def chunked(lst: List, n: int) -> Iterator[List]:
+    """Yield successive n-sized chunks from lst."""
+    for i in range(0, len(lst), n):
+        yield lst[i : i + n]
+
+
+def process_window(client, uploader, discovered_ts, retrieved, window, seed_cache) -> List[str]:
+    with METRICS.time("gap_fill"):
+        discovered_points = discover_datapoints(client, discovered_ts, window, retrieved, seed_cache)
+    equipment = sorted({p.split(":")[0] for p in discovered_points.keys()})
+    if not equipment:
+        return []
+
+    inputs = {typ: [] for typ in ("count", "good", "status", "planned_status")}
     for item in equipment:
-        total_items = np.array(discovered_points.get(f"{item}:count"))[:, 1]
-        good_items = np.array(discovered_points.get(f"{item}:good"))[:, 1]
-        uptime = np.array(discovered_points.get(f"{item}:status"))[:, 1]
-        planned_uptime = np.array(discovered_points.get(f"{item}:planned_status"))[:, 1]
-
-        if (
-            len(total_items) != len(good_items)
-            or len(total_items) != len(uptime)
-            or len(total_items) != len(planned_uptime)
-        ):
+        for typ, values in inputs.items():
+            values.append(np.array(discovered_points.get(f"{item}:{typ}"))[:, 1])
+
+        if len({len(values[-1]) for values in inputs.values()}) != 1:
             # We expect ALL dependent timeseries to have the exact same number of datapoints
             # for the specified time range for the calculation to execute.
             # Fix: run backfill / frontfill to make sure that “sensor” data is in place before you run OEE
             raise RuntimeError(
                 f"""{item}: Unable to retrieve datapoints for all required OEE timeseries (count, good, status, planned_status)
-                between {window}. Ensure that data is available for the time range specified."""
+                between {isoformat(window[0])} and {isoformat(window[1])}.
+                Ensure that data is available for the time range specified."""
             )
 
-        bad_items = np.subtract(total_items, good_items)
-        quality = np.divide(good_items, total_items, out=np.zeros_like(good_items), where=total_items != 0)
-        ideal_rate = np.full(lookback_minutes, 60.0 / 3.0)  # we know that ideal production should be 3 per sec.
-
-        off_spec_dps.extend(
-            [
-                {
-                    "externalId": f"{item}:off_spec",
-                    "datapoints": get_payload(bad_items, window),
-                }
-            ]
-        )
-
-        quality_dps.extend(
-            [
-                {
-                    "externalId": f"{item}:quality",
-                    "datapoints": get_payload(quality, window),
-                }
-            ]
+    with METRICS.time("compute"):
+        metrics = compute_oee(
+            total_items=np.stack(inputs["count"]),
+            good_items=np.stack(inputs["good"]),
+            uptime=np.stack(inputs["status"]),
+            planned_uptime=np.stack(inputs["planned_status"]),
         )
-
-        perf1 = np.divide(total_items, uptime, out=np.zeros_like(total_items), where=uptime != 0)
-        performance = np.divide(perf1, ideal_rate, out=np.zeros_like(perf1), where=ideal_rate != 0)
-        performance_dps.extend(
-            [
-                {
-                    "externalId": f"{item}:performance",
-                    "datapoints": get_payload(performance, window),
-                }
+        payloads = {
+            typ: [
+                {"externalId": f"{item}:{typ}", "datapoints": get_payload(values, window)}
+                for item, values in zip(equipment, metrics[typ])
             ]
-        )
-
-        availability = np.divide(uptime, planned_uptime, out=np.zeros_like(uptime), where=planned_uptime != 0)
-        availability_dps.extend(
-            [
-                {
-                    "externalId": f"{item}:availability",
-                    "datapoints": get_payload(availability, window),
-                }
-            ]
-        )
-
-        oee = np.multiply(np.multiply(performance, availability), quality)
-        oee_dps.extend(
-            [
-                {
-                    "externalId": f"{item}:oee",
-                    "datapoints": get_payload(oee, window),
-                }
-            ]
-        )
-    insert_datapoints(client, performance_dps, "performance", data_set)
-    insert_datapoints(client, quality_dps, "quality", data_set)
-    insert_datapoints(client, availability_dps, "availability", data_set)
-    insert_datapoints(client, off_spec_dps, "off_spec", data_set)
-    insert_datapoints(client, oee_dps, "oee", data_set)
+            for typ in ("performance", "quality", "availability", "off_spec", "oee")
+        }
+    METRICS.count("compute", "datapoints", sum(values.size for values in metrics.values()))
+    for typ, payload in payloads.items():
+        uploader.add(payload, typ)
+    return equipment
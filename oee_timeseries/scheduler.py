@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import random
+from threading import Condition
+from time import monotonic
+from time import sleep
+from typing import Any
+from typing import Callable
+from typing import Optional
+
+from cognite.client import CogniteClient
+from cognite.client.exceptions import CogniteAPIError
+from cognite.client.exceptions import CogniteConnectionError
+from cognite.client.exceptions import CogniteReadTimeout
+
+from common.metrics import Metrics
+
+
+class AdaptiveScheduler:
+    """
+    Limits how many CDF calls run at the same time and retries failed calls one by one.
+
+    The limit grows slowly while calls are fast and is halved when CDF throttles, fails transiently or answers slower
+    than target_latency, so concurrent site tasks back off together instead of retrying whole tasks. Call latencies,
+    retries and backoffs are recorded in the metrics given to configure(), under the "cdf" stage.
+
+    The Cognite SDK retries throttled and failed requests itself too, up to 10 times with backoff, while the call
+    holds its slot. That multiplies the attempts per call and hides throttling from the limit, so configure() lowers
+    the SDK retries of the client to sdk_max_retries.
+
+    Args:
+        max_concurrency: upper bound for concurrent calls
+        min_concurrency: lower bound for concurrent calls
+        target_latency: seconds above which a call counts as a sign of overload
+        tries: attempts per call
+        delay: initial backoff in seconds, doubled for every retry and randomized by up to 100%
+        max_delay: upper bound for the backoff in seconds
+        sdk_max_retries: retries per request left to the Cognite SDK, for short blips
+    """
+
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+    def __init__(
+        self,
+        max_concurrency: int = 10,
+        min_concurrency: int = 1,
+        target_latency: float = 10.0,
+        tries: int = 5,
+        delay: float = 1.0,
+        max_delay: float = 30.0,
+        sdk_max_retries: int = 1,
+    ):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.target_latency = target_latency
+        self.tries = tries
+        self.delay = delay
+        self.max_delay = max_delay
+        self.sdk_max_retries = sdk_max_retries
+        self.limit = float(max_concurrency)
+        self.metrics: Optional[Metrics] = None
+        self._in_flight = 0
+        self._cond = Condition()
+
+    def configure(
+        self, max_concurrency: int, metrics: Optional[Metrics] = None, client: Optional[CogniteClient] = None
+    ) -> None:
+        """
+        Set up the scheduler for a run.
+
+        Args:
+            max_concurrency: upper bound for concurrent calls
+            metrics: where call latencies, retries and backoffs are recorded
+            client: client whose calls go through the scheduler, its SDK retries are lowered to sdk_max_retries
+        """
+        with self._cond:
+            self.max_concurrency = max_concurrency
+            self.limit = float(max_concurrency)
+            self.metrics = metrics
+            self._cond.notify_all()
+        if client is not None:
+            limit_sdk_retries(client, self.sdk_max_retries)
+
+    def is_retryable(self, e: Exception) -> bool:
+        if isinstance(e, CogniteAPIError):
+            return e.code in self.RETRY_STATUS_CODES
+        return isinstance(e, (CogniteConnectionError, CogniteReadTimeout))
+
+    def call(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Call fn once a slot is free, retrying transient failures with exponential backoff and jitter.
+        """
+        delay = self.delay
+        for attempt in range(1, self.tries + 1):
+            self._acquire()
+            started = monotonic()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                retryable = self.is_retryable(e)
+                self._release(monotonic() - started, overloaded=retryable)
+                if not retryable or attempt == self.tries:
+                    raise
+                print(f"{getattr(fn, '__qualname__', fn)} failed ({e}), retry {attempt}/{self.tries - 1}")
+                if self.metrics is not None:
+                    self.metrics.count("cdf", "retries")
+                sleep(delay + random.uniform(0, delay))
+                delay = min(2 * delay, self.max_delay)
+            else:
+                self._release(monotonic() - started, overloaded=False)
+                return result
+
+    def _acquire(self) -> None:
+        with self._cond:
+            while self._in_flight >= max(int(self.limit), self.min_concurrency):
+                self._cond.wait()
+            self._in_flight += 1
+
+    def _release(self, latency: float, overloaded: bool) -> None:
+        if self.metrics is not None:
+            self.metrics.observe("cdf", latency)
+        with self._cond:
+            self._in_flight -= 1
+            if overloaded or latency > self.target_latency:
+                self.limit = max(self.limit / 2, self.min_concurrency)
+                if self.metrics is not None:
+                    self.metrics.count("cdf", "backoffs")
+            else:
+                # roughly one extra slot per round of calls at the current limit
+                self.limit = min(self.limit + 1 / self.limit, self.max_concurrency)
+            self._cond.notify_all()
+
+
+def limit_sdk_retries(client: CogniteClient, max_retries: int) -> None:
+    """
+    Lower the retries per request of all APIs of a Cognite SDK client. The SDK copies its global retry configuration
+    into every API when the client is created, so the client of a function is changed in place.
+
+    Args:
+        client: client to change
+        max_retries: upper bound for retries per request
+    """
+    pending = [client]
+    seen = {id(client)}
+    while pending:
+        api = pending.pop()
+        for name in ("_http_client", "_http_client_with_retry"):
+            config = getattr(getattr(api, name, None), "config", None)
+            for field in ("max_retries_total", "max_retries_status", "max_retries_read", "max_retries_connect"):
+                if hasattr(config, field):
+                    setattr(config, field, min(getattr(config, field), max_retries))
+        for value in vars(api).values():
+            # APIs hold their sub APIs, e.g. time_series.data and raw.rows
+            if hasattr(value, "_http_client") and id(value) not in seen:
+                seen.add(id(value))
+                pending.append(value)
+
+
+SCHEDULER = AdaptiveScheduler()
@@ -1,16 +1,31 @@
 from __future__ import annotations
 
 import re
-from math import floor
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+from threading import Lock
+from time import monotonic
 from typing import Dict
+from typing import Iterable
 from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Set
 from typing import Tuple
 from typing import Union
 
-from arrow import Arrow
+import numpy as np
 from cognite.client import CogniteClient
 from cognite.client.data_classes import DataSet
 from cognite.client.data_classes import TimeSeries
+from cognite.client.exceptions import CogniteDuplicatedError
+from scheduler import SCHEDULER
+
+from common.metrics import Metrics
+from common.timegrid import grid
+from common.timegrid import Span
+from common.timegrid import window_slice
 
 
 def translate_to_a_name(text: str) -> str:
@@ -19,84 +34,307 @@ def translate_to_a_name(text: str) -> str:
     return " ".join(output)
 
 
-def insert_datapoints(
-    client: CogniteClient, datapoints: List[Dict[str, Union[str, int, list]]], typ: str, data_set: DataSet
-) -> None:
+class TimeSeriesRegistry:
     """
-    Takes a list datapoints and uploads data CDF
+    Thread-safe cache of the OEE output time series known to exist in CDF, per data set and type.
+
+    Args:
+        ttl: seconds a loaded listing stays valid. None keeps it until clear() is called
     """
-    avail_ts = client.time_series.list(data_set_ids=[data_set.id], metadata={"type": typ}, limit=None)
-    known_external_ids = {ts.external_id for ts in avail_ts}
-    missing_ext_ids = {
-        record.get("externalId") for record in datapoints if record.get("externalId") not in known_external_ids
-    }
 
-    timeseries_list = [
-        TimeSeries(
-            external_id=new_ts,
-            name=translate_to_a_name(new_ts),
-            metadata={"type": typ},
-            data_set_id=data_set.id,
-        )
-        for new_ts in missing_ext_ids
-    ]
-    if len(timeseries_list) > 0:
-        # Create missing timeseries
-        client.time_series.create(timeseries_list)
+    def __init__(self, ttl: Optional[float] = None):
+        self.ttl = ttl
+        self._lock = Lock()
+        self._known: Dict[Tuple[int, str], Set[str]] = {}
+        self._loaded_at: Dict[Tuple[int, str], float] = {}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._known.clear()
+            self._loaded_at.clear()
+
+    def _known_external_ids(
+        self, client: CogniteClient, data_set: DataSet, typ: str, refresh: bool = False
+    ) -> Set[str]:
+        key = (data_set.id, typ)
+        loaded_at = self._loaded_at.get(key)
+        if refresh or loaded_at is None or (self.ttl is not None and monotonic() - loaded_at > self.ttl):
+            avail_ts = SCHEDULER.call(
+                client.time_series.list, data_set_ids=[data_set.id], metadata={"type": typ}, limit=None
+            )
+            self._known[key] = {ts.external_id for ts in avail_ts}
+            self._loaded_at[key] = monotonic()
+        return self._known[key]
+
+    def ensure_time_series(
+        self, client: CogniteClient, external_ids: Iterable[str], typ: str, data_set: DataSet
+    ) -> None:
+        """
+        Create the time series among external_ids that do not exist in the data set yet.
+
+        When some of them exist after all, e.g. created by an earlier attempt whose response was lost, the listing is
+        loaded again and only the ones still missing are created.
+        """
+        with self._lock:
+            known_external_ids = self._known_external_ids(client, data_set, typ)
+            missing_ext_ids = set(external_ids) - known_external_ids
+            if not missing_ext_ids:
+                return
+            try:
+                self._create(client, missing_ext_ids, typ, data_set)
+            except CogniteDuplicatedError as e:
+                print(f"{len(e.duplicated)} timeserie(s) exist already, listing them again.")
+                known_external_ids = self._known_external_ids(client, data_set, typ, refresh=True)
+                missing_ext_ids = set(external_ids) - known_external_ids
+                if missing_ext_ids:
+                    self._create(client, missing_ext_ids, typ, data_set)
+            known_external_ids.update(missing_ext_ids)
+
+    def _create(self, client: CogniteClient, external_ids: Set[str], typ: str, data_set: DataSet) -> None:
+        timeseries_list = [
+            TimeSeries(
+                external_id=new_ts,
+                name=translate_to_a_name(new_ts),
+                metadata={"type": typ},
+                data_set_id=data_set.id,
+            )
+            for new_ts in external_ids
+        ]
+        SCHEDULER.call(client.time_series.create, timeseries_list)
         print(f"Created missing {len(timeseries_list)} timeserie(s).")
 
-    # Insert datapoints
-    client.time_series.data.insert_multiple(datapoints)
-    print(f"Inserted datapoints for type {typ}. For {str(len(datapoints))} timeseries.")
+
+KNOWN_TIMESERIES = TimeSeriesRegistry()
+
+# Per-stage timings and counters of the current run
+METRICS = Metrics(namespace="oee_timeseries")
+
+
+class DatapointsUploader:
+    """
+    Collects OEE datapoints from all sites and windows and uploads them to CDF in size-bounded batches.
+
+    Args:
+        client: Cognite client
+        data_set: data set the output time series are created in
+        max_datapoints: upload a batch once it holds this many datapoints
+        max_bytes: upload a batch once its estimated request body reaches this size
+        max_workers: number of concurrent upload workers
+        max_pending: number of batches that may wait for or be in upload before add() blocks. Defaults to 2 per worker
+        registry: cache of the output time series known to exist
+        metrics: where upload timings, datapoints and batches in flight are recorded, under the "upload" stage
+    """
+
+    # Rough JSON size of a single {"timestamp": ..., "value": ...} item and of a time series entry
+    DATAPOINT_BYTES = 50
+    RECORD_BYTES = 40
+
+    def __init__(
+        self,
+        client: CogniteClient,
+        data_set: DataSet,
+        max_datapoints: int = 100_000,
+        max_bytes: int = 5_000_000,
+        max_workers: int = 4,
+        max_pending: Optional[int] = None,
+        registry: TimeSeriesRegistry = KNOWN_TIMESERIES,
+        metrics: Metrics = METRICS,
+    ):
+        self.client = client
+        self.data_set = data_set
+        self.max_datapoints = max_datapoints
+        self.max_bytes = max_bytes
+        self.registry = registry
+        self.metrics = metrics
+        self._lock = Lock()
+        self._buffer: List[Dict[str, Union[str, int, list]]] = []
+        self._buffered_datapoints = 0
+        self._buffered_bytes = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="OEE-Uploader")
+        self._futures: List[Future] = []
+        self._pending = BoundedSemaphore(max_pending or 2 * max_workers)
+
+    def add(self, datapoints: List[Dict[str, Union[str, int, list]]], typ: str) -> None:
+        """
+        Queue datapoints of the given output type, creating missing time series first.
+        """
+        self.registry.ensure_time_series(
+            client=self.client,
+            external_ids=[record.get("externalId") for record in datapoints],
+            typ=typ,
+            data_set=self.data_set,
+        )
+        with self._lock:
+            for record in datapoints:
+                count = len(record["datapoints"])
+                size = self.RECORD_BYTES + len(record["externalId"]) + count * self.DATAPOINT_BYTES
+                if self._buffer and (
+                    self._buffered_datapoints + count > self.max_datapoints
+                    or self._buffered_bytes + size > self.max_bytes
+                ):
+                    self._submit()
+                self._buffer.append(record)
+                self._buffered_datapoints += count
+                self._buffered_bytes += size
+
+    def _submit(self) -> None:
+        # Backpressure: producers wait here while too many batches are in flight, keeping memory bounded
+        self._pending.acquire()
+        future = self._executor.submit(self._upload, self._buffer, self._buffered_datapoints)
+        future.add_done_callback(lambda _: self._pending.release())
+
+        # Surface failed uploads early and drop finished batches
+        for f in self._futures:
+            if f.done():
+                f.result()
+        self._futures = [f for f in self._futures if not f.done()]
+        self._futures.append(future)
+        self.metrics.gauge("upload", "batches_in_flight", len(self._futures))
+        self._buffer = []
+        self._buffered_datapoints = 0
+        self._buffered_bytes = 0
+
+    def _upload(self, batch: List[Dict[str, Union[str, int, list]]], count: int) -> None:
+        with self.metrics.time("upload"):
+            SCHEDULER.call(self.client.time_series.data.insert_multiple, batch)
+        self.metrics.count("upload", "datapoints", count)
+        print(f"Inserted {count} datapoints for {len(batch)} timeseries.")
+
+    def flush(self) -> None:
+        """
+        Upload everything queued so far and wait for all pending batches.
+        """
+        with self._lock:
+            if self._buffer:
+                self._submit()
+            futures, self._futures = self._futures, []
+        for f in futures:
+            f.result()
+
+    def __enter__(self) -> DatapointsUploader:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
 
 
 def get_timeseries_for_site(client: CogniteClient, site: str):
     known_types = {"count", "good", "status", "planned_status"}
-    outcome = {}
-    for typ in known_types:
-        for ts in client.time_series.list(metadata={"site": site, "type": typ}, limit=None):
-            outcome[ts.external_id] = ts
-    return outcome
+    return {
+        ts.external_id: ts
+        for ts in SCHEDULER.call(client.time_series.list, metadata={"site": site}, limit=None)
+        if (ts.metadata or {}).get("type") in known_types
+    }
 
 
-def discover_datapoints(client: CogniteClient, ts: Dict[str, TimeSeries], window: Tuple[Arrow, Arrow]):
+def retrieve_datapoints(
+    client: CogniteClient, ts: Dict[str, TimeSeries], start: int, end: int
+) -> Dict[str, np.ndarray]:
+    """
+    Retrieve 1 minute sums of the given time series between start and end (ms), as sorted (timestamp, sum) arrays.
+    """
     outcome = {}
-    data = client.time_series.data.retrieve(
+    data = SCHEDULER.call(
+        client.time_series.data.retrieve,
         external_id=list(ts.keys()),
-        start=window[0].float_timestamp * 1000,
-        end=window[1].float_timestamp * 1000,
+        start=start,
+        end=end,
         aggregates=["sum"],
         granularity="1m",
     )
     for _r in data:
-        outcome[_r.external_id] = sorted(zip(_r.timestamp, _r.sum), key=lambda x: x[0])
+        timestamps = np.asarray(_r.timestamp, dtype=np.float64)
+        order = np.argsort(timestamps, kind="stable")
+        outcome[_r.external_id] = np.column_stack((timestamps[order], np.asarray(_r.sum, dtype=np.float64)[order]))
+    return outcome
+
+
+def discover_datapoints(
+    client: CogniteClient,
+    ts: Dict[str, TimeSeries],
+    window: Span,
+    retrieved: Optional[Dict[str, np.ndarray]] = None,
+    seed_cache: Optional[Dict[Tuple[str, int], Tuple[list, list]]] = None,
+):
+    """
+    Get the datapoints of the given time series within the window, with status series filled for every minute.
+
+    Args:
+        client: Cognite client
+        ts: time series to get datapoints for, keyed by external id
+        window: time range (ms, half-open) to get datapoints for
+        retrieved: output of retrieve_datapoints for a range covering the window. Retrieved from CDF when omitted
+        seed_cache: cache passed on to retrieve_latest_before for the values status series start the window with
+    """
+    start, end = window
+    if retrieved is None:
+        retrieved = retrieve_datapoints(client, ts, start, end)
+
+    outcome = {}
+    for k, v in retrieved.items():
+        outcome[k] = v[window_slice(v[:, 0], start, end)]
 
     # fill the gaps
 
-    for k, v in outcome.items():
-        if k.endswith("status"):
-            dp = client.time_series.data.retrieve_latest(external_id=k, before=window[0].float_timestamp * 1000 + 1)
-
-            if len(dp.timestamp) == 0:
-                values = [(window[0].float_timestamp * 1000, 0.0)]
-            elif len(v) == 0:
-                values = list(zip(dp.timestamp, dp.value))
-            else:
-                values = list(zip(dp.timestamp, dp.value)) + v
-
-            outcome[k] = sorted(
-                [
-                    (
-                        _timestamp,
-                        next((values[i - 1][1] for i, v in enumerate(values) if v[0] > _timestamp), values[0][1]),
-                    )
-                    for _timestamp in range(
-                        floor(window[0].floor("minutes").float_timestamp * 1000),
-                        floor(window[1].floor("minutes").shift(minutes=1).float_timestamp * 1000),
-                        60_000,
-                    )
-                ],
-                key=lambda x: x[0],
-            )
+    status_ids = [k for k in outcome if k.endswith("status")]
+    seeds = retrieve_latest_before(client, status_ids, start + 1, seed_cache) if status_ids else {}
+    # Every whole minute of the window, as the 1 minute sums of the other series
+    minutes = grid(start, end)
+    for k in status_ids:
+        v = outcome[k]
+        seed_timestamps, seed_values = seeds[k]
+
+        if len(seed_timestamps) == 0:
+            timestamps, values = [start], [0.0]
+        else:
+            timestamps = np.concatenate((seed_timestamps, v[:, 0]))
+            values = np.concatenate((seed_values, v[:, 1]))
+
+        outcome[k] = np.column_stack((minutes, forward_fill(timestamps, values, minutes)))
 
     return outcome
+
+
+def retrieve_latest_before(
+    client: CogniteClient,
+    external_ids: List[str],
+    before: int,
+    cache: Optional[Dict[Tuple[str, int], Tuple[list, list]]] = None,
+) -> Dict[str, Tuple[list, list]]:
+    """
+    Get the latest datapoint before the given time (ms) for all external ids in a single request.
+
+    Args:
+        client: Cognite client
+        external_ids: external ids of the time series
+        before: exclusive upper bound in ms
+        cache: results keyed by (external id, before), reused and filled in when given
+
+    Returns:
+        (timestamps, values) per external id, both empty when the time series has no earlier datapoint
+    """
+    cache = {} if cache is None else cache
+    missing = [ext_id for ext_id in external_ids if (ext_id, before) not in cache]
+    if missing:
+        for dps in SCHEDULER.call(client.time_series.data.retrieve_latest, external_id=missing, before=before):
+            cache[(dps.external_id, before)] = (list(dps.timestamp), list(dps.value))
+    return {ext_id: cache.get((ext_id, before), ([], [])) for ext_id in external_ids}
+
+
+def forward_fill(timestamps: Sequence[float], values: Sequence[float], grid: np.ndarray) -> np.ndarray:
+    """
+    Sample a step function defined by ascending (timestamps, values) at every point of the grid.
+
+    Each grid point takes the value of the last sample strictly before the first sample that is newer than the grid
+    point. Grid points at or after the last sample fall back to the first value, as the previous per-minute scan did.
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    idx = np.searchsorted(timestamps, grid, side="right")
+    filled = values[idx - 1]
+    filled[idx == len(timestamps)] = values[0]
+    return filled
@@ -0,0 +1,10 @@
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# oee_timeseries modules import each other as top-level modules, as they do when deployed as a function
+sys.path.insert(0, str(ROOT / "oee_timeseries"))
+sys.path.insert(0, str(ROOT))
@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import math
+from threading import Event
+from typing import Any
+from typing import Dict
+from typing import List
+
+import numpy as np
+import pytest
+from cognite.client.data_classes import TimeSeries
+from cognite.extractorutils.uploader import TimeSeriesUploadQueue
+
+from execute_rest_extractor.ice_cream_factory_datapoints_extractor.array_upload_queue import (
+    ArrayTimeSeriesUploadQueue,
+)
+from local_backend import FakeCogniteClient
+
+MINUTE_MS = 60_000
+START = 1_672_531_200_000  # 2023-01-01T00:00:00Z
+
+
+class Recorder:
+    """
+    FakeCogniteClient with its time series created, recording the insert requests and post upload calls.
+    """
+
+    def __init__(self, *external_ids: str):
+        self.client = FakeCogniteClient()
+        for external_id in external_ids:
+            self.client.time_series.create(TimeSeries(external_id=external_id))
+        self.requests: List[List[Dict[str, Any]]] = []
+        self.post_uploads: List[List[Dict[str, Any]]] = []
+        insert_multiple = self.client.datapoints.insert_multiple
+
+        def record(datapoints: List[Dict[str, Any]]) -> None:
+            self.requests.append(datapoints)
+            insert_multiple(datapoints)
+
+        self.client.datapoints.insert_multiple = record
+
+    def post_upload(self, uploaded: List[Dict[str, Any]]) -> None:
+        self.post_uploads.append(uploaded)
+
+    def queue(self, **kwargs) -> ArrayTimeSeriesUploadQueue:
+        return ArrayTimeSeriesUploadQueue(
+            self.client, post_upload_function=self.post_upload, cancelation_token=Event(), **kwargs
+        )
+
+    def sent(self) -> Dict[str, List[tuple]]:
+        """Datapoints per external id over all requests, in order"""
+        sent: Dict[str, List[tuple]] = {}
+        for request in self.requests:
+            for entry in request:
+                sent.setdefault(entry["externalId"], []).extend(entry["datapoints"])
+        return sent
+
+
+def minutes(count: int) -> np.ndarray:
+    return START + np.arange(count, dtype=np.int64) * MINUTE_MS
+
+
+@pytest.mark.unit
+def test_invalid_datapoints_are_discarded():
+    recorder = Recorder("a")
+    queue = recorder.queue()
+    values = np.array([1.0, math.nan, math.inf, -math.inf, 1e101, -1e101, 1e100, -1e100, 2.0])
+    timestamps = minutes(len(values))
+    timestamps[-1] = 1000  # before the earliest timestamp CDF accepts
+    queue.add_arrays_to_upload_queue(external_id="a", timestamps=timestamps, values=values)
+    assert queue.upload_queue_size == 3
+
+    queue.upload()
+    assert recorder.sent() == {"a": [(int(timestamps[i]), values[i]) for i in (0, 6, 7)]}
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("max_upload_points", [1, 3, 4, 7, 100])
+def test_requests_hold_at_most_max_upload_points(max_upload_points):
+    recorder = Recorder("a", "b", "c")
+    queue = recorder.queue(max_upload_points=max_upload_points)
+    counts = {"a": 10, "b": 3, "c": 5}
+    for external_id, count in counts.items():
+        queue.add_arrays_to_upload_queue(external_id=external_id, timestamps=minutes(count), values=np.ones(count))
+    queue.upload()
+
+    for request in recorder.requests:
+        assert sum(len(entry["datapoints"]) for entry in request) <= max_upload_points
+    assert recorder.sent() == {
+        external_id: list(zip(minutes(count).tolist(), [1.0] * count)) for external_id, count in counts.items()
+    }
+    # Tuples of plain Python numbers, as the SDK posts them
+    timestamp, value = recorder.requests[0][0]["datapoints"][0]
+    assert type(timestamp) is int and type(value) is float
+
+
+@pytest.mark.unit
+def test_post_upload_gets_first_and_last_datapoint():
+    recorder = Recorder("a", "b")
+    queue = recorder.queue(max_upload_points=4)
+    timestamps = minutes(10)
+    values = np.arange(10, dtype=np.float64)
+    # Out of order over two adds
+    queue.add_arrays_to_upload_queue(external_id="a", timestamps=timestamps[5:], values=values[5:])
+    queue.add_arrays_to_upload_queue(external_id="a", timestamps=timestamps[:5], values=values[:5])
+    queue.add_arrays_to_upload_queue(external_id="b", timestamps=timestamps[:1], values=values[:1])
+    queue.upload()
+
+    assert recorder.post_uploads == [
+        [
+            {"externalId": "a", "datapoints": [(int(timestamps[0]), 0.0), (int(timestamps[9]), 9.0)]},
+            {"externalId": "b", "datapoints": [(int(timestamps[0]), 0.0), (int(timestamps[0]), 0.0)]},
+        ]
+    ]
+
+
+@pytest.mark.unit
+def test_post_upload_skips_dropped_time_series():
+    recorder = Recorder("a")
+    queue = recorder.queue()
+    queue.add_arrays_to_upload_queue(external_id="a", timestamps=minutes(2), values=np.ones(2))
+    queue.add_arrays_to_upload_queue(external_id="missing", timestamps=minutes(2), values=np.ones(2))
+    queue.upload()
+    assert [entry["externalId"] for entry in recorder.post_uploads[0]] == ["a"]
+
+
+@pytest.mark.unit
+def test_payload_matches_time_series_upload_queue():
+    rng = np.random.default_rng(0)
+    batches = []
+    for external_id in ["a", "b", "a", "c"]:
+        count = int(rng.integers(1, 50))
+        timestamps = START + rng.integers(0, 10_000, size=count) * 1000
+        values = rng.normal(size=count)
+        values[rng.random(count) < 0.1] = math.nan
+        batches.append((external_id, timestamps, values))
+
+    old = Recorder("a", "b", "c")
+    old_queue = TimeSeriesUploadQueue(old.client, post_upload_function=old.post_upload, cancelation_token=Event())
+    new = Recorder("a", "b", "c")
+    new_queue = new.queue()
+    for external_id, timestamps, values in batches:
+        old_queue.add_to_upload_queue(
+            external_id=external_id, datapoints=list(zip(timestamps.tolist(), values.tolist()))
+        )
+        new_queue.add_to_upload_queue(
+            external_id=external_id, datapoints=list(zip(timestamps.tolist(), values.tolist()))
+        )
+    old_queue.upload()
+    new_queue.upload()
+
+    assert new.requests == old.requests
+    assert new.client.datapoints_store == old.client.datapoints_store
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+from threading import Event
+from types import SimpleNamespace
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+import pytest
+from cognite.client.data_classes import TimeSeries
+
+from execute_rest_extractor.ice_cream_factory_datapoints_extractor.datapoints_backfiller import Backfiller
+from local_backend import FakeCogniteClient
+
+MINUTE_MS = 60_000
+HOUR_MS = 60 * MINUTE_MS
+START = 1_672_531_200_000  # 2023-01-01T00:00:00Z
+
+
+class FakeStates:
+    def __init__(self, states: Dict[str, Tuple[int, int]]):
+        self.states = states
+
+    def get_state(self, external_ids: List[str]) -> List[Tuple[int, int]]:
+        return [self.states.get(ext_id, (None, None)) for ext_id in external_ids]
+
+
+def backfiller(client: FakeCogniteClient, states: FakeStates, end: int, expected_interval_sec: int = 60) -> Backfiller:
+    config = SimpleNamespace(
+        backfill=SimpleNamespace(history_days=1, gap_detection=True, expected_interval_sec=expected_interval_sec)
+    )
+    backfiller = Backfiller(None, Event(), None, [], config, states, client)
+    backfiller.stop_at, backfiller.now_ts = START, end
+    return backfiller
+
+
+def series(client: FakeCogniteClient, external_id: str, minutes_per_hour: List[int], step_sec: int = 60) -> None:
+    """
+    Time series with the given number of datapoints in each hour from START, step_sec apart.
+    """
+    client.time_series.create(TimeSeries(external_id=external_id))
+    store = client.datapoints_store.setdefault(external_id, {})
+    for hour, count in enumerate(minutes_per_hour):
+        for i in range(count):
+            store[START + hour * HOUR_MS + i * step_sec * 1000] = 1.0
+
+
+def gaps(minutes_per_hour: List[int], end: int, expected_interval_sec: int = 60, step_sec: int = 60):
+    client = FakeCogniteClient()
+    series(client, "a", minutes_per_hour, step_sec)
+    states = FakeStates({"a": (START, end)})
+    return backfiller(client, states, end, expected_interval_sec).find_gaps([TimeSeries(external_id="a")])["a"]
+
+
+@pytest.mark.unit
+def test_full_hours_are_no_gaps():
+    assert gaps([60, 60, 60], end=START + 3 * HOUR_MS) == []
+
+
+@pytest.mark.unit
+def test_partly_filled_hour_is_a_gap():
+    assert gaps([60, 59, 60], end=START + 3 * HOUR_MS) == [(START + HOUR_MS, START + 2 * HOUR_MS)]
+
+
+@pytest.mark.unit
+def test_empty_hours_are_merged_into_one_gap():
+    assert gaps([60, 0, 0, 60, 0], end=START + 5 * HOUR_MS) == [
+        (START + HOUR_MS, START + 3 * HOUR_MS),
+        (START + 4 * HOUR_MS, START + 5 * HOUR_MS),
+    ]
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize(
+    "last_hour, expected", [(30, []), (29, [(START + 2 * HOUR_MS, START + 2 * HOUR_MS + 30 * MINUTE_MS)])]
+)
+def test_last_hour_is_expected_to_be_filled_up_to_now(last_hour, expected):
+    # Now is half an hour into the last hour, so half of its datapoints are expected
+    assert gaps([60, 60, last_hour], end=START + 2 * HOUR_MS + 30 * MINUTE_MS) == expected
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("count, expected", [(30, []), (29, [(START, START + HOUR_MS)])])
+def test_expected_interval_sets_the_count_of_a_full_hour(count, expected):
+    assert gaps([count], end=START + HOUR_MS, expected_interval_sec=120, step_sec=120) == expected
+
+
+@pytest.mark.unit
+def test_series_without_state_are_a_gap_without_querying_cdf():
+    client = FakeCogniteClient()
+    series(client, "a", [60])
+    found = backfiller(client, FakeStates({}), START + HOUR_MS).find_gaps([TimeSeries(external_id="a")])
+    assert found == {"a": [(START, START + HOUR_MS)]}
+    assert client.calls["datapoints.retrieve"] == 0
+
+
+@pytest.mark.unit
+def test_series_missing_in_cdf_are_a_gap():
+    client = FakeCogniteClient()
+    states = FakeStates({"a": (START, START + HOUR_MS)})
+    found = backfiller(client, states, START + 2 * HOUR_MS).find_gaps([TimeSeries(external_id="a")])
+    assert found == {"a": [(START, START + 2 * HOUR_MS)]}
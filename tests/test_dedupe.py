@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+from threading import Event
+
+import numpy as np
+import pytest
+from cognite.client.data_classes import TimeSeries
+from cognite.client.exceptions import CogniteAPIError
+
+from execute_rest_extractor.ice_cream_factory_datapoints_extractor.array_upload_queue import (
+    ArrayTimeSeriesUploadQueue,
+)
+from execute_rest_extractor.ice_cream_factory_datapoints_extractor.dedupe import DatapointDeduplicator
+from execute_rest_extractor.ice_cream_factory_datapoints_extractor.dedupe import TimestampRuns
+from local_backend import FakeCogniteClient
+
+MINUTE_MS = 60_000
+START = 1_672_531_200_000  # 2023-01-01T00:00:00Z
+
+
+def minutes(start: int, stop: int) -> np.ndarray:
+    return START + np.arange(start, stop, dtype=np.int64) * MINUTE_MS
+
+
+class FakeStates:
+    def __init__(self, low: int, high: int):
+        self.state = (low, high)
+
+    def get_state(self, external_id: str):
+        return self.state
+
+
+@pytest.mark.unit
+def test_runs_merge_overlapping_and_adjacent_batches():
+    runs = TimestampRuns()
+    runs.add(minutes(0, 60))
+    runs.add(minutes(30, 90))
+    runs.add(minutes(90, 120))
+    assert runs.runs == [(START, START + 119 * MINUTE_MS, MINUTE_MS)]
+
+    assert runs.contains(minutes(0, 120)).all()
+    assert not runs.contains(minutes(120, 121)).any()
+    assert not runs.contains(minutes(0, 10) + 1000).any()
+
+
+@pytest.mark.unit
+def test_runs_split_where_spacing_changes():
+    runs = TimestampRuns()
+    timestamps = np.concatenate([minutes(0, 10), START + 9 * MINUTE_MS + np.arange(1, 11) * 1000])
+    runs.add(timestamps)
+    assert [step for _, _, step in runs.runs] == [MINUTE_MS, 1000]
+    assert runs.contains(timestamps).all()
+    assert not runs.contains(np.array([START + 500, START + 9 * MINUTE_MS + 500])).any()
+
+
+@pytest.mark.unit
+def test_runs_evict_oldest_beyond_max_runs():
+    runs = TimestampRuns(max_runs=3)
+    for hour in range(5):
+        # Single timestamps an hour apart with irregular offsets, so every batch is a run of its own
+        runs.add(np.array([START + hour * 60 * MINUTE_MS + hour * 1000]))
+    assert len(runs.runs) == 3
+    kept = np.array([START + hour * 60 * MINUTE_MS + hour * 1000 for hour in range(5)])
+    assert runs.contains(kept).tolist() == [False, False, True, True, True]
+
+
+@pytest.mark.unit
+def test_runs_keep_window_is_never_evicted():
+    runs = TimestampRuns(max_runs=2, keep_ms=10 * MINUTE_MS)
+    timestamps = np.array([START + i * MINUTE_MS + i for i in range(20)])
+    for timestamp in timestamps:
+        runs.add(np.array([timestamp]))
+    # Runs ending within 10 minutes of the latest timestamp are kept on top of max_runs
+    assert runs.contains(timestamps).tolist() == [False] * 10 + [True] * 10
+
+
+@pytest.mark.unit
+def test_runs_remove_splits_run():
+    runs = TimestampRuns()
+    runs.add(minutes(0, 60))
+    runs.remove(minutes(20, 30))
+    assert runs.contains(minutes(0, 60)).tolist() == [True] * 20 + [False] * 10 + [True] * 30
+    runs.remove(minutes(100, 110))
+    assert runs.contains(minutes(0, 60)).sum() == 50
+
+
+@pytest.mark.unit
+def test_deduplicator_drops_seen_and_in_batch_duplicates():
+    deduplicator = DatapointDeduplicator()
+    timestamps = np.array([START, START, START + MINUTE_MS])
+    assert deduplicator.filter("a", timestamps).tolist() == [True, False, True]
+    assert deduplicator.filter("a", minutes(0, 3)).tolist() == [False, False, True]
+    # Time series are deduplicated independently
+    assert deduplicator.filter("b", minutes(0, 3)).all()
+
+
+@pytest.mark.unit
+def test_deduplicator_skips_watermarks_only_when_enabled():
+    states = FakeStates(low=START + 10 * MINUTE_MS, high=START + 20 * MINUTE_MS)
+    expected = [t < states.state[0] or t > states.state[1] for t in minutes(0, 30).tolist()]
+
+    assert DatapointDeduplicator(states, skip_watermarks=True).filter("a", minutes(0, 30)).tolist() == expected
+    assert DatapointDeduplicator(states, skip_watermarks=False).filter("a", minutes(0, 30)).all()
+    assert DatapointDeduplicator(None, skip_watermarks=True).filter("a", minutes(0, 30)).all()
+
+
+@pytest.mark.unit
+def test_deduplicator_forget_allows_queueing_again():
+    deduplicator = DatapointDeduplicator()
+    deduplicator.filter("a", minutes(0, 10))
+    deduplicator.forget("a", minutes(5, 10))
+    assert deduplicator.filter("a", minutes(0, 10)).tolist() == [False] * 5 + [True] * 5
+    deduplicator.forget("unknown", minutes(0, 10))
+
+
+def upload_queue(client: FakeCogniteClient, deduplicator: DatapointDeduplicator) -> ArrayTimeSeriesUploadQueue:
+    return ArrayTimeSeriesUploadQueue(client, deduplicator=deduplicator, cancelation_token=Event())
+
+
+@pytest.mark.unit
+def test_failed_upload_keeps_points_queued(monkeypatch):
+    client = FakeCogniteClient()
+    client.time_series.create(TimeSeries(external_id="a"))
+    queue = upload_queue(client, DatapointDeduplicator())
+    queue.add_arrays_to_upload_queue(external_id="a", timestamps=minutes(0, 10), values=np.ones(10))
+
+    upload_batch = queue._upload_batch
+
+    def fail(batch):
+        raise CogniteAPIError("Service unavailable", code=503)
+
+    monkeypatch.setattr(queue, "_upload_batch", fail)
+    with pytest.raises(CogniteAPIError):
+        queue.upload()
+    # Querying the same datapoints again adds nothing, they are still queued
+    queue.add_arrays_to_upload_queue(external_id="a", timestamps=minutes(0, 12), values=np.ones(12))
+    assert queue.upload_queue_size == 12
+
+    monkeypatch.setattr(queue, "_upload_batch", upload_batch)
+    queue.upload()
+    assert sorted(client.datapoints_store["a"]) == minutes(0, 12).tolist()
+
+
+@pytest.mark.unit
+def test_dropped_time_series_can_be_queued_again():
+    client = FakeCogniteClient()
+    queue = upload_queue(client, DatapointDeduplicator())
+    queue.add_arrays_to_upload_queue(external_id="a", timestamps=minutes(0, 10), values=np.ones(10))
+    # The time series does not exist, its datapoints are dropped by the upload
+    queue.upload()
+    assert "a" not in client.datapoints_store
+
+    client.time_series.create(TimeSeries(external_id="a"))
+    queue.add_arrays_to_upload_queue(external_id="a", timestamps=minutes(0, 10), values=np.ones(10))
+    assert queue.upload_queue_size == 10
+    queue.upload()
+    assert sorted(client.datapoints_store["a"]) == minutes(0, 10).tolist()
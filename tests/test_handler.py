@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+from typing import Any
+from typing import Dict
+from typing import List
+
+import pytest
+from handler import process_site
+
+from common.timegrid import DAY_MS
+from common.timegrid import spans
+from local_backend import FakeCogniteClient
+from local_backend import SyntheticFactory
+
+NOW = 1_672_531_200_000  # 2023-01-01T00:00:00Z
+# 2 machines with count, good, status and planned_status series each
+SITE_SERIES = 8
+DAY_DATAPOINTS = SITE_SERIES * 1440
+
+
+class CollectingUploader:
+    def __init__(self):
+        self.records: Dict[str, List[Dict[str, Any]]] = {}
+
+    def add(self, datapoints: List[Dict[str, Any]], typ: str) -> None:
+        for record in datapoints:
+            self.records.setdefault(record["externalId"], []).extend(record["datapoints"])
+
+
+def run(days: int, **kwargs):
+    factory = SyntheticFactory(sites=["Oslo"], equipment_per_site=2)
+    client = FakeCogniteClient(factory, prefill=True, prefill_days=days + 1, now=NOW)
+    uploader = CollectingUploader()
+    windows = spans(NOW - days * DAY_MS, NOW, DAY_MS)
+    process_site(client, uploader, "Oslo", windows, {}, **kwargs)
+    return client.calls["datapoints.retrieve"], uploader.records
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize(
+    "kwargs, retrievals",
+    [
+        ({}, 1),
+        ({"chunk_days": 2}, 4),
+        ({"max_datapoints": 3 * DAY_DATAPOINTS}, 3),
+        ({"max_datapoints": 3 * DAY_DATAPOINTS - 1}, 4),
+        # A chunk holds at least one day, however small the budget
+        ({"max_datapoints": 10}, 7),
+        # An explicit chunk size wins over the budget
+        ({"chunk_days": 7, "max_datapoints": 10}, 1),
+    ],
+)
+def test_process_site_chunks(kwargs, retrievals):
+    calls, records = run(days=7, **kwargs)
+    assert calls == retrievals
+    _, expected = run(days=7)
+    assert records == expected
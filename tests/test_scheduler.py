@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import pytest
+from cognite.client import ClientConfig
+from cognite.client import CogniteClient
+from cognite.client.credentials import Token
+from cognite.client.exceptions import CogniteAPIError
+from cognite.client.exceptions import CogniteConnectionError
+from scheduler import AdaptiveScheduler
+
+
+def scheduler(**kwargs) -> AdaptiveScheduler:
+    # No backoff sleeps in tests
+    kwargs.setdefault("delay", 0.0)
+    kwargs.setdefault("max_delay", 0.0)
+    return AdaptiveScheduler(**kwargs)
+
+
+class FlakyCall:
+    """
+    Callable that raises the given errors on its first calls and then returns "ok".
+    """
+
+    def __init__(self, *errors: Exception):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self) -> str:
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+@pytest.mark.unit
+def test_concurrency_is_limited():
+    sched = scheduler(max_concurrency=3)
+    lock = Lock()
+    in_flight, peak = 0, 0
+
+    def call() -> None:
+        nonlocal in_flight, peak
+        with lock:
+            in_flight += 1
+            peak = max(peak, in_flight)
+        time.sleep(0.02)
+        with lock:
+            in_flight -= 1
+
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        list(executor.map(lambda _: sched.call(call), range(30)))
+    assert peak == 3
+
+
+@pytest.mark.unit
+def test_limit_is_halved_on_throttling_and_grows_back():
+    sched = scheduler(max_concurrency=8)
+    assert sched.call(FlakyCall(CogniteAPIError("Too many requests", code=429))) == "ok"
+    # The failed attempt halves the limit, the successful retry grows it by one over the limit
+    assert sched.limit == pytest.approx(4 + 1 / 4)
+
+    for _ in range(3):
+        sched.call(FlakyCall(*[CogniteAPIError("Too many requests", code=429)] * 4))
+    assert sched.limit == sched.min_concurrency + 1 / sched.min_concurrency
+
+    for _ in range(200):
+        sched.call(FlakyCall())
+    assert sched.limit == sched.max_concurrency
+
+
+@pytest.mark.unit
+def test_slow_calls_halve_limit():
+    sched = scheduler(max_concurrency=8, target_latency=0.01)
+    sched.call(time.sleep, 0.02)
+    assert sched.limit == 4
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("code", [429, 500, 502, 503, 504])
+def test_transient_api_errors_are_retried(code):
+    call = FlakyCall(CogniteAPIError("Failed", code=code), CogniteAPIError("Failed", code=code))
+    assert scheduler().call(call) == "ok"
+    assert call.calls == 3
+
+
+@pytest.mark.unit
+def test_connection_errors_are_retried():
+    call = FlakyCall(CogniteConnectionError())
+    assert scheduler().call(call) == "ok"
+    assert call.calls == 2
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("error", [CogniteAPIError("Bad request", code=400), ValueError("bug")])
+def test_other_errors_are_raised_at_once(error):
+    sched = scheduler(max_concurrency=8)
+    call = FlakyCall(error)
+    with pytest.raises(type(error)):
+        sched.call(call)
+    assert call.calls == 1
+    # Errors that are not a sign of overload do not lower the limit
+    assert sched.limit == 8
+
+
+@pytest.mark.unit
+def test_retries_give_up_after_tries():
+    call = FlakyCall(*[CogniteAPIError("Too many requests", code=429)] * 5)
+    with pytest.raises(CogniteAPIError):
+        scheduler(tries=5).call(call)
+    assert call.calls == 5
+
+
+@pytest.mark.unit
+def test_configure_lowers_sdk_retries():
+    config = ClientConfig(
+        client_name="test", project="test", credentials=Token("token"), base_url="https://example.cognitedata.com"
+    )
+    client = CogniteClient(config)
+    scheduler(sdk_max_retries=1).configure(max_concurrency=4, client=client)
+
+    for api in (client.datapoints, client.time_series, client.raw.rows, client.data_sets):
+        assert api._http_client_with_retry.config.max_retries_total == 1
+        assert api._http_client_with_retry.config.max_retries_status == 1
+        # Non-idempotent requests are still never retried after a read timeout
+        assert api._http_client.config.max_retries_read == 0
@@ -0,0 +1,62 @@
+from __future__ import annotations
+
+import pytest
+
+from execute_rest_extractor.ice_cream_factory_datapoints_extractor.state_store import BatchedRawStateStore
+from execute_rest_extractor.ice_cream_factory_datapoints_extractor.state_store import WATERMARK_KEY
+from local_backend import FakeCogniteClient
+
+DB = "src:002:opcua:db:state"
+TABLE = "timeseries_datapoints_states"
+WATERMARK_TABLE = "timeseries_datapoints_watermark"
+
+
+def store(client: FakeCogniteClient) -> BatchedRawStateStore:
+    states = BatchedRawStateStore(cdf_client=client, database=DB, table=TABLE, watermark_table=WATERMARK_TABLE)
+    states.initialize()
+    return states
+
+
+def watermark(client: FakeCogniteClient) -> int:
+    return client.raw_store[DB][WATERMARK_TABLE][WATERMARK_KEY]["high"]
+
+
+@pytest.mark.unit
+def test_watermark_only_moves_forward_across_stores():
+    client = FakeCogniteClient()
+    backfill = store(client)
+    backfill.set_state("a", low=100, high=200)
+    backfill.synchronize()
+    assert watermark(client) == 200
+
+    # A frontfill run advances the watermark while the backfill run still holds its older states
+    frontfill = store(client)
+    frontfill.expand_state("b", low=900, high=1000)
+    frontfill.synchronize()
+    assert watermark(client) == 1000
+
+    # The backfill run writes its own state, but must not move the shared watermark back
+    backfill.expand_state("a", low=50, high=300)
+    backfill.synchronize()
+    assert watermark(client) == 1000
+    assert client.raw_store[DB][TABLE]["a"] == {"low": 50, "high": 300}
+
+    backfill.expand_state("a", high=1200)
+    backfill.synchronize()
+    assert watermark(client) == 1200
+
+
+@pytest.mark.unit
+def test_watermark_not_read_or_written_without_changes():
+    client = FakeCogniteClient()
+    states = store(client)
+    states.set_state("a", low=1, high=2)
+    states.synchronize()
+    calls = dict(client.calls)
+
+    states.synchronize()
+    states.expand_state("a", low=0)
+    states.synchronize()
+
+    assert client.calls["raw.rows.retrieve"] == calls.get("raw.rows.retrieve", 0)
+    assert watermark(client) == 2
@@ -0,0 +1,41 @@
+from __future__ import annotations
+
+import subprocess
+import sys
+from datetime import datetime
+from datetime import timezone
+from pathlib import Path
+
+import arrow
+import numpy as np
+import pytest
+
+from common.timegrid import to_ms
+
+ROOT = Path(__file__).resolve().parents[1]
+EPOCH_MS = 1_672_531_200_000  # 2023-01-01T00:00:00Z
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize(
+    "time",
+    [
+        arrow.get("2023-01-01T00:00:00+00:00"),
+        arrow.get("2023-01-01T01:00:00+01:00"),
+        datetime(2023, 1, 1, tzinfo=timezone.utc),
+        datetime(2023, 1, 1),
+        EPOCH_MS,
+        float(EPOCH_MS) + 0.4,
+        np.int64(EPOCH_MS),
+        np.float64(EPOCH_MS),
+    ],
+)
+def test_to_ms(time):
+    assert to_ms(time) == EPOCH_MS
+
+
+@pytest.mark.unit
+def test_common_modules_do_not_import_arrow_or_requests():
+    code = "import sys, common.metrics, common.timegrid; print(sorted({'arrow', 'requests'} & set(sys.modules)))"
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, stdout=subprocess.PIPE, universal_newlines=True)
+    assert result.stdout.strip() == "[]"
@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+from typing import List
+from typing import Tuple
+
+import numpy as np
+import pytest
+from cognite.client.data_classes import TimeSeries
+from tools import discover_datapoints
+from tools import forward_fill
+
+MINUTE_MS = 60_000
+START = 1_672_531_200_000  # 2023-01-01T00:00:00Z
+
+
+def scan_fill(values: List[Tuple[float, float]], timestamp: float) -> float:
+    """
+    Value at the timestamp as the per-minute scan of discover_datapoints computed it before forward_fill.
+    """
+    return next((values[i - 1][1] for i, v in enumerate(values) if v[0] > timestamp), values[0][1])
+
+
+def random_samples(rng: np.random.Generator, count: int, duplicates: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    timestamps = np.sort(START + rng.integers(0, 120, size=count) * MINUTE_MS + rng.integers(0, 2, size=count) * 1000)
+    if duplicates:
+        timestamps[1::3] = timestamps[::3][: len(timestamps[1::3])]
+        timestamps.sort()
+    return timestamps.astype(np.float64), rng.integers(0, 2, size=count).astype(np.float64)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("duplicates", [False, True])
+def test_forward_fill_matches_scan(seed, duplicates):
+    rng = np.random.default_rng(seed)
+    timestamps, values = random_samples(rng, int(rng.integers(1, 30)), duplicates)
+    # Starts before the first sample and ends after the last one
+    grid = np.arange(START - 10 * MINUTE_MS, START + 130 * MINUTE_MS, MINUTE_MS, dtype=np.int64)
+
+    samples = list(zip(timestamps.tolist(), values.tolist()))
+    expected = [scan_fill(samples, t) for t in grid.tolist()]
+
+    assert forward_fill(timestamps, values, grid).tolist() == expected
+
+
+@pytest.mark.unit
+def test_forward_fill_before_first_sample_takes_last_value():
+    filled = forward_fill([START, START + MINUTE_MS], [1.0, 2.0], np.array([START - MINUTE_MS], dtype=np.int64))
+    assert filled.tolist() == [2.0] == [scan_fill([(START, 1.0), (START + MINUTE_MS, 2.0)], START - MINUTE_MS)]
+
+
+@pytest.mark.unit
+def test_forward_fill_after_last_sample_takes_first_value():
+    grid = np.array([START + MINUTE_MS, START + 5 * MINUTE_MS], dtype=np.int64)
+    filled = forward_fill([START, START + MINUTE_MS], [1.0, 2.0], grid)
+    assert filled.tolist() == [1.0, 1.0] == [scan_fill([(START, 1.0), (START + MINUTE_MS, 2.0)], t) for t in grid]
+
+
+@pytest.mark.unit
+def test_forward_fill_duplicate_timestamps_take_last_duplicate():
+    samples = [(START, 1.0), (START + MINUTE_MS, 3.0), (START + MINUTE_MS, 4.0), (START + 3 * MINUTE_MS, 5.0)]
+    grid = np.arange(START, START + 3 * MINUTE_MS, MINUTE_MS, dtype=np.int64)
+    filled = forward_fill([t for t, _ in samples], [v for _, v in samples], grid)
+    assert filled.tolist() == [1.0, 4.0, 4.0] == [scan_fill(samples, t) for t in grid.tolist()]
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("seed", range(10))
+def test_discover_datapoints_matches_scan(seed):
+    rng = np.random.default_rng(seed)
+    window = (START + 30 * MINUTE_MS, START + 90 * MINUTE_MS)
+    ts = {ext_id: TimeSeries(external_id=ext_id) for ext_id in ("PM001:count", "PM001:status", "PM002:status")}
+    retrieved = {}
+    for ext_id in ts:
+        timestamps, values = random_samples(rng, int(rng.integers(0, 40)))
+        retrieved[ext_id] = np.column_stack((timestamps, values)).reshape(-1, 2)
+    # PM002:status has no datapoint before the window
+    seed_cache = {
+        ("PM001:status", window[0] + 1): ([window[0] - 5 * MINUTE_MS], [float(rng.integers(0, 2))]),
+        ("PM002:status", window[0] + 1): ([], []),
+    }
+
+    outcome = discover_datapoints(None, ts, window, retrieved, seed_cache)
+
+    count = retrieved["PM001:count"]
+    in_window = count[(count[:, 0] >= window[0]) & (count[:, 0] < window[1])]
+    assert outcome["PM001:count"].tolist() == in_window.tolist()
+
+    minutes = range(window[0], window[1], MINUTE_MS)
+    for ext_id in ("PM001:status", "PM002:status"):
+        seed_timestamps, seed_values = seed_cache[(ext_id, window[0] + 1)]
+        v = retrieved[ext_id]
+        v = v[(v[:, 0] >= window[0]) & (v[:, 0] < window[1])]
+        if not seed_timestamps:
+            samples = [(float(window[0]), 0.0)]
+        else:
+            samples = list(zip(seed_timestamps, seed_values)) + [tuple(row) for row in v.tolist()]
+        expected = [[t, scan_fill(samples, t)] for t in minutes]
+        assert outcome[ext_id].tolist() == expected
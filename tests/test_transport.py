@@ -0,0 +1,195 @@
+from __future__ import annotations
+
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from threading import Thread
+
+import pytest
+import requests
+from urllib3 import HTTPResponse
+from urllib3.exceptions import MaxRetryError
+
+from execute_rest_extractor.ice_cream_factory_datapoints_extractor import transport
+from execute_rest_extractor.ice_cream_factory_datapoints_extractor.transport import CircuitBreaker
+from execute_rest_extractor.ice_cream_factory_datapoints_extractor.transport import CircuitOpenError
+from execute_rest_extractor.ice_cream_factory_datapoints_extractor.transport import http_retry
+from execute_rest_extractor.ice_cream_factory_datapoints_extractor.transport import JitteredRetry
+from execute_rest_extractor.ice_cream_factory_datapoints_extractor.transport import retry_after_seconds
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(transport, "monotonic", clock)
+    return clock
+
+
+def fail(retry: JitteredRetry, status: int = 503, headers: dict = None) -> JitteredRetry:
+    return retry.increment(method="GET", url="/", response=HTTPResponse(status=status, headers=headers or {}))
+
+
+@pytest.mark.unit
+def test_backoff_doubles_and_is_capped():
+    retry = JitteredRetry(total=10, status_forcelist={503}, backoff_factor=0.5, max_backoff=5.0)
+    backoffs = []
+    for _ in range(7):
+        retry = fail(retry)
+        backoffs.append(retry.get_backoff_time())
+    assert backoffs == [0, 1.0, 2.0, 4.0, 5.0, 5.0, 5.0]
+
+
+@pytest.mark.unit
+def test_backoff_jitter_is_bounded(monkeypatch):
+    retry = JitteredRetry(total=10, status_forcelist={503}, backoff_factor=0.5, max_backoff=30.0, jitter=0.5)
+    retry = fail(fail(fail(retry)))
+    monkeypatch.setattr(transport.random, "uniform", lambda low, high: high)
+    assert retry.get_backoff_time() == 2.5
+    monkeypatch.setattr(transport.random, "uniform", lambda low, high: low)
+    assert retry.get_backoff_time() == 2.0
+
+
+@pytest.mark.unit
+def test_new_keeps_backoff_settings():
+    retry = JitteredRetry(total=3, max_backoff=7.0, jitter=0.3, deadline=20.0)
+    copy = retry.new()
+    assert (copy.max_backoff, copy.jitter, copy.deadline) == (7.0, 0.3, 20.0)
+
+
+@pytest.mark.unit
+def test_deadline_counts_from_first_failure(clock):
+    # The policy given to the adapter is never used up, only the copies made on failures are
+    template = JitteredRetry(total=100, status_forcelist={503}, backoff_factor=0.5, deadline=10.0)
+    clock.now += 500
+    retry = fail(template)
+    assert template.retry_until is None
+    assert retry.remaining() == 10.0
+
+    clock.now += 6
+    retry = fail(retry)
+    # Backoff and Retry-After are cut off at the deadline
+    assert retry.get_backoff_time() == 1.0
+    assert retry.get_retry_after(HTTPResponse(status=503, headers={"Retry-After": "120"})) == 4.0
+
+    clock.now += 4
+    with pytest.raises(MaxRetryError):
+        fail(retry)
+
+
+@pytest.mark.unit
+def test_without_deadline_retries_are_counted_only(clock):
+    retry = JitteredRetry(total=2, status_forcelist={503})
+    retry = fail(retry)
+    clock.now += 10_000
+    retry = fail(retry)
+    assert retry.remaining() is None
+    with pytest.raises(MaxRetryError):
+        fail(retry)
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    statuses = []
+    requests = 0
+
+    def do_GET(self):
+        type(self).requests += 1
+        status = self.statuses.pop(0) if self.statuses else 200
+        self.send_response(status)
+        self.send_header("Retry-After", "0")
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    FlakyHandler.statuses, FlakyHandler.requests = [], 0
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+    Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def session(retries: int) -> requests.Session:
+    s = requests.Session()
+    s.mount("http://", requests.adapters.HTTPAdapter(max_retries=http_retry(retries, 0.0, 0.0, deadline=60.0)))
+    return s
+
+
+@pytest.mark.unit
+def test_http_retry_retries_transient_statuses(server):
+    FlakyHandler.statuses = [503, 429, 502]
+    response = session(retries=5).get(server)
+    assert response.status_code == 200
+    assert FlakyHandler.requests == 4
+
+
+@pytest.mark.unit
+def test_http_retry_returns_last_response(server):
+    FlakyHandler.statuses = [503] * 10
+    response = session(retries=2).get(server)
+    assert response.status_code == 503
+    assert FlakyHandler.requests == 3
+
+
+@pytest.mark.unit
+def test_http_retry_does_not_retry_client_errors(server):
+    FlakyHandler.statuses = [404]
+    assert session(retries=5).get(server).status_code == 404
+    assert FlakyHandler.requests == 1
+
+
+@pytest.mark.unit
+def test_circuit_opens_after_threshold_and_resets(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30.0)
+    for _ in range(2):
+        breaker.record(success=False)
+        breaker.check()
+    breaker.record(success=False)
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+    clock.now += 30
+    breaker.check()
+    # Half open: the next failure opens the circuit again at once
+    breaker.record(success=False)
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+    clock.now += 30
+    breaker.record(success=True)
+    breaker.record(success=False)
+    breaker.check()
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize(
+    "header, expected",
+    [(None, None), ("", None), ("3", 3.0), ("1.5", 1.5), ("-4", 0.0), ("soon", None)],
+)
+def test_retry_after_seconds(header, expected):
+    assert retry_after_seconds(header) == expected
+
+
+@pytest.mark.unit
+def test_retry_after_http_date():
+    now = datetime.now(timezone.utc)
+    header = format_datetime(now + timedelta(seconds=30), usegmt=True)
+    assert 28 <= retry_after_seconds(header) <= 30
+    past = format_datetime(now - timedelta(seconds=30), usegmt=True)
+    assert retry_after_seconds(past) == 0.0